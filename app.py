@@ -1,39 +1,600 @@
 import os
 import io
+import asyncio
 import base64
 import numpy as np
 from PIL import Image
-from flask import Flask, request, jsonify, render_template, send_from_directory
-from volcenginesdkarkruntime import Ark
+from flask import Flask, Response, request, jsonify, render_template, send_file, g, has_request_context
 from dotenv import load_dotenv
 import json
+import time
 import uuid
+import atexit
+import hashlib
+import functools
+import re
+import queue
+import random
+import sqlite3
+import urllib.parse
+import urllib.request
+import bisect
+import threading
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import FormDataParser
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
-from openai import OpenAI
 import pymysql
 
+from scoring import _image_fingerprint, _score_image_bytes_timed
+
+try:
+    import fcntl
+except ImportError:  # Windows 下无 fcntl，仅使用进程内锁
+    fcntl = None
+
 # 加载环境变量
 load_dotenv()
 
 app = Flask(__name__)
 
+# 以 python app.py 运行时，spawn 启动的评分子进程会以 __mp_main__ 的名义重新执行本文件；
+# 这些子进程只做评分，不启动数据库初始化、上传登记与回收等后台任务
+_SPAWNED_CHILD = __name__ == '__mp_main__'
+
+
+# ===== 性能指标：延迟直方图与计数器 =====
+# 进程内聚合，通过 /metrics 以 Prometheus 文本格式导出；多 worker 部署时每个进程各自导出
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+# 为 1 时在响应中附带 Server-Timing 头，列出本次请求各阶段耗时
+METRICS_TIMING_HEADER = os.environ.get("METRICS_TIMING_HEADER", "0") == "1"
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _Metrics:
+    """线程安全的直方图与计数器；每次观测只做一次二分查找和一次加锁累加。"""
+
+    def __init__(self, buckets, enabled: bool = True):
+        self.buckets = tuple(buckets)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._help: dict[str, tuple[str, str]] = {}
+        self._histograms: dict[tuple, list] = {}
+        self._counters: dict[tuple, float] = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def observe(self, name: str, seconds: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        idx = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            h[0][idx] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ''
+        body = ','.join('{}="{}"'.format(
+            k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs)
+        return '{' + body + '}'
+
+    def render(self, gauges: list[tuple[str, tuple, float]] = ()) -> str:
+        """导出 Prometheus 文本格式；gauges 为调用方现取的 (名称, 标签, 值)。"""
+        with self._lock:
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()}
+            counters = dict(self._counters)
+        families: dict[str, list[str]] = {}
+        for (name, pairs), (counts, total, count) in sorted(histograms.items()):
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(pairs + (('le', repr(float(bound))),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(pairs + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(pairs)} {total:.6f}")
+            lines.append(f"{name}_count{self._labels(pairs)} {count}")
+        for (name, pairs), value in sorted(counters.items()):
+            families.setdefault(name, []).append(f"{name}{self._labels(pairs)} {value:g}")
+        for name, pairs, value in gauges:
+            families.setdefault(name, []).append(f"{name}{self._labels(tuple(pairs))} {value:g}")
+        out = []
+        for name, lines in families.items():
+            kind, text = self._help.get(name, ('untyped', ''))
+            if text:
+                out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return '\n'.join(out) + '\n'
+
+
+metrics = _Metrics(METRICS_BUCKETS, enabled=METRICS_ENABLED)
+metrics.describe('http_request_duration_seconds', 'histogram', '按路由统计的请求处理耗时（流式响应计到返回响应头为止）')
+metrics.describe('http_requests_total', 'counter', '按路由与状态码统计的请求数')
+metrics.describe('upstream_request_duration_seconds', 'histogram', '单次上游调用耗时（不含重试间隔）')
+metrics.describe('upstream_requests_total', 'counter', '上游调用结果计数：ok/error/retry/short_circuit/rate_limited')
+metrics.describe('db_operation_duration_seconds', 'histogram', '数据库操作耗时（含连接池等待）')
+metrics.describe('db_pool_wait_seconds', 'histogram', '从连接池取得连接的等待耗时')
+metrics.describe('image_stage_duration_seconds', 'histogram', '图片处理各阶段耗时')
+metrics.describe('db_pool_connections', 'gauge', '连接池中的连接数')
+metrics.describe('history_write_queue_depth', 'gauge', '历史记录写入队列中待落库的条数')
+metrics.describe('generate_jobs_active', 'gauge', '正在执行的异步生成任务数')
+metrics.describe('upstream_breaker_open', 'gauge', '上游熔断器是否处于非关闭状态')
+metrics.describe('cache_hits_total', 'counter', '缓存命中次数')
+metrics.describe('cache_misses_total', 'counter', '缓存未命中次数')
+
+# 阶段类别 -> (直方图名称, 标签名)
+_TIMER_METRICS = {
+    'upstream': ('upstream_request_duration_seconds', 'upstream'),
+    'db': ('db_operation_duration_seconds', 'op'),
+    'image': ('image_stage_duration_seconds', 'stage'),
+}
+
+
+def _record_timing(kind: str, name: str, seconds: float):
+    """记录阶段耗时；在请求上下文中同时累加到本次请求的 Server-Timing 明细。"""
+    metric, label = _TIMER_METRICS[kind]
+    metrics.observe(metric, seconds, **{label: name})
+    if METRICS_TIMING_HEADER and has_request_context():
+        timings = g.setdefault('stage_timings', {})
+        key = f"{kind}-{name}"
+        timings[key] = timings.get(key, 0.0) + seconds
+
+
+@contextmanager
+def _timed(kind: str, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_timing(kind, name, time.perf_counter() - start)
+
+
+@app.before_request
+def _metrics_request_start():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _metrics_request_end(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    # 使用路由模板而非原始路径作为标签，避免标签基数随文件名膨胀
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe('http_request_duration_seconds', elapsed, method=request.method, route=route)
+    metrics.inc('http_requests_total', method=request.method, route=route, status=response.status_code)
+    if METRICS_TIMING_HEADER:
+        parts = [f"{k};dur={v * 1000:.1f}" for k, v in g.pop('stage_timings', {}).items()]
+        parts.append(f"total;dur={elapsed * 1000:.1f}")
+        response.headers['Server-Timing'] = ', '.join(parts)
+    return response
+
+# 上游调用超时（秒）；重试由下方的统一容错层负责，SDK 自带重试关闭
+ARK_TIMEOUT = float(os.environ.get("ARK_TIMEOUT", "120"))
+MS_TIMEOUT = float(os.environ.get("MS_TIMEOUT", "120"))
+
+
+
+class _LazyClient:
+    """首次访问属性时才创建 SDK 客户端（及其 HTTP 连接池），不占用 worker 启动时间；
+    fork 出的子进程各自重新创建，不共享父进程的连接。"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = self._factory()
+                    self._pid = os.getpid()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class _LazyAsyncClient(_LazyClient):
+    """异步 SDK 客户端：HTTP 连接池绑定事件循环，每个 (进程, 事件循环) 各持有一个，
+    同一循环内的所有请求共享其 keep-alive 连接。只能在事件循环中访问。"""
+
+    def get(self):
+        owner = (os.getpid(), asyncio.get_running_loop())
+        if self._client is None or self._pid != owner:
+            with self._lock:
+                if self._client is None or self._pid != owner:
+                    self._client = self._factory()
+                    self._pid = owner
+        return self._client
+
+    async def aclose(self):
+        with self._lock:
+            current, self._client, self._pid = self._client, None, None
+        if current is not None:
+            await current.close()
+
+
+def _make_ark_client(async_mode: bool = False):
+    # SDK 模块导入本身耗时较长，推迟到首次调用
+    from volcenginesdkarkruntime import Ark, AsyncArk
+    return (AsyncArk if async_mode else Ark)(
+        base_url=os.environ.get("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3"),
+        api_key=os.environ.get("ARK_API_KEY"),
+        timeout=ARK_TIMEOUT,
+        max_retries=0,
+    )
+
+
+def _make_ms_client(async_mode: bool = False):
+    from openai import AsyncOpenAI, OpenAI
+    return (AsyncOpenAI if async_mode else OpenAI)(
+        base_url=os.environ.get("MS_BASE_URL"),
+        api_key=os.environ.get("MS_API_KEY"),
+        timeout=MS_TIMEOUT,
+        max_retries=0,
+    )
+
+
 # 初始化 ARK 客户端（用于生成，但本功能主要用于评估，不调用生成接口）
-client = Ark(
-    base_url="https://ark.cn-beijing.volces.com/api/v3",
-    api_key=os.environ.get("ARK_API_KEY"),
-)
+client = _LazyClient(_make_ark_client)
+ms_client = _LazyClient(_make_ms_client)
+# ASGI 模式（asgi.py）使用的异步客户端
+async_client = _LazyAsyncClient(functools.partial(_make_ark_client, async_mode=True))
+async_ms_client = _LazyAsyncClient(functools.partial(_make_ms_client, async_mode=True))
 
-ms_client = OpenAI(
-    base_url=os.environ.get("MS_BASE_URL"),
-    api_key=os.environ.get("MS_API_KEY"),
-)
+
+# ===== 上游调用容错：限流、退避重试与熔断 =====
+
+class _UpstreamUnavailable(Exception):
+    """熔断打开或限流等待超时时抛出，调用方应快速失败。"""
+
+
+class _TokenBucket:
+    """令牌桶限流：rate 为每秒补充的令牌数，burst 为桶容量；rate<=0 表示不限流。"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0
+        self.rejected = 0
+
+    def _take(self, deadline: float, waited: bool) -> float | None:
+        """尝试取一个令牌：取到返回 0，需要等待时返回等待秒数，等待会超过 deadline 时返回 None。"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                if waited:
+                    self.waited += 1
+                return 0.0
+            delay = (1 - self._tokens) / self.rate
+            if now + delay > deadline:
+                self.rejected += 1
+                return None
+            return delay
+
+    def acquire(self, timeout: float) -> bool:
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            delay = self._take(deadline, waited)
+            if not delay:
+                return delay is not None
+            waited = True
+            time.sleep(delay)
+
+    async def acquire_async(self, timeout: float) -> bool:
+        """acquire 的协程版本：等待令牌时让出事件循环。"""
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            delay = self._take(deadline, waited)
+            if not delay:
+                return delay is not None
+            waited = True
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'rate_per_sec': self.rate,
+                'burst': self.capacity,
+                'tokens': round(self._tokens, 3),
+                'waited': self.waited,
+                'rejected': self.rejected,
+            }
+
+
+class _CircuitBreaker:
+    """连续失败达到阈值后打开，reset_timeout 后放行一次探测调用（半开），成功则关闭。"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.short_circuited = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._probe_in_flight = False
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def record_neutral(self):
+        """非上游故障（如参数错误、限流）：不计入失败，但结束半开探测。"""
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'closed'
+                self.failures = 0
+            self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'trips': self.trips,
+                'short_circuited': self.short_circuited,
+            }
+
+
+def _upstream_status(exc: Exception) -> int | None:
+    status = getattr(exc, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def _is_rate_limited(exc: Exception) -> bool:
+    return _upstream_status(exc) == 429 or 'RateLimit' in type(exc).__name__ or 'rate limit' in str(exc).lower()
+
+
+def _is_upstream_fault(exc: Exception) -> bool:
+    """5xx、超时与连接错误视为上游故障，计入熔断。"""
+    status = _upstream_status(exc)
+    if status is not None and status >= 500:
+        return True
+    name = type(exc).__name__
+    return 'Timeout' in name or 'Connection' in name
+
+
+def _is_transport_error(exc: Exception) -> bool:
+    """超时或连接错误（没有收到 HTTP 响应）。"""
+    return _upstream_status(exc) is None and _is_upstream_fault(exc)
+
+
+def _never_sent(exc: Exception) -> bool:
+    """连接阶段即失败（httpx ConnectError / ConnectTimeout），请求未发出，重试不会重复计费。"""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if type(exc).__name__ in ('ConnectError', 'ConnectTimeout', 'ConnectionRefusedError'):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def _retry_after(exc: Exception) -> float | None:
+    headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    try:
+        value = headers.get('retry-after') if headers is not None else None
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class _ResilientUpstream:
+    """包装上游调用：令牌桶限流 -> 熔断检查 -> 调用，限流与 5xx 按抖动指数退避重试。
+
+    超时与请求发出后的连接错误计入熔断但默认不重试：生成接口按次计费且不幂等，
+    超时的请求可能已在上游执行。retry_transport 为 True 时才重试这类错误。
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, max_retries: int, base_delay: float,
+                 max_delay: float, failure_threshold: int, reset_timeout: float, limit_wait: float,
+                 retry_transport: bool = False):
+        self.name = name
+        self.label = name.lower()
+        self.limiter = _TokenBucket(rate, burst)
+        self.breaker = _CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limit_wait = limit_wait
+        self.retry_transport = retry_transport
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _start(self):
+        with self._lock:
+            self.calls += 1
+
+    def _check_breaker(self, last_error: Exception | None):
+        if self.breaker.allow():
+            return
+        metrics.inc('upstream_requests_total', upstream=self.label, outcome='short_circuit')
+        # 重试途中熔断打开：抛出真实的上游错误，保留原有错误映射
+        if last_error is not None:
+            with self._lock:
+                self.failures += 1
+            raise last_error
+        raise _UpstreamUnavailable(f'{self.name} 上游服务暂不可用（熔断中），请稍后重试')
+
+    def _rate_limited(self):
+        self.breaker.record_neutral()
+        metrics.inc('upstream_requests_total', upstream=self.label, outcome='rate_limited')
+        return _UpstreamUnavailable(f'{self.name} 请求频率过高（本地限流），请稍后重试')
+
+    def _retry_delay(self, e: Exception, attempt: int) -> float | None:
+        """记录一次失败；应当重试时返回退避秒数，否则返回 None（调用方重新抛出）。"""
+        fault = _is_upstream_fault(e)
+        if fault:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_neutral()
+        retryable = fault or _is_rate_limited(e)
+        if retryable and _is_transport_error(e) and not (self.retry_transport or _never_sent(e)):
+            retryable = False
+        if retryable and attempt < self.max_retries:
+            # 全抖动指数退避；上游给出 Retry-After 时以其为下限
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+            delay = max(delay, min(self.max_delay, _retry_after(e) or 0))
+            with self._lock:
+                self.retries += 1
+            metrics.inc('upstream_requests_total', upstream=self.label, outcome='retry')
+            return delay
+        with self._lock:
+            self.failures += 1
+        metrics.inc('upstream_requests_total', upstream=self.label, outcome='error')
+        return None
+
+    def _succeeded(self):
+        self.breaker.record_success()
+        metrics.inc('upstream_requests_total', upstream=self.label, outcome='ok')
+
+    def call(self, fn, *args, **kwargs):
+        self._start()
+        attempt = 0
+        last_error = None
+        while True:
+            self._check_breaker(last_error)
+            if not self.limiter.acquire(self.limit_wait):
+                raise self._rate_limited()
+            try:
+                with _timed('upstream', self.label):
+                    result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                last_error = e
+                time.sleep(delay)
+                continue
+            self._succeeded()
+            return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """call 的协程版本：fn 为异步 SDK 方法，限流等待与退避均不阻塞事件循环。
+        与同步调用共享同一组限流器、熔断器与计数。"""
+        self._start()
+        attempt = 0
+        last_error = None
+        while True:
+            self._check_breaker(last_error)
+            if not await self.limiter.acquire_async(self.limit_wait):
+                raise self._rate_limited()
+            try:
+                with _timed('upstream', self.label):
+                    result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                last_error = e
+                await asyncio.sleep(delay)
+                continue
+            self._succeeded()
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {'calls': self.calls, 'retries': self.retries, 'failures': self.failures}
+        return {**counters, 'limiter': self.limiter.stats(), 'breaker': self.breaker.stats()}
+
+
+def _resilient_from_env(name: str, prefix: str) -> _ResilientUpstream:
+    env = os.environ.get
+    return _ResilientUpstream(
+        name,
+        rate=float(env(f"{prefix}_RATE_PER_SEC", "0")),
+        burst=int(env(f"{prefix}_RATE_BURST", "5")),
+        max_retries=int(env(f"{prefix}_MAX_RETRIES", "3")),
+        base_delay=float(env(f"{prefix}_RETRY_BASE_DELAY", "0.5")),
+        max_delay=float(env(f"{prefix}_RETRY_MAX_DELAY", "8")),
+        failure_threshold=int(env(f"{prefix}_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(env(f"{prefix}_BREAKER_RESET", "30")),
+        limit_wait=float(env(f"{prefix}_RATE_MAX_WAIT", "30")),
+        retry_transport=env(f"{prefix}_RETRY_TRANSPORT", "0") == "1",
+    )
+
+
+ark_upstream = _resilient_from_env('Ark', 'ARK')
+ms_upstream = _resilient_from_env('ModelScope', 'MS')
 
 DB_HOST = os.environ.get("DB_HOST", "127.0.0.1")
 DB_PORT = int(os.environ.get("DB_PORT", "3306"))
 DB_USER = os.environ.get("DB_USER", "root")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
 DB_NAME = os.environ.get("DB_NAME", "seedream")
+DB_CONNECT_TIMEOUT = float(os.environ.get("DB_CONNECT_TIMEOUT", "5"))
+# 由后台初始化线程在建表与历史导入完成后置为 True，此前历史记录走文件存储
 DB_READY = False
 
 def _db_connect(db: str | None = None):
@@ -45,40 +606,246 @@ def _db_connect(db: str | None = None):
         database=(db or DB_NAME),
         charset="utf8mb4",
         autocommit=True,
+        connect_timeout=DB_CONNECT_TIMEOUT,
     )
 
+# 连接池配置：每个进程独立一个池（gunicorn 多 worker 下 fork 后自动重置）
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get("DB_POOL_IDLE_TIMEOUT", "300"))
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "3600"))
+# 空闲超过该秒数的连接在借出前先 ping 一次做健康检查
+DB_POOL_PING_INTERVAL = float(os.environ.get("DB_POOL_PING_INTERVAL", "30"))
+
+
+class _DBPool:
+    """线程安全的有界 pymysql 连接池，支持健康检查、空闲超时与最长存活时间。"""
+
+    def __init__(self, factory, max_size: int, timeout: float, idle_timeout: float,
+                 max_lifetime: float, ping_interval: float):
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self._cond = threading.Condition()
+        self._reset_state()
+
+    def _reset_state(self):
+        # 空闲连接栈：(conn, created_at, last_used)，后进先出以便多余连接自然空闲过期
+        self._idle: list[tuple] = []
+        self._size = 0
+        self._in_use = 0
+        self.created = 0
+        self.closed = 0
+        self.acquired = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.failed_checks = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def after_fork(self):
+        """子进程中丢弃从父进程继承的连接（不发送 QUIT，避免影响父进程的会话）。"""
+        self._cond = threading.Condition()
+        self._reset_state()
+
+    def _expired(self, created: float, last_used: float, now: float) -> bool:
+        return (now - last_used) > self.idle_timeout or (now - created) > self.max_lifetime
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        start = time.monotonic()
+        entry = None
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    conn, created, last_used = self._idle.pop()
+                    if self._expired(created, last_used, now):
+                        self._size -= 1
+                        self.closed += 1
+                        self._close(conn)
+                        continue
+                    entry = (conn, created, last_used)
+                    break
+                if entry is not None or self._size < self.max_size:
+                    if entry is None:
+                        self._size += 1
+                    self._in_use += 1
+                    break
+                remaining = self.timeout - (now - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise TimeoutError('数据库连接池已满，等待超时')
+                self.waits += 1
+                self._cond.wait(remaining)
+        try:
+            if entry is not None:
+                conn, created, last_used = entry
+                if time.monotonic() - last_used > self.ping_interval:
+                    try:
+                        conn.ping(reconnect=False)
+                    except Exception:
+                        self._close(conn)
+                        entry = None
+                        with self._cond:
+                            self.failed_checks += 1
+                            self.closed += 1
+            if entry is None:
+                conn, created = self.factory(), time.monotonic()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        waited = time.monotonic() - start
+        metrics.observe('db_pool_wait_seconds', waited)
+        with self._cond:
+            if entry is None:
+                self.created += 1
+            self.acquired += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+        return conn, created
+
+    def release(self, conn, created: float, broken: bool = False):
+        now = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if broken or getattr(conn, 'open', True) is False or (now - created) > self.max_lifetime:
+                self._size -= 1
+                self.closed += 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, created, now))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, op: str = 'other'):
+        """借出一个连接；op 为指标中的操作名，耗时含等待连接的时间。"""
+        start = time.perf_counter()
+        conn, created = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(conn, created, broken=broken)
+            _record_timing('db', op, time.perf_counter() - start)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self.closed += len(idle)
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'created': self.created,
+                'closed': self.closed,
+                'acquired': self.acquired,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'failed_health_checks': self.failed_checks,
+                'wait_time_avg_ms': round(self.wait_time_total * 1000 / self.acquired, 3) if self.acquired else 0.0,
+                'wait_time_max_ms': round(self.wait_time_max * 1000, 3),
+            }
+
+
+db_pool = _DBPool(
+    lambda: _db_connect(DB_NAME),
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_IDLE_TIMEOUT,
+    DB_POOL_MAX_LIFETIME,
+    DB_POOL_PING_INTERVAL,
+)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=db_pool.after_fork)
+atexit.register(db_pool.close_all)
+
+# ASGI 模式下阻塞的数据库与历史存储操作放到专用线程池执行：线程数与连接池容量一致，
+# 等待连接的请求在事件循环中排队，不占用其他卸载线程
+_db_executor = None
+_db_executor_pid = None
+_db_executor_lock = threading.Lock()
+
+
+def _get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor, _db_executor_pid
+    with _db_executor_lock:
+        if _db_executor is None or _db_executor_pid != os.getpid():
+            _db_executor = ThreadPoolExecutor(max_workers=max(1, DB_POOL_SIZE), thread_name_prefix='db-offload')
+            _db_executor_pid = os.getpid()
+        return _db_executor
+
+
+async def _run_db(fn, *args, **kwargs):
+    """在事件循环中调用阻塞的数据库 / 历史存储函数。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_db_executor(), functools.partial(fn, *args, **kwargs))
+
+HISTORY_DB_INDEXES = (
+    ('idx_created_id', 'created_at, id'),
+    ('idx_mode_created_id', 'mode, created_at, id'),
+)
+
 def _db_init():
-    global DB_READY
+    """建库建表并补充索引；数据库不可用时抛出异常，由后台初始化线程重试。"""
     try:
         conn = _db_connect(None)
+        conn.close()
     except Exception:
-        try:
-            conn = pymysql.connect(
-                host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, charset="utf8mb4", autocommit=True
-            )
-            with conn.cursor() as cur:
-                cur.execute(f"CREATE DATABASE IF NOT EXISTS `{DB_NAME}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
-            conn.close()
-        except Exception:
-            DB_READY = False
-            return
+        conn = pymysql.connect(
+            host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, charset="utf8mb4", autocommit=True,
+            connect_timeout=DB_CONNECT_TIMEOUT,
+        )
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE DATABASE IF NOT EXISTS `{DB_NAME}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+        conn.close()
     conn = _db_connect(DB_NAME)
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS history_items (
-                id VARCHAR(64) PRIMARY KEY,
-                mode VARCHAR(32),
-                prompt TEXT,
-                source_image_url TEXT,
-                image_url TEXT,
-                size VARCHAR(16),
-                watermark TINYINT(1),
-                created_at DATETIME
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS history_items (
+                    id VARCHAR(64) PRIMARY KEY,
+                    mode VARCHAR(32),
+                    prompt TEXT,
+                    source_image_url TEXT,
+                    image_url TEXT,
+                    size VARCHAR(16),
+                    watermark TINYINT(1),
+                    created_at DATETIME
+                )
+                """
             )
-            """
-        )
-    DB_READY = True
+            # 结构迁移：为历史分页查询补充二级索引（按 created_at, id 倒序键集分页）
+            cur.execute("SHOW INDEX FROM history_items")
+            existing = {row[2] for row in cur.fetchall()}
+            for name, cols in HISTORY_DB_INDEXES:
+                if name not in existing:
+                    cur.execute(f"ALTER TABLE history_items ADD INDEX `{name}` ({cols})")
+    finally:
+        conn.close()
 
 def _dt_mysql(ts: str | None) -> str:
     if not ts:
@@ -86,12 +853,16 @@ def _dt_mysql(ts: str | None) -> str:
     return str(ts).replace("T", " ")[:19]
 
 # 历史记录存储配置
-HISTORY_DIR = os.path.join(app.root_path, 'data')
+HISTORY_DIR = os.environ.get("HISTORY_DIR", os.path.join(app.root_path, 'data'))
 HISTORY_FILE = os.path.join(HISTORY_DIR, 'history.json')
+HISTORY_LOG_FILE = os.path.join(HISTORY_DIR, 'history.jsonl')
+HISTORY_LOCK_FILE = os.path.join(HISTORY_DIR, 'history.lock')
 MAX_HISTORY = 500
+# 日志中失效记录（被删除/被裁剪）超过该数量且多于有效记录时触发压缩
+HISTORY_COMPACT_MIN_GARBAGE = int(os.environ.get("HISTORY_COMPACT_MIN_GARBAGE", "200"))
 
 # 上传文件配置
-UPLOAD_DIR = os.path.join(app.root_path, 'uploads')
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join(app.root_path, 'uploads'))
 ALLOWED_EXTS = {'jpg','jpeg','png','webp'}
 
 def _ensure_upload_dir():
@@ -105,201 +876,2301 @@ _ensure_upload_dir()
 def _ensure_history_store():
     try:
         os.makedirs(HISTORY_DIR, exist_ok=True)
-        if not os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump([], f, ensure_ascii=False)
     except Exception:
         # 存储目录不可用时忽略，不影响主流程
         pass
 
 _ensure_history_store()
 
-_db_init()
 
-def _migrate_file_history_to_db():
-    if not DB_READY:
-        return
-    try:
-        items = _load_history()
-        if not items:
+@contextmanager
+def _flock(lock_path: str, thread_lock):
+    """进程内锁 + 跨进程文件锁（gunicorn 多 worker 共享同一数据目录）。"""
+    with thread_lock:
+        if fcntl is None:
+            yield
             return
-        conn = _db_connect(DB_NAME)
-        with conn.cursor() as cur:
-            for it in items:
-                cur.execute(
-                    """
-                    INSERT IGNORE INTO history_items (id, mode, prompt, source_image_url, image_url, size, watermark, created_at)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                    """,
-                    (
-                        it.get("id"),
-                        it.get("mode"),
-                        it.get("prompt"),
-                        it.get("source_image_url"),
-                        it.get("image_url"),
-                        it.get("size"),
-                        1 if it.get("watermark") else 0,
-                        _dt_mysql(it.get("created_at")),
-                    ),
-                )
-    except Exception:
-        pass
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+class _JsonlHistoryStore:
+    """数据库不可用时的文件历史存储。
+
+    以追加写的 JSONL 日志记录新增（add）与删除墓碑（del），进程内维护按 id
+    与 created_at 的索引；多进程间通过文件锁串行化写入，读取时只增量解析
+    其他进程新追加的行。失效记录累积到阈值后重写日志并原子替换。
+    首次使用时自动从旧的 history.json 迁移。
+    """
+
+    def __init__(self, path: str, legacy_path: str, lock_path: str, max_items: int,
+                 compact_min_garbage: int = 200):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.lock_path = lock_path
+        self.max_items = max_items
+        self.compact_min_garbage = compact_min_garbage
+        self.compactions = 0
+        self._lock = threading.RLock()
+        self._prepared = False
+        self._reset_index()
+
+    def _reset_index(self):
+        self._items: dict[str, dict] = {}
+        self._order: list[tuple[str, str]] = []
+        self._by_mode: dict[str, list[tuple[str, str]]] = {}
+        self._offset = 0
+        self._ino = None
+        self._lines = 0
+
+    def _file_lock(self):
+        return _flock(self.lock_path, self._lock)
+
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        return (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+    def _prepare(self):
+        """确保日志文件存在；不存在时从旧版 history.json 迁移（需持有文件锁）。"""
+        if self._prepared:
+            return
+        if not os.path.exists(self.path):
+            legacy = []
+            try:
+                with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                    legacy = json.load(f) or []
+            except Exception:
+                legacy = []
+            self._write_log([it for it in legacy if isinstance(it, dict)][-self.max_items:])
+        self._prepared = True
+
+    def _write_log(self, items):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            for item in items:
+                f.write(self._encode({'op': 'add', 'item': item}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _index_add(self, item: dict):
+        item_id = item.get('id')
+        old = self._items.get(item_id)
+        if old is not None and (old.get('created_at'), old.get('mode')) == (item.get('created_at'), item.get('mode')):
+            # 仅改写字段：保持原有写入顺序与排序索引
+            self._items[item_id] = item
+            return
+        if old is not None:
+            self._index_remove(item_id)
+        self._items[item_id] = item
+        key = (item.get('created_at') or '', item_id)
+        bisect.insort(self._order, key)
+        bisect.insort(self._by_mode.setdefault(item.get('mode') or '', []), key)
+        while len(self._items) > self.max_items:
+            self._index_remove(next(iter(self._items)))
+
+    def _index_remove(self, item_id) -> bool:
+        item = self._items.pop(item_id, None)
+        if item is None:
+            return False
+        key = (item.get('created_at') or '', item_id)
+        for order in (self._order, self._by_mode.get(item.get('mode') or '', [])):
+            pos = bisect.bisect_left(order, key)
+            if pos < len(order) and order[pos] == key:
+                del order[pos]
+        return True
+
+    def _sync(self):
+        """增量读取日志尾部；日志被压缩替换（inode 变化）时重建索引。"""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            self._reset_index()
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self._ino or st.st_size < self._offset:
+                self._reset_index()
+                self._ino = st.st_ino
+            if st.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            chunk = f.read(st.st_size - self._offset)
+        # 只消费完整的行，写到一半的行留待下次读取
+        end = chunk.rfind(b'\n')
+        if end < 0:
+            return
+        for line in chunk[:end + 1].splitlines():
+            if not line.strip():
+                continue
+            self._lines += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('op') == 'add' and isinstance(record.get('item'), dict):
+                self._index_add(record['item'])
+            elif record.get('op') == 'del':
+                self._index_remove(record.get('id'))
+        self._offset += end + 1
+
+    def _append(self, record: dict):
+        with open(self.path, 'ab') as f:
+            f.write(self._encode(record))
+        self._sync()
+        if self._lines - len(self._items) >= max(self.compact_min_garbage, len(self._items)):
+            self._compact()
+
+    def _compact(self):
+        self._write_log(list(self._items.values()))
+        st = os.stat(self.path)
+        self._ino = st.st_ino
+        self._offset = st.st_size
+        self._lines = len(self._items)
+        self.compactions += 1
+
+    def add(self, entry: dict) -> dict:
+        with self._file_lock():
+            self._prepare()
+            self._sync()
+            self._append({'op': 'add', 'item': entry})
+        return entry
+
+    def update(self, item_id, fields: dict, expect: dict | None = None) -> bool:
+        """改写已有记录的字段；记录不存在或当前值与 expect 不符时返回 False。"""
+        with self._file_lock():
+            self._prepare()
+            self._sync()
+            item = self._items.get(item_id)
+            if item is None or any(item.get(k) != v for k, v in (expect or {}).items()):
+                return False
+            self._append({'op': 'add', 'item': {**item, **fields}})
+        return True
+
+    def delete(self, item_id) -> bool:
+        with self._file_lock():
+            self._prepare()
+            self._sync()
+            if item_id not in self._items:
+                return False
+            self._append({'op': 'del', 'id': item_id})
+        return True
+
+    def compact(self):
+        with self._file_lock():
+            self._prepare()
+            self._sync()
+            self._compact()
+
+    def _refresh(self):
+        if not self._prepared:
+            with self._file_lock():
+                self._prepare()
+        # 读取无需文件锁：仅解析完整行，压缩通过原子替换完成
+        self._sync()
+
+    def get(self, item_id) -> dict | None:
+        with self._lock:
+            self._refresh()
+            return self._items.get(item_id)
+
+    def items(self) -> list[dict]:
+        """按写入顺序返回全部记录。"""
+        with self._lock:
+            self._refresh()
+            return list(self._items.values())
+
+    def page(self, limit: int, cursor: tuple[str, str] | None = None,
+             mode: str | None = None) -> tuple[list[dict], tuple[str, str] | None]:
+        """按 (created_at, id) 倒序做键集分页，返回本页记录与下一页游标。"""
+        with self._lock:
+            self._refresh()
+            order = self._order if mode is None else self._by_mode.get(mode, [])
+            end = bisect.bisect_left(order, cursor) if cursor else len(order)
+            start = max(0, end - limit)
+            keys = order[start:end]
+            items = [self._items[item_id] for _, item_id in reversed(keys)]
+            next_cursor = keys[0] if (start > 0 and keys) else None
+            return items, next_cursor
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'log_lines': self._lines,
+                'log_bytes': self._offset,
+                'compactions': self.compactions,
+            }
+
+
+history_store = _JsonlHistoryStore(
+    HISTORY_LOG_FILE,
+    HISTORY_FILE,
+    HISTORY_LOCK_FILE,
+    MAX_HISTORY,
+    HISTORY_COMPACT_MIN_GARBAGE,
+)
 
-_migrate_file_history_to_db()
 
 def _load_history():
     try:
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f) or []
+        return history_store.items()
     except Exception:
         return []
 
-def _save_history(items):
+_HISTORY_INSERT_COLUMNS = "(id, mode, prompt, source_image_url, image_url, size, watermark, created_at) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)"
+
+
+def _history_db_params(entry: dict) -> tuple:
+    return (
+        entry.get("id"),
+        entry.get("mode"),
+        entry.get("prompt"),
+        entry.get("source_image_url"),
+        entry.get("image_url"),
+        entry.get("size"),
+        1 if entry.get("watermark") else 0,
+        _dt_mysql(entry.get("created_at")),
+    )
+
+
+def _insert_history_rows(entries: list[dict], ignore_duplicates: bool = False):
+    """单次 executemany 批量写入历史记录。"""
+    if not entries:
+        return
+    verb = "INSERT IGNORE" if ignore_duplicates else "INSERT"
+    with db_pool.connection('history_insert') as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                f"{verb} INTO history_items {_HISTORY_INSERT_COLUMNS}",
+                [_history_db_params(e) for e in entries],
+            )
+
+
+# ===== 数据库后台初始化与文件历史导入 =====
+# worker 启动时不连接数据库：由后台线程建表并导入文件历史，任一步失败都按指数退避重试，两步都成功后置 DB_READY
+DB_INIT_RETRY_MAX_DELAY = float(os.environ.get("DB_INIT_RETRY_MAX_DELAY", "60"))
+HISTORY_MIGRATE_BATCH = int(os.environ.get("HISTORY_MIGRATE_BATCH", "500"))
+HISTORY_MIGRATION_MARKER = os.path.join(HISTORY_DIR, 'history.migrated')
+HISTORY_MIGRATION_LOCK = os.path.join(HISTORY_DIR, 'history.migrate.lock')
+_history_migration_lock = threading.Lock()
+
+
+def _history_log_fingerprint() -> str | None:
     try:
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(items, f, ensure_ascii=False)
-    except Exception:
-        pass
+        st = os.stat(HISTORY_LOG_FILE)
+    except OSError:
+        return None
+    return f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
 
-def _add_history_entry(entry):
-    if DB_READY:
-        try:
-            conn = _db_connect(DB_NAME)
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO history_items (id, mode, prompt, source_image_url, image_url, size, watermark, created_at)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                    """,
-                    (
-                        entry.get("id"),
-                        entry.get("mode"),
-                        entry.get("prompt"),
-                        entry.get("source_image_url"),
-                        entry.get("image_url"),
-                        entry.get("size"),
-                        1 if entry.get("watermark") else 0,
-                        _dt_mysql(entry.get("created_at")),
-                    ),
-                )
-            return entry
-        except Exception:
-            pass
-    items = _load_history()
-    items.append(entry)
-    if len(items) > MAX_HISTORY:
-        items = items[-MAX_HISTORY:]
-    _save_history(items)
-    return entry
 
-def _delete_history_entry(item_id):
-    if DB_READY:
+def _migrate_file_history_to_db() -> int:
+    """把文件历史按批 executemany 导入数据库（INSERT IGNORE，可重复执行），返回导入条数。
+
+    共享同一数据目录的所有 worker 通过文件锁串行执行，导入后记录日志文件指纹；
+    日志未变化时直接跳过，不再在每个 worker 启动时重复导入。
+    """
+    with _flock(HISTORY_MIGRATION_LOCK, _history_migration_lock):
+        fingerprint = _history_log_fingerprint()
+        if fingerprint is None and not os.path.exists(HISTORY_FILE):
+            return 0
         try:
-            conn = _db_connect(DB_NAME)
-            with conn.cursor() as cur:
-                cur.execute("DELETE FROM history_items WHERE id=%s", (item_id,))
-            return True
-        except Exception:
+            with open(HISTORY_MIGRATION_MARKER, 'r', encoding='ascii') as f:
+                if fingerprint is not None and f.read().strip() == fingerprint:
+                    return 0
+        except OSError:
             pass
-    items = _load_history()
-    new_items = [item for item in items if item.get('id') != item_id]
-    if len(new_items) != len(items):
-        _save_history(new_items)
-        return True
-    return False
+        items = _load_history()
+        if fingerprint is None:
+            # 仅有旧版 history.json 时，读取过程中已转换为 JSONL 日志
+            fingerprint = _history_log_fingerprint()
+        for start in range(0, len(items), HISTORY_MIGRATE_BATCH):
+            _insert_history_rows(items[start:start + HISTORY_MIGRATE_BATCH], ignore_duplicates=True)
+        if fingerprint is not None:
+            tmp = f"{HISTORY_MIGRATION_MARKER}.{os.getpid()}.tmp"
+            with open(tmp, 'w', encoding='ascii') as f:
+                f.write(fingerprint)
+            os.replace(tmp, HISTORY_MIGRATION_MARKER)
+        return len(items)
 
 
-def safe_generate_image(prompt, **kwargs):
-    """安全的图片生成函数，包含完整错误处理"""
-    try:
-        images_response = client.images.generate(
-            model="doubao-seedream-4-0-250828",
-            prompt=prompt,
-            **kwargs
-        )
+class _DBBootstrap:
+    """后台数据库初始化：重试直至建表与导入文件历史都成功后置 DB_READY。
+
+    每个进程各自一个线程；fork 出的子进程在首个请求时重新拉起（父进程已就绪则无需再拉起）。
+    """
+
+    def __init__(self, max_delay: float):
+        self.max_delay = max(1.0, max_delay)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.attempts = 0
+        self.migrated = 0
+        self.last_error = None
+        self.started_at = None
+        self.ready_after = None
+        # 置 DB_READY 之后的补导也已完成；此前上传回收保持关闭
+        self.caught_up = False
+
+    def start(self):
+        if DB_READY:
+            return
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name='db-bootstrap', daemon=True)
+            self._thread.start()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _retry(self, fn):
+        """按指数退避（带抖动）重试 fn 直至成功，返回其结果。"""
+        delay = 1.0
+        while True:
+            self.attempts += 1
+            try:
+                return fn()
+            except Exception as e:
+                self.last_error = str(e)
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(self.max_delay, delay * 2)
+
+    def _run(self):
+        global DB_READY
+        self._retry(_db_init)
+        # 导入成功前保持 DB_READY 为 False：读取仍走文件存储，上传回收也不会把尚未导入的记录当作无引用
+        self.migrated += self._retry(_migrate_file_history_to_db)
+        DB_READY = True
+        self.ready_after = time.monotonic() - self.started_at
+        # 导入期间仍写入文件的记录补导一次（日志未变化时立即返回）
+        self.migrated += self._retry(_migrate_file_history_to_db)
+        self.caught_up = True
+
+    def stats(self) -> dict:
         return {
-            'success': True,
-            'image_url': images_response.data[0].url
+            'ready': DB_READY,
+            'caught_up': self.caught_up,
+            'attempts': self.attempts,
+            'migrated_items': self.migrated,
+            'ready_after_s': round(self.ready_after, 3) if self.ready_after is not None else None,
+            'last_error': self.last_error,
         }
-    except Exception as e:
-        error_msg = str(e)
-        if "API key" in error_msg:
-            return {'success': False, 'error': 'API密钥配置错误'}
-        elif "quota" in error_msg.lower():
-            return {'success': False, 'error': 'API配额不足'}
-        elif "rate limit" in error_msg.lower():
-            return {'success': False, 'error': '请求频率过高，请稍后重试'}
-        elif "OversizeImage" in error_msg or "oversize" in error_msg.lower():
-            return {'success': False, 'error': '参考图过大（超过10MB）。请更换更小图片，或使用本地上传以自动压缩'}
-        else:
-            return {'success': False, 'error': f'生成失败: {error_msg}'}
 
 
-# ===== 批量图片质量评估与优选 =====
+db_bootstrap = _DBBootstrap(DB_INIT_RETRY_MAX_DELAY)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=db_bootstrap.after_fork)
+if not _SPAWNED_CHILD:
+    db_bootstrap.start()
+
+
+@app.before_request
+def _ensure_db_bootstrap():
+    db_bootstrap.start()
+
+# 历史写入的 write-behind 模式：生成接口只入队，由后台线程按批量/时间触发批量写库
+HISTORY_WRITE_BEHIND = os.environ.get("HISTORY_WRITE_BEHIND", "0") == "1"
+HISTORY_QUEUE_SIZE = int(os.environ.get("HISTORY_QUEUE_SIZE", "1000"))
+HISTORY_BATCH_SIZE = int(os.environ.get("HISTORY_BATCH_SIZE", "50"))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "0.5"))
+
+
+class _HistoryWriteBehind:
+    """有界内存队列 + 后台批量刷写线程；写库失败的批次回退到文件存储。"""
+
+    def __init__(self, max_queue: int, batch_size: int, interval: float):
+        self.max_queue = max_queue
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._queue: queue.Queue = queue.Queue(maxsize=self.max_queue)
+        self._pending = 0
+        # 尚未写出的记录（id -> entry）、正在写出的记录 id 与写出后待执行的地址改写
+        self._queued: dict = {}
+        self._writing: set = set()
+        self._deferred: dict = {}
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.flush_time_total = 0.0
+        self.flush_time_last = 0.0
+        self.flush_time_max = 0.0
+
+    def _ensure_thread(self):
+        # 线程不随 fork 复制，每个 worker 进程首次入队时各自启动
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            if self._pid is not None and self._pid != os.getpid():
+                self._cond = threading.Condition()
+                self._reset_state()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='history-write-behind', daemon=True)
+            self._thread.start()
+
+    def submit(self, entry: dict) -> bool:
+        """入队成功返回 True；队列已满或正在关闭时返回 False，由调用方同步写入。"""
+        self._ensure_thread()
+        with self._cond:
+            if self._stopping:
+                return False
+            try:
+                self._queue.put_nowait(entry)
+            except queue.Full:
+                self.rejected += 1
+                return False
+            self._queued[entry['id']] = entry
+            self._pending += 1
+            self.enqueued += 1
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                if self._stopping:
+                    return
+                continue
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            if self._stopping and self._queue.empty():
+                return
+
+    def amend(self, item_id, old_url: str, new_url: str) -> bool | None:
+        """改写尚未落库记录的结果图地址：仍在队列中时直接修改待写入的记录，
+        正在写出时登记为写出后再更新。记录不在写入队列中时返回 None，由调用方直接更新。"""
+        with self._cond:
+            if self._pid != os.getpid():
+                return None
+            entry = self._queued.get(item_id)
+            if entry is not None:
+                if entry.get('image_url') != old_url:
+                    return False
+                entry['image_url'] = new_url
+                return True
+            if item_id in self._writing:
+                self._deferred[item_id] = (old_url, new_url)
+                return True
+        return None
+
+    def _write(self, batch: list[dict]):
+        with self._cond:
+            for entry in batch:
+                self._queued.pop(entry['id'], None)
+                self._writing.add(entry['id'])
+        start = time.monotonic()
+        failed = False
+        try:
+            _insert_history_rows(batch, ignore_duplicates=True)
+        except Exception:
+            failed = True
+            for entry in batch:
+                try:
+                    history_store.add(entry)
+                except Exception:
+                    pass
+        elapsed = time.monotonic() - start
+        with self._cond:
+            self._pending -= len(batch)
+            self.batches += 1
+            self.flushed += len(batch)
+            if failed:
+                self.failed_batches += 1
+            self.flush_time_total += elapsed
+            self.flush_time_last = elapsed
+            self.flush_time_max = max(self.flush_time_max, elapsed)
+            deferred = []
+            for entry in batch:
+                self._writing.discard(entry['id'])
+                if entry['id'] in self._deferred:
+                    deferred.append((entry['id'], *self._deferred.pop(entry['id'])))
+            self._cond.notify_all()
+        for item_id, old_url, new_url in deferred:
+            _update_history_image_url(item_id, old_url, new_url)
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """等待已入队的记录全部写出，超时返回 False。"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._thread is None or self._pid != os.getpid():
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def shutdown(self, timeout: float = 10.0):
+        """进程退出时停止接收新记录并写出队列中剩余的记录。"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        with self._cond:
+            self._stopping = True
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'enabled': HISTORY_WRITE_BEHIND,
+                'queue_depth': self._pending,
+                'max_queue': self.max_queue,
+                'enqueued': self.enqueued,
+                'rejected': self.rejected,
+                'flushed': self.flushed,
+                'batches': self.batches,
+                'failed_batches': self.failed_batches,
+                'flush_latency_last_ms': round(self.flush_time_last * 1000, 3),
+                'flush_latency_avg_ms': round(self.flush_time_total * 1000 / self.batches, 3) if self.batches else 0.0,
+                'flush_latency_max_ms': round(self.flush_time_max * 1000, 3),
+            }
+
+
+history_writer = _HistoryWriteBehind(HISTORY_QUEUE_SIZE, HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL)
+atexit.register(history_writer.shutdown)
+
+
+def _add_history_entry(entry):
+    if DB_READY:
+        if HISTORY_WRITE_BEHIND and history_writer.submit(entry):
+            return entry
+        try:
+            _insert_history_rows([entry])
+            return entry
+        except Exception:
+            pass
+    try:
+        history_store.add(entry)
+    except Exception:
+        # 存储不可用时忽略，不影响主流程
+        pass
+    return entry
+
+def _add_history_entries(entries: list[dict]):
+    """批量写入历史记录：数据库可用时一次 executemany，失败则逐条回退到文件存储。"""
+    if not entries:
+        return
+    if DB_READY:
+        if HISTORY_WRITE_BEHIND:
+            rest = [e for e in entries if not history_writer.submit(e)]
+            if not rest:
+                return
+            entries = rest
+        try:
+            _insert_history_rows(entries)
+            return
+        except Exception:
+            pass
+    for entry in entries:
+        try:
+            history_store.add(entry)
+        except Exception:
+            pass
+
+def _get_history_entry(item_id) -> dict | None:
+    if DB_READY:
+        try:
+            with db_pool.connection('history_get') as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT id, mode, prompt, source_image_url, image_url, size, watermark, created_at FROM history_items WHERE id=%s",
+                        (item_id,),
+                    )
+                    row = cur.fetchone()
+            return _history_row_to_item(row) if row else None
+        except Exception:
+            pass
+    return history_store.get(item_id)
+
+def _history_referenced(urls: list[str]) -> set[str]:
+    """返回 urls 中仍被历史记录引用（作为参考图或结果图）的地址。"""
+    urls = list(dict.fromkeys(u for u in urls if u))
+    if not urls:
+        return set()
+    if DB_READY:
+        found = set()
+        try:
+            with db_pool.connection('history_references') as conn:
+                with conn.cursor() as cur:
+                    for i in range(0, len(urls), 200):
+                        chunk = urls[i:i + 200]
+                        marks = ','.join(['%s'] * len(chunk))
+                        cur.execute(
+                            f"SELECT source_image_url, image_url FROM history_items "
+                            f"WHERE source_image_url IN ({marks}) OR image_url IN ({marks})",
+                            chunk + chunk,
+                        )
+                        for row in cur.fetchall():
+                            found.update(row)
+        except Exception:
+            # 无法确认时按“仍被引用”处理，避免误删
+            return set(urls)
+        return found & set(urls)
+    wanted = set(urls)
+    found = set()
+    for it in history_store.items():
+        found.update(u for u in (it.get('source_image_url'), it.get('image_url')) if u in wanted)
+    return found
+
+
+def _history_references(urls: list[str]) -> bool:
+    """是否仍有历史记录引用这些地址（作为参考图或结果图）。"""
+    return bool(_history_referenced(urls))
+
+def _update_history_image_url(item_id, old_url: str, new_url: str) -> bool:
+    """把历史记录的结果图地址由 old_url 改写为 new_url；记录已删除或已被改写时不做修改。"""
+    if DB_READY:
+        if HISTORY_WRITE_BEHIND:
+            # 记录仍在写入队列中时由写入线程负责，无需等待刷写
+            amended = history_writer.amend(item_id, old_url, new_url)
+            if amended is not None:
+                return amended
+        try:
+            with db_pool.connection('history_update') as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE history_items SET image_url=%s WHERE id=%s AND image_url=%s",
+                        (new_url, item_id, old_url),
+                    )
+                    if cur.rowcount:
+                        return True
+        except Exception:
+            pass
+    try:
+        return history_store.update(item_id, {'image_url': new_url}, expect={'image_url': old_url})
+    except Exception:
+        return False
+
+def _delete_history_entry(item_id):
+    if DB_READY:
+        if HISTORY_WRITE_BEHIND:
+            # 待删除的记录可能仍在写入队列中，先刷写再删除
+            history_writer.flush()
+    entry = _get_history_entry(item_id)
+    deleted = False
+    if DB_READY:
+        try:
+            with db_pool.connection('history_delete') as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM history_items WHERE id=%s", (item_id,))
+            deleted = True
+        except Exception:
+            pass
+    if not deleted:
+        deleted = history_store.delete(item_id)
+    if deleted and entry:
+        # 释放不再被任何历史记录引用的上传文件
+        try:
+            upload_store.release(entry.get('source_image_url'))
+        except Exception:
+            pass
+    return deleted
+
+
+GENERATE_MODEL = "doubao-seedream-4-0-250828"
+# 生成结果缓存：默认关闭（TTL=0），开启后相同请求在 TTL 内直接复用上次的成功结果
+GENERATE_CACHE_TTL = float(os.environ.get("GENERATE_CACHE_TTL", "0"))
+GENERATE_CACHE_MAX_ENTRIES = int(os.environ.get("GENERATE_CACHE_MAX_ENTRIES", "256"))
+
+
+def _generate_error_result(e: Exception) -> dict:
+    """把生成调用的异常映射为面向用户的错误信息"""
+    if isinstance(e, _UpstreamUnavailable):
+        return {'success': False, 'error': str(e)}
+    error_msg = str(e)
+    if "API key" in error_msg:
+        return {'success': False, 'error': 'API密钥配置错误'}
+    elif "quota" in error_msg.lower():
+        return {'success': False, 'error': 'API配额不足'}
+    elif "rate limit" in error_msg.lower():
+        return {'success': False, 'error': '请求频率过高，请稍后重试'}
+    elif "OversizeImage" in error_msg or "oversize" in error_msg.lower():
+        return {'success': False, 'error': '参考图过大（超过10MB）。请更换更小图片，或使用本地上传以自动压缩'}
+    else:
+        return {'success': False, 'error': f'生成失败: {error_msg}'}
+
+
+def _safe_generate_image_uncached(prompt, **kwargs):
+    """安全的图片生成函数，包含完整错误处理"""
+    try:
+        images_response = ark_upstream.call(
+            client.images.generate,
+            model=GENERATE_MODEL,
+            prompt=prompt,
+            **kwargs
+        )
+        return {
+            'success': True,
+            'image_url': images_response.data[0].url
+        }
+    except Exception as e:
+        return _generate_error_result(e)
+
+
+async def _safe_generate_image_uncached_async(prompt, **kwargs):
+    """_safe_generate_image_uncached 的协程版本，使用异步 Ark 客户端"""
+    try:
+        images_response = await ark_upstream.call_async(
+            async_client.images.generate,
+            model=GENERATE_MODEL,
+            prompt=prompt,
+            **kwargs
+        )
+        return {
+            'success': True,
+            'image_url': images_response.data[0].url
+        }
+    except Exception as e:
+        return _generate_error_result(e)
+
+
+class _SingleFlight:
+    """相同键的并发调用只执行一次，其余调用等待并共享同一结果。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, dict] = {}
+        self._async_calls: dict[str, asyncio.Task] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call['event'].wait()
+        else:
+            try:
+                call['result'] = fn()
+            except BaseException as e:
+                call['error'] = e
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call['event'].set()
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+    async def do_async(self, key: str, fn):
+        """do 的协程版本：fn 为无参协程函数，同一事件循环内的并发调用共享同一次执行。
+        调用在独立的任务中运行，发起者与跟随者都只是等待它：任一客户端断开导致的取消
+        只影响该调用者本身，不会中断共享的生成、也不会把取消传给其他等待者。"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._async_calls.get(key)
+            if task is None or task.get_loop() is not loop:
+                task = loop.create_task(fn())
+                self._async_calls[key] = task
+                task.add_done_callback(functools.partial(self._async_done, key))
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _async_done(self, key: str, task: asyncio.Task):
+        with self._lock:
+            if self._async_calls.get(key) is task:
+                del self._async_calls[key]
+        if not task.cancelled():
+            # 等待者都已离开时避免 “exception was never retrieved” 告警
+            task.exception()
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = len(self._calls) + len(self._async_calls)
+            return {'in_flight': in_flight, 'executed': self.executed, 'coalesced': self.coalesced}
+
+
+class _TTLCache:
+    """带 TTL 的 LRU 结果缓存。"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._data: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'ttl': self.ttl,
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+generate_flight = _SingleFlight()
+generate_cache = _TTLCache(GENERATE_CACHE_TTL, GENERATE_CACHE_MAX_ENTRIES)
+
+
+def _generate_request_key(prompt, kwargs: dict) -> str:
+    """规范化生成请求：折叠提示词空白、统一尺寸大小写与水印布尔值，参考图按内容哈希。"""
+    image = kwargs.get('image') or ''
+    if len(image) > 256:
+        image = hashlib.sha256(image.encode('utf-8')).hexdigest()
+    normalized = {
+        'model': GENERATE_MODEL,
+        'prompt': ' '.join(str(prompt or '').split()),
+        'size': str(kwargs.get('size') or '').strip().upper(),
+        'watermark': bool(kwargs.get('watermark')),
+        'response_format': kwargs.get('response_format') or '',
+        'image': image,
+        'extra': {k: v for k, v in sorted(kwargs.items())
+                  if k not in ('image', 'size', 'watermark', 'response_format')},
+    }
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def safe_generate_image(prompt, bypass_cache=False, **kwargs):
+    """带请求合并与结果缓存的生成入口。
+
+    相同的 (prompt, size, watermark, image) 并发请求只调用一次上游；
+    开启 GENERATE_CACHE_TTL 后，成功结果在 TTL 内直接复用。
+    bypass_cache=True 时跳过合并与缓存，强制重新生成。
+    """
+    if bypass_cache:
+        return _safe_generate_image_uncached(prompt, **kwargs)
+    key = _generate_request_key(prompt, kwargs)
+    if generate_cache.enabled:
+        cached = generate_cache.get(key)
+        if cached is not None:
+            return dict(cached)
+
+    def call():
+        result = _safe_generate_image_uncached(prompt, **kwargs)
+        if result.get('success') and generate_cache.enabled:
+            generate_cache.put(key, dict(result))
+        return result
+
+    return dict(generate_flight.do(key, call))
+
+
+async def safe_generate_image_async(prompt, bypass_cache=False, **kwargs):
+    """safe_generate_image 的协程版本，与同步路径共用结果缓存与请求键。"""
+    if bypass_cache:
+        return await _safe_generate_image_uncached_async(prompt, **kwargs)
+    key = _generate_request_key(prompt, kwargs)
+    if generate_cache.enabled:
+        cached = generate_cache.get(key)
+        if cached is not None:
+            return dict(cached)
+
+    async def call():
+        result = await _safe_generate_image_uncached_async(prompt, **kwargs)
+        if result.get('success') and generate_cache.enabled:
+            generate_cache.put(key, dict(result))
+        return result
+
+    return dict(await generate_flight.do_async(key, call))
+
+
+# ===== 批量图片质量评估与优选 =====
+
+# 评分进程池：解码、缩略与评分均为 CPU 密集型，放到多进程并行执行
+SCORE_WORKERS = int(os.environ.get("SCORE_WORKERS", str(os.cpu_count() or 1)))
+# 单个请求最多同时占用的评分任务数，0 表示不限制
+SCORE_MAX_CONCURRENCY = int(os.environ.get("SCORE_MAX_CONCURRENCY", "0"))
+# 流式优选：以降采样解码评分、逐窗读取上传文件，峰值内存不随批量增长
+SELECT_STREAMING = os.environ.get("SELECT_STREAMING", "0") == "1"
+# 评分子进程的启动方式（spawn / forkserver）。不用 fork：父进程已有数据库初始化、上传回收、
+# 历史写入等后台线程，fork 出的子进程会继承这些线程当时持有的锁
+SCORE_START_METHOD = os.environ.get("SCORE_START_METHOD", "spawn")
+
+_score_pool = None
+_score_pool_pid = None
+_score_pool_lock = threading.Lock()
+
+
+def _get_score_pool():
+    """懒加载评分进程池（每个 gunicorn worker 各自持有一个，fork 后按 pid 重建）。"""
+    global _score_pool, _score_pool_pid
+    if SCORE_WORKERS <= 1:
+        return None
+    with _score_pool_lock:
+        if _score_pool is None or _score_pool_pid != os.getpid():
+            _score_pool = ProcessPoolExecutor(max_workers=SCORE_WORKERS,
+                                              mp_context=multiprocessing.get_context(SCORE_START_METHOD))
+            _score_pool_pid = os.getpid()
+        return _score_pool
+
+
+def _score_pool_after_fork():
+    # 父进程的进程池及其管理线程不属于子进程，直接丢弃，首次使用时重建
+    global _score_pool, _score_pool_lock
+    _score_pool = None
+    _score_pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_score_pool_after_fork)
+
+
+def _reset_score_pool():
+    global _score_pool
+    with _score_pool_lock:
+        pool, _score_pool = _score_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _pool_map(fn, blobs: list[bytes], concurrency: int = 0) -> list:
+    """在评分进程池中按输入顺序执行 fn(blob)；concurrency>0 时限制同时在途的任务数。"""
+    pool = _get_score_pool()
+    if pool is None or len(blobs) <= 1:
+        return [fn(b) for b in blobs]
+    window = concurrency if concurrency > 0 else len(blobs)
+    results = []
+    try:
+        for start in range(0, len(blobs), window):
+            results.extend(pool.map(fn, blobs[start:start + window]))
+    except BrokenProcessPool:
+        # 子进程异常退出时重建进程池，本次请求回退为串行执行
+        _reset_score_pool()
+        results.extend(fn(b) for b in blobs[len(results):])
+    return results
+
+
+def _score_many(blobs: list[bytes], concurrency: int = 0, reduced: bool = False) -> list[float | None]:
+    """并行评分，结果按输入顺序返回；concurrency>0 时限制同时在途的任务数。"""
+    timed = _pool_map(functools.partial(_score_image_bytes_timed, reduced), blobs, concurrency)
+    results: list[float | None] = []
+    for score, seconds in timed:
+        _record_timing('image', 'quality_score', seconds)
+        results.append(score)
+    return results
+
+
+# ===== 图片评分缓存 =====
+# 评分算法调整时递增版本号，使旧缓存自然失效
+SCORE_ALGO_VERSION = "1"
+SCORE_CACHE_MAX_ENTRIES = int(os.environ.get("SCORE_CACHE_MAX_ENTRIES", "20000"))
+SCORE_CACHE_MAX_BYTES = int(os.environ.get("SCORE_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+SCORE_CACHE_PERSIST = os.environ.get("SCORE_CACHE_PERSIST", "0") == "1"
+
+
+class _ScoreCache:
+    """按 内容哈希+算法版本 缓存评分结果，按条目数与字节数双重上限做 LRU 淘汰。"""
+
+    def __init__(self, max_entries: int, max_bytes: int, path: str | None = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._dirty = 0
+        self._data: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+
+    @staticmethod
+    def make_key(data: bytes, variant: str = '') -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        return f"{SCORE_ALGO_VERSION}:{variant}:{digest}"
+
+    @staticmethod
+    def _entry_size(key: str) -> int:
+        # 键字符串 + float + OrderedDict 节点的近似开销
+        return len(key) + 24 + 64
+
+    def get(self, key: str) -> float | None:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: float):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self._data[key] = value
+                return
+            self._data[key] = value
+            self._bytes += self._entry_size(key)
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                old_key, _ = self._data.popitem(last=False)
+                self._bytes -= self._entry_size(old_key)
+                self.evictions += 1
+            self._dirty += 1
+            flush = self.path and self._dirty >= 100
+        if flush:
+            self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+                'persistent': bool(self.path),
+            }
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                items = json.load(f) or []
+        except Exception:
+            return
+        for key, value in items[-self.max_entries:]:
+            if key.startswith(f"{SCORE_ALGO_VERSION}:") and key not in self._data:
+                self._data[key] = float(value)
+                self._bytes += self._entry_size(key)
+        while self._data and self._bytes > self.max_bytes:
+            old_key, _ = self._data.popitem(last=False)
+            self._bytes -= self._entry_size(old_key)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            items = list(self._data.items())
+            self._dirty = 0
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(items, f)
+            os.replace(tmp, self.path)
+        except Exception:
+            pass
+
+
+score_cache = _ScoreCache(
+    SCORE_CACHE_MAX_ENTRIES,
+    SCORE_CACHE_MAX_BYTES,
+    os.path.join(HISTORY_DIR, 'score_cache.json') if SCORE_CACHE_PERSIST else None,
+)
+if not _SPAWNED_CHILD:
+    atexit.register(score_cache.save)
+
+
+def _score_many_cached(blobs: list[bytes], concurrency: int = 0, reduced: bool = False) -> list[float | None]:
+    """先查评分缓存，仅对未命中的图片解码评分；无法解析的图片不写入缓存。"""
+    variant = 'reduced' if reduced else 'full'
+    keys = [score_cache.make_key(b, variant) for b in blobs]
+    results: list[float | None] = [score_cache.get(k) for k in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        with _timed('image', 'score_batch'):
+            fresh = _score_many([blobs[i] for i in missing], concurrency, reduced=reduced)
+        for i, score in zip(missing, fresh):
+            results[i] = score
+            if score is not None:
+                score_cache.put(keys[i], score)
+    return results
+
+
+# ===== 近似重复图片聚类 =====
+# 连拍批量中大量图片几乎相同：先在小尺寸灰度图上计算 dHash 与清晰度粗估，
+# 按汉明距离聚类后，每组只对粗估最清晰的少数候选做完整评分
+SELECT_DEDUP = os.environ.get("SELECT_DEDUP", "0") == "1"
+SELECT_MAX_COUNT = 20
+# 开启聚类时单次请求可处理的图片上限（完整评分只发生在各组候选上）
+SELECT_DEDUP_MAX_COUNT = int(os.environ.get("SELECT_DEDUP_MAX_COUNT", "200"))
+# 64 位 dHash 的汉明距离不超过该值视为近似重复
+SELECT_DEDUP_HAMMING = int(os.environ.get("SELECT_DEDUP_HAMMING", "10"))
+# 每组参与完整评分的候选数
+SELECT_DEDUP_CANDIDATES = max(1, int(os.environ.get("SELECT_DEDUP_CANDIDATES", "2")))
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _cluster_hashes(hashes: list[int], threshold: int) -> list[int]:
+    """按上传顺序做首元聚类：每个尚未归组的图片把其后距离不超过阈值的未归组图片并入自己一组。
+    返回与输入对齐的组号（从 0 起，按各组首张图片的顺序编号）。"""
+    n = len(hashes)
+    if n == 0:
+        return []
+    h = np.array(hashes, dtype=np.uint64)
+    # 两两异或后按字节查表统计置位数，得到 n*n 汉明距离矩阵
+    xor = (h[:, None] ^ h[None, :]).view(np.uint8).reshape(n, n, 8)
+    dist = _POPCOUNT8[xor].sum(axis=2, dtype=np.uint16)
+    labels = np.full(n, -1, dtype=np.int64)
+    cluster = 0
+    for i in range(n):
+        if labels[i] >= 0:
+            continue
+        labels[(labels < 0) & (dist[i] <= threshold)] = cluster
+        cluster += 1
+    return labels.tolist()
+
+
+def _select_best_deduplicated(files, max_count: int, window: int, concurrency: int, reduced: bool) -> dict | None:
+    """两阶段优选：先逐窗计算指纹并聚类，再只对各组候选做完整评分。
+
+    有效图片指能够计算指纹的文件，按上传顺序最多取 max_count 张；返回的索引均基于有效图片。
+    某组候选全部无法评分时顺延到组内下一批。没有任何图片评分成功时返回 None。
+    """
+    valid = []  # (FileStorage, sharpness)，不持有图片字节
+    hashes = []
+    pending = list(files)
+    while pending and len(valid) < max_count:
+        need = min(max_count - len(valid), window)
+        batch, pending = pending[:need], pending[need:]
+        blobs = [f.read() for f in batch]
+        for f, (dhash, sharpness, seconds) in zip(batch, _pool_map(_image_fingerprint, blobs, concurrency)):
+            _record_timing('image', 'fingerprint', seconds)
+            if dhash is None:
+                continue
+            valid.append((f, sharpness))
+            hashes.append(dhash)
+        del blobs
+    if not valid:
+        return None
+
+    labels = _cluster_hashes(hashes, SELECT_DEDUP_HAMMING)
+    members: dict[int, list[int]] = {}
+    for i, label in enumerate(labels):
+        members.setdefault(label, []).append(i)
+    ranked = {c: sorted(idx, key=lambda i: -valid[i][1]) for c, idx in members.items()}
+
+    def read(i: int) -> bytes:
+        stream = valid[i][0].stream
+        stream.seek(0)
+        return stream.read()
+
+    scores: list[float | None] = [None] * len(valid)
+    taken = {c: 0 for c in ranked}
+    todo = list(ranked)
+    while todo:
+        candidates = []
+        for c in todo:
+            candidates.extend(ranked[c][taken[c]:taken[c] + SELECT_DEDUP_CANDIDATES])
+            taken[c] += SELECT_DEDUP_CANDIDATES
+        for start in range(0, len(candidates), window):
+            chunk = candidates[start:start + window]
+            blobs = [read(i) for i in chunk]
+            for i, score in zip(chunk, _score_many_cached(blobs, concurrency, reduced=reduced)):
+                scores[i] = score
+            del blobs
+        todo = [c for c in todo
+                if taken[c] < len(ranked[c]) and all(scores[i] is None for i in ranked[c][:taken[c]])]
+
+    clusters = []
+    best_index = -1
+    for c in sorted(members):
+        scored = [i for i in members[c] if scores[i] is not None]
+        # max 取首个最大值：与逐张比较时的严格大于一致
+        best = max(scored, key=lambda i: scores[i]) if scored else None
+        clusters.append({
+            'cluster_id': c,
+            'members': members[c],
+            'best_index': best,
+            'best_score': scores[best] if best is not None else None,
+        })
+        if best is not None and (best_index < 0 or scores[best] > scores[best_index]):
+            best_index = best
+    if best_index < 0:
+        return None
+    return {
+        'best_index': best_index,
+        'best_blob': read(best_index),
+        'scores': scores,
+        'cluster_ids': labels,
+        'clusters': clusters,
+    }
+
+
+def _encode_image_b64(img: Image.Image, fmt: str = 'JPEG') -> str:
+    with _timed('image', 'encode_b64'):
+        buf = io.BytesIO()
+        img.save(buf, format=fmt, quality=90)
+        return base64.b64encode(buf.getvalue()).decode('ascii')
+
+def _image_file_to_data_url(file_storage) -> str:
+    with _timed('image', 'eval_decode_resize'):
+        img = Image.open(file_storage.stream)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        max_dim = 2048
+        w, h = img.size
+        if max(w, h) > max_dim:
+            img = img.copy()
+            img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+    b64 = _encode_image_b64(img, fmt='JPEG')
+    return f"data:image/jpeg;base64,{b64}"
+
+
+# ===== 参考图预处理 =====
+# 上传时即生成可直接提交给上游的 data URL（超限时压缩），图生图时直接读取复用
+REFERENCE_MAX_BYTES = 10 * 1024 * 1024
+REFERENCE_DERIVED_DIR = os.path.join(UPLOAD_DIR, '.derived')
+UPLOAD_PRECOMPUTE_REFERENCE = os.environ.get("UPLOAD_PRECOMPUTE_REFERENCE", "1") == "1"
+
+
+def _guess_image_mime(filename: str) -> str:
+    lower = filename.lower()
+    if lower.endswith('.png'):
+        return 'image/png'
+    if lower.endswith('.webp'):
+        return 'image/webp'
+    return 'image/jpeg'
+
+
+def _reference_derived_path(filename: str) -> str:
+    # 只接受上传目录下的单层文件名，避免拼出目录之外或隐藏文件的路径
+    if not filename or filename != os.path.basename(filename) or filename.startswith('.'):
+        raise ValueError(f'非法的上传文件名: {filename!r}')
+    return os.path.join(REFERENCE_DERIVED_DIR, f"{filename}.dataurl")
+
+
+def _compress_reference(path: str) -> bytes:
+    """把超限参考图压缩为 JPEG：限制最长边 2048，二分查找满足大小上限的最高质量。"""
+    img = Image.open(path)
+    # 去除透明通道并限制尺寸
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    max_dim = 2048
+    w, h = img.size
+    if max(w, h) > max_dim:
+        img = img.copy()
+        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+
+    def encode(q: int) -> bytes:
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=q, optimize=True)
+        return buf.getvalue()
+
+    lo, hi = 35, 85
+    best = None
+    while lo <= hi:
+        q = (lo + hi) // 2
+        data = encode(q)
+        if len(data) <= REFERENCE_MAX_BYTES:
+            best, lo = data, q + 1
+        else:
+            hi = q - 1
+    # 最低质量仍超限时沿用最低质量的结果，交由上游判断
+    return best if best is not None else encode(35)
+
+
+def _build_reference_derivative(path: str, filename: str) -> str:
+    """生成并持久化参考图的 data URL，返回其内容。"""
+    with _timed('image', 'reference_prepare'):
+        if os.path.getsize(path) > REFERENCE_MAX_BYTES:
+            try:
+                data, mime = _compress_reference(path), 'image/jpeg'
+            except Exception:
+                # 压缩失败则回退到原始编码
+                with open(path, 'rb') as f:
+                    data, mime = f.read(), 'image/jpeg'
+        else:
+            with open(path, 'rb') as f:
+                data, mime = f.read(), _guess_image_mime(filename)
+        data_url = f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+    try:
+        os.makedirs(REFERENCE_DERIVED_DIR, exist_ok=True)
+        target = _reference_derived_path(filename)
+        tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='ascii') as f:
+            f.write(data_url)
+        os.replace(tmp, target)
+    except Exception:
+        pass
+    return data_url
+
+
+def _reference_data_url(path: str, filename: str) -> str:
+    """读取已预处理的参考图 data URL；不存在或源文件更新时重新生成。"""
+    derived = _reference_derived_path(filename)
+    try:
+        if os.path.getmtime(derived) >= os.path.getmtime(path):
+            with open(derived, 'r', encoding='ascii') as f:
+                return f.read()
+    except OSError:
+        pass
+    return _build_reference_derivative(path, filename)
+
+
+# ===== 上传文件内容寻址存储 =====
+# 上传文件以 sha256 命名（<digest>.<ext>），相同内容只保存一份；
+# 旧的 uuid 命名文件原地保留、按原地址直接提供，只登记内容哈希。索引保存在 uploads/.index.json。
+UPLOAD_GC_GRACE = float(os.environ.get("UPLOAD_GC_GRACE", str(24 * 3600)))
+# 后台回收的间隔（秒），0 表示只在删除历史记录时回收对应文件
+UPLOAD_GC_INTERVAL = float(os.environ.get("UPLOAD_GC_INTERVAL", "3600"))
+UPLOAD_INDEX_LEGACY = os.environ.get("UPLOAD_INDEX_LEGACY", "1") == "1"
+_CAS_NAME_RE = re.compile(r'^[0-9a-f]{64}\.(jpg|jpeg|png|webp)$')
+# 内容寻址之前的上传文件名（uuid4().hex）
+_LEGACY_NAME_RE = re.compile(r'^[0-9a-f]{32}\.(jpg|jpeg|png|webp)$')
+_UPLOAD_CHUNK = 1024 * 1024
+# 引用时间追加日志超过该大小时合并
+_REFERENCE_LOG_COMPACT_BYTES = 1024 * 1024
+
+
+class _UploadStore:
+    """内容寻址的上传目录：上传去重、登记旧文件与按历史引用回收。
+
+    文件最近一次写入或被去重命中后的 grace 秒内不会回收；之后不再被任何历史记录引用时，
+    由删除历史记录时的 release 或后台定期的 sweep 删除。去重命中的时间追加到 .referenced.log，
+    不改写索引。
+    """
+
+    def __init__(self, root: str, grace: float, gc_interval: float = 0):
+        self.root = root
+        self.grace = grace
+        self.gc_interval = gc_interval
+        self.index_path = os.path.join(root, '.index.json')
+        self.lock_path = os.path.join(root, '.index.lock')
+        self.refs_path = os.path.join(root, '.referenced.log')
+        self._lock = threading.RLock()
+        self._index_cache = None
+        self._gc_thread = None
+        self._gc_pid = None
+        self.deduplicated = 0
+        self.stored = 0
+        self.collected = 0
+        self.sweeps = 0
+        self.last_sweep_error = None
+
+    def after_fork(self):
+        self._lock = threading.RLock()
+        self._gc_thread = None
+
+    def _file_lock(self):
+        return _flock(self.lock_path, self._lock)
+
+    def _read_index(self) -> dict:
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                idx = json.load(f) or {}
+        except Exception:
+            idx = {}
+        idx.setdefault('blobs', {})
+        return idx
+
+    def _cached_index(self) -> dict:
+        """只读用途的索引：文件未变化时复用上次解析结果，去重命中无需每次解析整个索引。调用方不得修改。"""
+        try:
+            st = os.stat(self.index_path)
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            key = None
+        cached = self._index_cache
+        if cached is None or cached[0] != key:
+            cached = (key, self._read_index())
+            self._index_cache = cached
+        return cached[1]
+
+    def _write_index(self, idx: dict):
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(idx, f, ensure_ascii=False)
+        os.replace(tmp, self.index_path)
+
+    @staticmethod
+    def _hash_stream(stream) -> str:
+        h = hashlib.sha256()
+        while True:
+            chunk = stream.read(_UPLOAD_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+        return h.hexdigest()
+
+    def _hit(self, idx: dict, digest: str) -> str | None:
+        """内容已存在时记录引用时间并返回文件名（调用方持有文件锁）。"""
+        blob = idx['blobs'].get(digest)
+        if blob is None or not os.path.exists(os.path.join(self.root, blob['name'])):
+            return None
+        # 刚把地址返回给客户端，重新计算保留期
+        self._log_reference(digest)
+        self.deduplicated += 1
+        return blob['name']
+
+    def put(self, digest: str, ext: str, stage) -> tuple[str, bool]:
+        """登记上传内容，返回 (文件名, 是否新写入)。内容已存在时只追加引用时间，不写文件也不改写索引；
+        否则调用 stage() 在上传目录内准备好临时文件并返回其路径，再原子改名为内容寻址文件名。"""
+        with self._file_lock():
+            name = self._hit(self._cached_index(), digest)
+        if name:
+            return name, False
+        # 临时文件在锁外写入，避免阻塞其他上传；改名前在锁内复核
+        tmp_path = stage()
+        with self._file_lock():
+            idx = self._read_index()
+            name = self._hit(idx, digest)
+            if name:
+                return name, False
+            name = f"{digest}.{ext}"
+            path = os.path.join(self.root, name)
+            os.replace(tmp_path, path)
+            idx['blobs'][digest] = {'name': name, 'size': os.path.getsize(path), 'created': time.time()}
+            self._write_index(idx)
+            self.stored += 1
+            return name, True
+
+    def _log_reference(self, digest: str):
+        """追加一条引用时间（调用方持有文件锁）；日志过大时合并。"""
+        with open(self.refs_path, 'a', encoding='ascii') as f:
+            f.write(f"{digest} {time.time():.3f}\n")
+            size = f.tell()
+        if size > _REFERENCE_LOG_COMPACT_BYTES:
+            self._compact_references(self._read_references(), time.time())
+
+    def _read_references(self) -> dict[str, float]:
+        """每份内容最近一次被去重命中的时间。"""
+        refs: dict[str, float] = {}
+        try:
+            with open(self.refs_path, 'r', encoding='ascii') as f:
+                for line in f:
+                    digest, _, ts = line.partition(' ')
+                    try:
+                        t = float(ts)
+                    except ValueError:
+                        continue
+                    if t > refs.get(digest, 0):
+                        refs[digest] = t
+        except OSError:
+            pass
+        return refs
+
+    def _compact_references(self, refs: dict[str, float], now: float):
+        """只保留仍在保留期内的引用时间（调用方持有文件锁）。"""
+        keep = [f"{d} {t:.3f}\n" for d, t in refs.items() if now - t < self.grace]
+        tmp = f"{self.refs_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='ascii') as f:
+            f.writelines(keep)
+        os.replace(tmp, self.refs_path)
+
+    @staticmethod
+    def name_from_url(url: str | None) -> str | None:
+        if not url or url.startswith('http://') or url.startswith('https://'):
+            return None
+        rel = url[1:] if url.startswith('/') else url
+        if not rel.startswith('uploads/'):
+            return None
+        return rel.split('/', 1)[1]
+
+    def _collectable(self, digest: str, blob: dict, refs: dict[str, float], now: float) -> bool:
+        if blob.get('legacy'):
+            return False
+        return now - max(blob.get('created', 0), refs.get(digest, 0)) >= self.grace
+
+    @staticmethod
+    def _blob_urls(name: str) -> list[str]:
+        return [f"/uploads/{name}", f"uploads/{name}"]
+
+    def _remove(self, idx: dict, digest: str, name: str):
+        """删除文件及其派生数据并从索引中移除（调用方持有文件锁并负责写回索引）。"""
+        paths = [os.path.join(self.root, name), _reference_derived_path(name)]
+        try:
+            paths += [e.path for e in os.scandir(THUMB_CACHE_DIR) if e.name.startswith(f"{name}.w")]
+        except OSError:
+            pass
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        upload_manifest.forget(name)
+        del idx['blobs'][digest]
+        self.collected += 1
+
+    def release(self, url: str | None) -> bool:
+        """历史记录删除后调用：文件不再被任何历史引用且超过保留期时删除。"""
+        name = self.name_from_url(url)
+        if not name or (DB_READY and not db_bootstrap.caught_up):
+            return False
+        with self._file_lock():
+            idx = self._read_index()
+            digest, blob = next(((d, b) for d, b in idx['blobs'].items() if b['name'] == name), (None, None))
+            if blob is None or not self._collectable(digest, blob, self._read_references(), time.time()):
+                return False
+            if _history_references(self._blob_urls(name)):
+                return False
+            self._remove(idx, digest, name)
+            self._write_index(idx)
+            return True
+
+    def sweep(self) -> int:
+        """回收所有超过保留期且未被历史记录引用的文件（含从未生成过的上传），返回删除数量。"""
+        if not DB_READY or not db_bootstrap.caught_up:
+            # 数据库不可用或文件历史尚未全部导入时无法确认所有引用，宁可不回收
+            return 0
+        if HISTORY_WRITE_BEHIND:
+            # 仍在写入队列中的历史记录也算引用
+            history_writer.flush()
+        now = time.time()
+        idx = self._read_index()
+        refs = self._read_references()
+        candidates = {d: b['name'] for d, b in idx['blobs'].items() if self._collectable(d, b, refs, now)}
+        if not candidates:
+            return 0
+        # 历史查询不持有文件锁，避免阻塞上传；删除前在锁内复核
+        referenced = _history_referenced([u for name in candidates.values() for u in self._blob_urls(name)])
+        removed = 0
+        with self._file_lock():
+            idx = self._read_index()
+            refs = self._read_references()
+            now = time.time()
+            for digest, name in candidates.items():
+                blob = idx['blobs'].get(digest)
+                if blob is None or blob['name'] != name or not self._collectable(digest, blob, refs, now):
+                    continue
+                if referenced.intersection(self._blob_urls(name)):
+                    continue
+                self._remove(idx, digest, name)
+                removed += 1
+            if removed:
+                self._write_index(idx)
+            self._compact_references(refs, now)
+        return removed
+
+    def start_gc(self):
+        """每个进程一个后台回收线程；fork 出的子进程在首个请求时重新拉起。"""
+        if self.gc_interval <= 0:
+            return
+        if self._gc_thread is not None and self._gc_pid == os.getpid():
+            return
+        with self._lock:
+            if self._gc_thread is not None and self._gc_pid == os.getpid():
+                return
+            self._gc_pid = os.getpid()
+            self._gc_thread = threading.Thread(target=self._gc_loop, name='upload-gc', daemon=True)
+            self._gc_thread.start()
+
+    def _gc_loop(self):
+        while True:
+            # 多 worker 时错开各进程的回收时间
+            time.sleep(random.uniform(0.5, 1.0) * self.gc_interval)
+            try:
+                self.sweep()
+                self.last_sweep_error = None
+            except Exception as e:
+                self.last_sweep_error = str(e)
+            self.sweeps += 1
+
+    def index_legacy(self):
+        """登记旧的 uuid 命名文件：文件原地保留、地址不变，只把内容哈希写入索引，
+        之后相同内容的上传直接复用旧文件。旧文件不参与回收。
+        内容与已登记文件相同的旧文件同样保留（其地址可能已被历史记录引用），
+        只把文件名记在该内容的 duplicates 下，之后启动不再重复计算哈希。"""
+        with self._file_lock():
+            idx = self._read_index()
+            known = {n for b in idx['blobs'].values() for n in [b['name'], *b.get('duplicates', ())]}
+            changed = False
+            for entry in os.scandir(self.root):
+                name = entry.name
+                if not entry.is_file() or not _LEGACY_NAME_RE.match(name) or name in known:
+                    continue
+                with open(entry.path, 'rb') as f:
+                    digest = self._hash_stream(f)
+                blob = idx['blobs'].get(digest)
+                if blob and os.path.exists(os.path.join(self.root, blob['name'])):
+                    # 内容已有一份，旧文件仍按原名直接提供
+                    blob.setdefault('duplicates', []).append(name)
+                    changed = True
+                    continue
+                st = entry.stat()
+                idx['blobs'][digest] = {'name': name, 'size': st.st_size, 'created': st.st_mtime, 'legacy': True}
+                changed = True
+            if changed:
+                self._write_index(idx)
+
+    def stats(self) -> dict:
+        idx = self._read_index()
+        return {
+            'blobs': len(idx['blobs']),
+            'bytes': sum(b.get('size', 0) for b in idx['blobs'].values()),
+            'legacy_duplicates': sum(len(b.get('duplicates', ())) for b in idx['blobs'].values()),
+            'stored': self.stored,
+            'deduplicated': self.deduplicated,
+            'collected': self.collected,
+            'sweeps': self.sweeps,
+            'last_sweep_error': self.last_sweep_error,
+        }
+
+
+def _is_upload_name(filename: str) -> bool:
+    """是否为上传接口可能产生的文件名；其余名称（含路径分隔符、隐藏文件等）一律视为不存在。"""
+    return bool(_CAS_NAME_RE.match(filename) or _LEGACY_NAME_RE.match(filename))
+
+
+upload_store = _UploadStore(UPLOAD_DIR, UPLOAD_GC_GRACE, UPLOAD_GC_INTERVAL)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=upload_store.after_fork)
+if UPLOAD_INDEX_LEGACY and not _SPAWNED_CHILD:
+    try:
+        upload_store.index_legacy()
+    except Exception:
+        pass
+if not _SPAWNED_CHILD:
+    upload_store.start_gc()
+
+
+@app.before_request
+def _ensure_upload_gc():
+    upload_store.start_gc()
+
+
+# ===== 上传流式接收与校验 =====
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(30 * 1024 * 1024)))
+UPLOAD_MAX_PIXELS = int(os.environ.get("UPLOAD_MAX_PIXELS", str(80_000_000)))
+# multipart 边界与表单字段的额外开销
+_MULTIPART_OVERHEAD = 64 * 1024
+# 不超过该大小的上传在内存中接收，内容已存在时不落盘
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", str(16 * 1024 * 1024)))
+
+# 文件头魔数 -> Pillow 格式名
+_IMAGE_MAGIC = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+)
+_FORMAT_EXTS = {'JPEG': ('jpg', 'jpeg'), 'PNG': ('png',), 'WEBP': ('webp',)}
+
+
+class _UploadRejected(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def _sniff_image_format(head: bytes) -> str | None:
+    for magic, fmt in _IMAGE_MAGIC:
+        if head.startswith(magic):
+            return fmt
+    if len(head) >= 12 and head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+class _UploadSink:
+    """multipart 解析器的文件容器：请求体边到达边处理，前 16 字节即校验文件头魔数，
+    同时计算哈希、累计大小。不超过 UPLOAD_SPOOL_BYTES 时留在内存，超过后转写到上传目录下的临时文件；
+    内容需要新保存时由 stage 准备临时文件，之后由 upload_store.put 原子改名。"""
+
+    def __init__(self, ext: str):
+        self.ext = ext
+        self.path = None
+        self.size = 0
+        self.format = None
+        self._head = b''
+        self._hash = hashlib.sha256()
+        self._file = io.BytesIO()
+
+    def _sniff(self):
+        self.format = _sniff_image_format(self._head)
+        if self.format is None:
+            raise _UploadRejected('文件内容不是有效的 JPG/PNG/WebP 图片')
+
+    def _spill(self):
+        self.path = os.path.join(UPLOAD_DIR, f".upload-{uuid.uuid4().hex}.tmp")
+        f = open(self.path, 'w+b')
+        with self._file.getbuffer() as view:
+            f.write(view)
+        self._file = f
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_BYTES:
+            raise _UploadRejected(f'文件过大，最大支持 {UPLOAD_MAX_BYTES // (1024 * 1024)}MB', 413)
+        if self.format is None:
+            self._head += data[:16 - len(self._head)]
+            if len(self._head) >= 16:
+                self._sniff()
+        self._hash.update(data)
+        if self.path is None and self.size > UPLOAD_SPOOL_BYTES:
+            self._spill()
+        return self._file.write(data)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def finish(self) -> tuple[str, str]:
+        """接收完毕后用 Pillow 只解析图片头确认格式与尺寸，返回 (digest, ext)。"""
+        if self.size == 0:
+            raise _UploadRejected('文件为空')
+        if self.format is None:
+            self._sniff()
+        self._file.flush()
+        self._file.seek(0)
+        try:
+            with Image.open(self._file) as img:
+                detected, (w, h) = img.format, img.size
+        except Exception:
+            raise _UploadRejected('无法解析图片文件头')
+        if detected not in _FORMAT_EXTS or detected != self.format:
+            raise _UploadRejected('文件内容不是有效的 JPG/PNG/WebP 图片')
+        if w <= 0 or h <= 0 or w * h > UPLOAD_MAX_PIXELS:
+            raise _UploadRejected('图片尺寸无效或像素过多')
+        # 以实际格式为准修正扩展名
+        ext = self.ext if self.ext in _FORMAT_EXTS[detected] else _FORMAT_EXTS[detected][0]
+        return self._hash.hexdigest(), ext
+
+    def stage(self) -> str:
+        """返回上传目录内保存完整内容的临时文件路径（仍在内存中时先写出）。"""
+        if self.path is None:
+            self._spill()
+        self._file.close()
+        return self.path
+
+    def close(self):
+        """关闭并删除临时文件（已被改名为正式文件时无需删除）。"""
+        self._file.close()
+        if self.path is None:
+            return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _parse_upload_form(environ, limit: int) -> tuple[dict, list]:
+    """流式解析上传请求体，返回 (files, sinks)。扩展名在文件部分开始时即校验，
+    内容不合法或超限时在读到对应数据块时抛出 _UploadRejected，不再继续接收。
+    sinks 为本次创建的全部临时文件容器，调用方负责 close。"""
+    sinks = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        if not filename:
+            raise _UploadRejected('未选择文件')
+        # 校验扩展名
+        name = secure_filename(filename)
+        ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+        if ext not in ALLOWED_EXTS:
+            raise _UploadRejected('仅支持 JPG/PNG/WebP')
+        sink = _UploadSink(ext)
+        sinks.append(sink)
+        return sink
+
+    # 解析器每次读取 64KB，并保留上一块末尾用于匹配分隔符；内存上限须大于一次读取量，否则会误判 413
+    parser = FormDataParser(stream_factory=stream_factory, max_content_length=limit,
+                            max_form_memory_size=2 * _MULTIPART_OVERHEAD)
+    try:
+        _, _, files = parser.parse_from_environ(environ)
+    except BaseException:
+        for sink in sinks:
+            sink.close()
+        raise
+    return files, sinks
+
+
+# ===== 上传图片缩略图 =====
+# /uploads/<name>?w=256&fmt=webp 按需生成缩略/转码版本，缓存在 uploads/.thumbs/，按总大小做 LRU 淘汰
+THUMB_WIDTHS = (64, 128, 256, 512, 1024)
+THUMB_FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpeg': ('JPEG', 'image/jpeg'), 'jpg': ('JPEG', 'image/jpeg'), 'png': ('PNG', 'image/png')}
+THUMB_CACHE_DIR = os.path.join(UPLOAD_DIR, '.thumbs')
+THUMB_CACHE_MAX_BYTES = int(os.environ.get("THUMB_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# 上传时预先生成的缩略图宽度，逗号分隔，如 "256"；默认不预生成
+THUMB_PREWARM_WIDTHS = tuple(int(x) for x in os.environ.get("THUMB_PREWARM_WIDTHS", "").split(',') if x.strip())
+THUMB_PREWARM_FORMAT = os.environ.get("THUMB_PREWARM_FORMAT", "webp")
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+class _DiskLRU:
+    """按总大小做 LRU 淘汰的磁盘缓存目录：命中时刷新 mtime，超限时淘汰最久未用的文件。"""
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._bytes = None
+        self.evictions = 0
+
+    @staticmethod
+    def touch(path: str) -> bool:
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def _account(self, added: int):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan_total()
+            else:
+                self._bytes += added
+            if self._bytes <= self.max_bytes:
+                return
+            # 其他进程也会写入，淘汰前重新扫描目录以获得准确的占用
+            entries = []
+            for entry in os.scandir(self.root):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    self.evictions += 1
+                except OSError:
+                    pass
+            self._bytes = total
+
+    def _scan_total(self) -> int:
+        try:
+            return sum(e.stat().st_size for e in os.scandir(self.root) if e.is_file())
+        except OSError:
+            return 0
+
+
+class _ThumbnailCache(_DiskLRU):
+    """磁盘缩略图缓存。"""
+
+    def __init__(self, root: str, max_bytes: int):
+        super().__init__(root, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def variant_path(self, name: str, width: int, fmt: str) -> str:
+        return os.path.join(self.root, f"{name}.w{width}.{fmt}")
+
+    def get_or_create(self, source: str, name: str, width: int, fmt: str) -> str:
+        target = self.variant_path(name, width, fmt)
+        try:
+            os.utime(target)
+            with self._lock:
+                self.hits += 1
+            return target
+        except OSError:
+            pass
+        with self._lock:
+            self.misses += 1
+        pil_format = THUMB_FORMATS[fmt][0]
+        with _timed('image', 'thumbnail_render'), Image.open(source) as img:
+            # JPEG 按目标尺寸降采样解码
+            img.draft('RGB', (width, width))
+            if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                img = img.convert('RGBA')
+            if img.width > width:
+                img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+            img.save(tmp, format=pil_format, quality=80)
+        os.replace(tmp, target)
+        self._account(os.path.getsize(target))
+        return target
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'bytes': self._bytes if self._bytes is not None else self._scan_total(),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+thumb_cache = _ThumbnailCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_BYTES)
+
+
+def _upload_etag(name: str, path: str, suffix: str = '') -> str:
+    """内容寻址文件名本身即内容哈希；旧文件名退化为 mtime+size。"""
+    stem = name.split('.', 1)[0]
+    if _CAS_NAME_RE.match(name):
+        base = stem[:32]
+    else:
+        st = os.stat(path)
+        base = f"{int(st.st_mtime):x}-{st.st_size:x}"
+    return f"{base}{suffix}"
+
+
+def _serve_upload_variant(name: str, width_arg: str | None, fmt_arg: str | None, root: str = UPLOAD_DIR):
+    path = None if _is_hidden_path(name) else safe_join(root, name)
+    if not path or not os.path.isfile(path):
+        return jsonify({'error': 'File not found'}), 404
+    try:
+        width = int(width_arg) if width_arg else THUMB_WIDTHS[-1]
+    except ValueError:
+        return jsonify({'error': 'Invalid width'}), 400
+    # 只允许固定档位，避免任意宽度撑爆缓存；向上取最近的档位
+    width = next((w for w in THUMB_WIDTHS if w >= width), THUMB_WIDTHS[-1])
+    fmt = (fmt_arg or 'webp').lower()
+    if fmt not in THUMB_FORMATS:
+        return jsonify({'error': 'Unsupported format'}), 400
+    etag = _upload_etag(name, path, f"-w{width}.{fmt}")
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        variant = thumb_cache.get_or_create(path, name, width, fmt)
+        resp = send_file(variant, mimetype=THUMB_FORMATS[fmt][1], conditional=False, etag=False,
+                         max_age=STATIC_MAX_AGE)
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = STATIC_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+
+def _prewarm_thumbnails(path: str, name: str):
+    for width in THUMB_PREWARM_WIDTHS:
+        try:
+            thumb_cache.get_or_create(path, name, width, THUMB_PREWARM_FORMAT)
+        except Exception:
+            pass
+
+
+# ===== 静态文件服务 =====
+# /video 与 /uploads 共用：启动时预先计算 ETag / Last-Modified，支持 Range(206)、
+# If-None-Match / If-Modified-Since(304) 与长期缓存；文件体由 WSGI file_wrapper 发送，
+# gunicorn 等服务器会使用 sendfile 零拷贝。前置 nginx 时可开启 STATIC_USE_X_SENDFILE。
+VIDEO_DIR = os.path.join(app.root_path, 'video')
+app.config['USE_X_SENDFILE'] = os.environ.get("STATIC_USE_X_SENDFILE", "0") == "1"
+
+
+def _is_hidden_path(rel: str) -> bool:
+    """路径中任一层以 . 开头（索引、派生数据与缩略图缓存等内部文件）。"""
+    return any(part.startswith('.') for part in rel.replace('\\', '/').split('/'))
+
+
+class _StaticManifest:
+    """目录文件清单：相对路径 -> 路径、大小、修改时间与 ETag。内部的隐藏文件不对外提供。"""
+
+    def __init__(self, root: str, etag_fn=None):
+        self.root = root
+        self.etag_fn = etag_fn
+        self._entries: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.scan()
+
+    def _stat(self, rel: str) -> dict | None:
+        if _is_hidden_path(rel):
+            return None
+        path = safe_join(self.root, rel)
+        if not path:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        if self.etag_fn:
+            etag = self.etag_fn(rel, path)
+        else:
+            etag = f"{int(st.st_mtime):x}-{st.st_size:x}"
+        return {'path': path, 'size': st.st_size, 'mtime': st.st_mtime, 'etag': etag}
+
+    def scan(self):
+        entries = {}
+        try:
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                for fn in filenames:
+                    if fn.startswith('.') or fn.endswith('.tmp'):
+                        continue
+                    rel = os.path.relpath(os.path.join(dirpath, fn), self.root).replace(os.sep, '/')
+                    entry = self._stat(rel)
+                    if entry:
+                        entries[rel] = entry
+        except OSError:
+            pass
+        with self._lock:
+            self._entries = entries
+
+    def lookup(self, rel: str) -> dict | None:
+        if _is_hidden_path(rel):
+            return None
+        entry = self._entries.get(rel)
+        if entry is None:
+            # 启动后新增的文件（如新上传）首次访问时登记
+            entry = self._stat(rel)
+            if entry is not None:
+                with self._lock:
+                    self._entries[rel] = entry
+        return entry
+
+    def forget(self, rel: str):
+        with self._lock:
+            self._entries.pop(rel, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _send_static(manifest: _StaticManifest, rel: str, mimetype: str | None = None,
+                 not_found: str = 'File not found'):
+    entry = manifest.lookup(rel)
+    if entry is None:
+        return jsonify({'error': not_found}), 404
+    try:
+        resp = send_file(
+            entry['path'],
+            mimetype=mimetype,
+            conditional=True,
+            etag=entry['etag'],
+            last_modified=entry['mtime'],
+            max_age=STATIC_MAX_AGE,
+        )
+    except FileNotFoundError:
+        manifest.forget(rel)
+        return jsonify({'error': not_found}), 404
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
+
+
+video_manifest = _StaticManifest(VIDEO_DIR)
+upload_manifest = _StaticManifest(UPLOAD_DIR, etag_fn=lambda rel, path: _upload_etag(rel, path))
+
+
+# ===== 生成结果本地镜像 =====
+# Ark 返回的图片地址会过期，且每次浏览都要跨网络访问 CDN：生成成功后由后台线程下载一次，
+# 按内容哈希存入本地目录（总大小超限按最久未访问淘汰），再把历史记录改写为 /generated/<name>
+MIRROR_ENABLED = os.environ.get("MIRROR_ENABLED", "1") == "1"
+MIRROR_DIR = os.path.join(HISTORY_DIR, 'generated')
+MIRROR_CACHE_MAX_BYTES = int(os.environ.get("MIRROR_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+MIRROR_WORKERS = int(os.environ.get("MIRROR_WORKERS", "4"))
+MIRROR_MAX_PENDING = int(os.environ.get("MIRROR_MAX_PENDING", "256"))
+MIRROR_TIMEOUT = float(os.environ.get("MIRROR_TIMEOUT", "30"))
+MIRROR_MAX_IMAGE_BYTES = int(os.environ.get("MIRROR_MAX_IMAGE_BYTES", str(50 * 1024 * 1024)))
+
+
+class _ImageMirror(_DiskLRU):
+    """有界线程池下载生成图片：在途任务数有上限（超出直接放弃，历史保留上游地址），
+    相同内容只存一份；另在 .sources/ 下记录每个文件的上游地址，文件被淘汰后据此重新下载。"""
+
+    def __init__(self, root: str, max_bytes: int, workers: int, max_pending: int,
+                 timeout: float, max_image_bytes: int):
+        super().__init__(root, max_bytes)
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_image_bytes = max_image_bytes
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        # 上游地址 -> 本地文件名：命中生成结果缓存的重复地址无需再次下载
+        self._by_url: OrderedDict[str, str] = OrderedDict()
+        self.mirrored = 0
+        self.reused = 0
+        self.failed = 0
+        self.dropped = 0
+        self.restored = 0
+        self.downloaded_bytes = 0
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image-mirror')
+            self._pid = os.getpid()
+        return self._executor
 
-def _conv2d(arr: np.ndarray, kernel: np.ndarray) -> np.ndarray:
-    kh, kw = kernel.shape
-    ph, pw = kh // 2, kw // 2
-    padded = np.pad(arr, ((ph, ph), (pw, pw)), mode='reflect')
-    out = np.zeros_like(arr)
-    # 简单实现，性能足够满足中小图
-    for i in range(arr.shape[0]):
-        region_rows = padded[i:i+kh]
-        for j in range(arr.shape[1]):
-            region = region_rows[:, j:j+kw]
-            out[i, j] = float((region * kernel).sum())
-    return out
-
-
-def _compute_quality_score(img: Image.Image) -> float:
-    """
-    计算图片质量评分：综合锐度(边缘)、对比度、亮度合理性与分辨率。
-    返回值越大表示质量越好。
-    """
-    # 限制计算尺寸，保证速度与稳定
-    w, h = img.size
-    scaled = img.copy()
-    scaled.thumbnail((1024, 1024), Image.LANCZOS)
-    arr = np.array(scaled.convert('L'), dtype=np.float32)
+    def submit(self, item_id, url: str | None) -> bool:
+        if not url or not url.startswith(('http://', 'https://')):
+            return False
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending += 1
+            executor = self._get_executor()
+        executor.submit(self._run, item_id, url)
+        return True
 
-    # Sobel 边缘强度
-    kx = np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]], dtype=np.float32)
-    ky = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]], dtype=np.float32)
-    gx = _conv2d(arr, kx)
-    gy = _conv2d(arr, ky)
-    mag = np.sqrt(gx * gx + gy * gy)
-    edge_mean = float(np.mean(mag))
-    sharpness_score = float(np.log1p(edge_mean))  # 0~4 左右
+    def _run(self, item_id, url: str):
+        try:
+            name = self.fetch(url)
+            _update_history_image_url(item_id, url, f"/generated/{name}")
+        except Exception:
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
 
-    # 对比度（标准差）
-    contrast_score = float(np.std(arr) / 50.0)
+    def _download(self, url: str) -> bytes:
+        with urllib.request.urlopen(url, timeout=self.timeout) as resp:
+            data = resp.read(self.max_image_bytes + 1)
+        if len(data) > self.max_image_bytes:
+            raise ValueError('生成图片超过镜像大小上限')
+        return data
 
-    # 亮度偏差惩罚，接近中性灰更佳
-    brightness_penalty = float(abs(np.mean(arr) - 127.5) / 127.5)
+    def fetch(self, url: str) -> str:
+        """下载（或复用已镜像的）图片，返回本地文件名。"""
+        with self._lock:
+            name = self._by_url.get(url)
+        if name and self.touch(os.path.join(self.root, name)):
+            with self._lock:
+                self.reused += 1
+            return name
+        with _timed('upstream', 'image_download'):
+            data = self._download(url)
+        fmt = _sniff_image_format(data[:16])
+        if fmt is None:
+            raise ValueError('上游返回的内容不是图片')
+        name = f"{hashlib.sha256(data).hexdigest()}.{_FORMAT_EXTS[fmt][0]}"
+        path = os.path.join(self.root, name)
+        if not self.touch(path):
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._account(len(data))
+        self._write_source(name, url)
+        with self._lock:
+            self._by_url[url] = name
+            self._by_url.move_to_end(url)
+            while len(self._by_url) > 1024:
+                self._by_url.popitem(last=False)
+            self.mirrored += 1
+            self.downloaded_bytes += len(data)
+        return name
 
-    # 分辨率评分（偏好更高分辨率）
-    resolution_score = float(min(w, h) / 1024.0)
+    def _source_path(self, name: str) -> str | None:
+        return safe_join(os.path.join(self.root, '.sources'), name)
 
-    score = sharpness_score + 0.8 * contrast_score + 0.2 * resolution_score - 0.5 * brightness_penalty
-    return round(score, 6)
+    def _write_source(self, name: str, url: str):
+        path = self._source_path(name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(url)
+        except OSError:
+            pass
 
+    def source_url(self, name: str) -> str | None:
+        path = self._source_path(name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except (OSError, TypeError):
+            return None
 
-def _encode_image_b64(img: Image.Image, fmt: str = 'JPEG') -> str:
-    buf = io.BytesIO()
-    img.save(buf, format=fmt, quality=90)
-    return base64.b64encode(buf.getvalue()).decode('ascii')
+    def restore(self, name: str) -> bool:
+        """重新下载已被淘汰的文件；上游地址已过期或内容已变化时返回 False。"""
+        source = self.source_url(name)
+        if not source:
+            return False
+        try:
+            restored = self.fetch(source) == name
+        except Exception:
+            return False
+        if restored:
+            with self._lock:
+                self.restored += 1
+        return restored
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'enabled': MIRROR_ENABLED,
+                'bytes': self._bytes if self._bytes is not None else self._scan_total(),
+                'max_bytes': self.max_bytes,
+                'pending': self._pending,
+                'mirrored': self.mirrored,
+                'reused': self.reused,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'restored': self.restored,
+                'evictions': self.evictions,
+                'downloaded_bytes': self.downloaded_bytes,
+            }
 
-def _image_file_to_data_url(file_storage) -> str:
-    img = Image.open(file_storage.stream)
-    if img.mode not in ('RGB', 'L'):
-        img = img.convert('RGB')
-    max_dim = 2048
-    w, h = img.size
-    if max(w, h) > max_dim:
-        img = img.copy()
-        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
-    b64 = _encode_image_b64(img, fmt='JPEG')
-    return f"data:image/jpeg;base64,{b64}"
+
+image_mirror = _ImageMirror(MIRROR_DIR, MIRROR_CACHE_MAX_BYTES, MIRROR_WORKERS, MIRROR_MAX_PENDING,
+                            MIRROR_TIMEOUT, MIRROR_MAX_IMAGE_BYTES)
+mirror_manifest = _StaticManifest(MIRROR_DIR, etag_fn=lambda rel, path: _upload_etag(rel, path))
+
+
+def _mirror_history_entries(entries: list[dict]):
+    if not MIRROR_ENABLED:
+        return
+    for entry in entries:
+        image_mirror.submit(entry['id'], entry.get('image_url'))
 
 
 @app.route('/')
@@ -311,20 +3182,30 @@ def index():
 @app.route('/api/upload', methods=['POST'])
 def upload_image():
     try:
-        if 'file' not in request.files:
-            return jsonify({'success': False, 'error': '缺少文件字段'}), 400
-        f = request.files['file']
-        if not f or f.filename == '':
-            return jsonify({'success': False, 'error': '未选择文件'}), 400
-        # 校验扩展名
-        name = secure_filename(f.filename)
-        ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
-        if ext not in ALLOWED_EXTS:
-            return jsonify({'success': False, 'error': '仅支持 JPG/PNG/WebP'}), 400
-        # 保存文件
-        filename = f"{uuid.uuid4().hex}.{ext}"
+        # 按 Content-Length 提前拒绝超限请求，无需读取请求体
+        limit = UPLOAD_MAX_BYTES + _MULTIPART_OVERHEAD
+        if request.content_length is not None and request.content_length > limit:
+            return jsonify({'success': False, 'error': f'文件过大，最大支持 {UPLOAD_MAX_BYTES // (1024 * 1024)}MB'}), 413
+        # 直接解析原始请求体（不经 request.files 预先缓冲整个请求），分块传输时读到超限即中止
+        try:
+            with _timed('image', 'upload_ingest'):
+                files, sinks = _parse_upload_form(request.environ, limit)
+        except _UploadRejected as e:
+            return jsonify({'success': False, 'error': str(e)}), e.status
+        try:
+            f = files.get('file')
+            if f is None:
+                return jsonify({'success': False, 'error': '缺少文件字段'}), 400
+            try:
+                digest, ext = f.stream.finish()
+            except _UploadRejected as e:
+                return jsonify({'success': False, 'error': str(e)}), e.status
+            # 按内容哈希保存（临时文件原子改名），相同内容直接复用已有文件，不再落盘
+            filename, created = upload_store.put(digest, ext, f.stream.stage)
+        finally:
+            for sink in sinks:
+                sink.close()
         path = os.path.join(UPLOAD_DIR, filename)
-        f.save(path)
         # 返回可访问URL（相对路径即可）
         url = f"/uploads/{filename}"
         # 尺寸提示（不拒绝上传），避免后续生成因参考图过大失败
@@ -332,10 +3213,20 @@ def upload_image():
             size_bytes = os.path.getsize(path)
         except Exception:
             size_bytes = 0
+        if UPLOAD_PRECOMPUTE_REFERENCE and created:
+            # 预先生成图生图所需的参考图数据，后续生成直接复用
+            try:
+                _build_reference_derivative(path, filename)
+            except Exception:
+                pass
+        if THUMB_PREWARM_WIDTHS and created:
+            _prewarm_thumbnails(path, filename)
         resp = {'success': True, 'url': url, 'filename': filename}
-        if size_bytes > (10 * 1024 * 1024):
+        if size_bytes > REFERENCE_MAX_BYTES:
             resp['warning'] = '图片较大（>10MB），生成时将自动压缩以避免失败'
         return jsonify(resp)
+    except RequestEntityTooLarge:
+        return jsonify({'success': False, 'error': f'文件过大，最大支持 {UPLOAD_MAX_BYTES // (1024 * 1024)}MB'}), 413
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -343,85 +3234,399 @@ def upload_image():
 @app.route('/uploads/<path:filename>')
 def serve_upload(filename):
     try:
-        return send_from_directory(UPLOAD_DIR, filename)
+        if _is_hidden_path(filename):
+            return jsonify({'error': 'File not found'}), 404
+        if request.args.get('w') or request.args.get('fmt'):
+            return _serve_upload_variant(filename, request.args.get('w'), request.args.get('fmt'))
+        return _send_static(upload_manifest, filename)
     except Exception as e:
         return jsonify({'error': f'Error serving upload: {str(e)}'}), 500
 
+
+@app.route('/generated/<path:filename>')
+def serve_generated(filename):
+    """本地镜像的生成图片（支持 ?w=&fmt= 缩略图）；已被淘汰时从上游原始地址重新下载，地址已过期则 404"""
+    try:
+        # 只接受内容寻址文件名，隐藏文件与子目录一律 404
+        if not _CAS_NAME_RE.match(filename):
+            return jsonify({'error': 'File not found'}), 404
+        path = os.path.join(MIRROR_DIR, filename)
+        if not os.path.isfile(path) and not image_mirror.restore(filename):
+            return jsonify({'error': 'File not found'}), 404
+        # 访问即刷新，按最近访问时间淘汰
+        image_mirror.touch(path)
+        if request.args.get('w') or request.args.get('fmt'):
+            return _serve_upload_variant(filename, request.args.get('w'), request.args.get('fmt'), root=MIRROR_DIR)
+        return _send_static(mirror_manifest, filename)
+    except Exception as e:
+        return jsonify({'error': f'Error serving image: {str(e)}'}), 500
+
+EVALUATE_MODEL = 'Qwen/Qwen3-VL-8B-Instruct'
+EVALUATE_PROMPT = '请作为专业的摄影与图像审美评估助手，用中文列点评估这张照片的优点、缺点，并给出具体且可操作的改进建议。语言简洁，避免空话。'
+
+
+def _evaluate_messages(image_url: str, prompt_text: str) -> list[dict]:
+    return [{
+        'role': 'user',
+        'content': [
+            {'type': 'text', 'text': prompt_text},
+            {'type': 'image_url', 'image_url': {'url': image_url}},
+        ],
+    }]
+
+
+def _record_evaluation(image_url, prompt_text: str):
+    _add_history_entry({
+        'id': str(uuid.uuid4()),
+        'mode': 'evaluate',
+        'prompt': prompt_text,
+        'image_url': image_url if isinstance(image_url, str) and image_url.startswith('http') else '',
+        'created_at': datetime.utcnow().isoformat()
+    })
+
+
+def _flag_value(value) -> bool:
+    """布尔开关取值：字符串只有 1/true/yes（不区分大小写）为真，"false"、"0" 等均为假。"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+def _request_flag(data: dict, name: str, req=None):
+    """依次从 JSON 请求体、查询参数、表单读取布尔开关，未提供时返回 None。req 默认为当前 Flask 请求。"""
+    req = req or request
+    flag = data.get(name, req.args.get(name, req.form.get(name)))
+    return None if flag is None else _flag_value(flag)
+
+
+def _wants_event_stream(data: dict, req=None) -> bool:
+    flag = _request_flag(data, 'stream', req)
+    if flag is not None:
+        return bool(flag)
+    return 'text/event-stream' in ((req or request).headers.get('Accept') or '')
+
+
+def _chunk_text(chunk) -> str:
+    try:
+        return chunk.choices[0].delta.content or ''
+    except (AttributeError, IndexError):
+        return ''
+
+
+def _completion_text(resp) -> str:
+    try:
+        return (resp.choices[0].message.content or '').strip()
+    except Exception:
+        return ''
+
+
+def _stream_evaluation(image_url: str, prompt_text: str, cache_key: str | None = None):
+    """以 SSE 转发模型的增量输出：delta 事件为文本片段，done 事件为完整结果。"""
+    def events():
+        parts = []
+        start = time.monotonic()
+        try:
+            stream = ms_upstream.call(
+                ms_client.chat.completions.create,
+                model=EVALUATE_MODEL,
+                messages=_evaluate_messages(image_url, prompt_text),
+                stream=True,
+            )
+            for chunk in stream:
+                piece = _chunk_text(chunk)
+                if piece:
+                    parts.append(piece)
+                    yield _sse('delta', {'text': piece})
+        except Exception as e:
+            yield _sse('error', {'success': False, 'error': str(e)})
+            return
+        text = ''.join(parts).strip()
+        if not text:
+            yield _sse('error', {'success': False, 'error': 'AI未返回有效内容'})
+            return
+        if cache_key:
+            eval_cache.put(cache_key, text, time.monotonic() - start)
+        _record_evaluation(image_url, prompt_text)
+        yield _sse('done', {'success': True, 'evaluation': text})
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+# ===== 评估结果缓存 =====
+# 以 图片内容哈希 + 提示词 + 模型名 为键持久化到 SQLite，多进程共享；按 TTL 过期、按最近访问做 LRU 淘汰
+EVAL_CACHE_ENABLED = os.environ.get("EVAL_CACHE_ENABLED", "1") == "1"
+EVAL_CACHE_PATH = os.environ.get("EVAL_CACHE_PATH", os.path.join(HISTORY_DIR, 'eval_cache.sqlite3'))
+EVAL_CACHE_TTL = float(os.environ.get("EVAL_CACHE_TTL", str(7 * 24 * 3600)))
+EVAL_CACHE_MAX_ENTRIES = int(os.environ.get("EVAL_CACHE_MAX_ENTRIES", "5000"))
+
+
+class _EvalCache:
+    """持久化的评估结果缓存，统计命中率与节省的上游耗时。"""
+
+    def __init__(self, path: str, ttl: float, max_entries: int, enabled: bool = True):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.errors = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS eval_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL,"
+                " last_access REAL NOT NULL, latency REAL NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_eval_cache_access ON eval_cache (last_access)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(image_digest: str, prompt_text: str, model: str) -> str:
+        raw = json.dumps([image_digest, prompt_text, model], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        try:
+            conn = self._conn()
+            row = conn.execute("SELECT value, created, latency FROM eval_cache WHERE key=?", (key,)).fetchone()
+            now = time.time()
+            if row is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM eval_cache WHERE key=?", (key,))
+                row = None
+            if row is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+            conn.execute("UPDATE eval_cache SET last_access=? WHERE key=?", (now, key))
+            with self._lock:
+                self.hits += 1
+                self.saved_seconds += row[2]
+            return row[0]
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+                self.misses += 1
+            return None
+
+    def put(self, key: str, value: str, latency: float):
+        if not self.enabled:
+            return
+        try:
+            conn = self._conn()
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO eval_cache (key, value, created, last_access, latency) VALUES (?,?,?,?,?)",
+                (key, value, now, now, latency),
+            )
+            conn.execute("DELETE FROM eval_cache WHERE created < ?", (now - self.ttl,))
+            count = conn.execute("SELECT COUNT(*) FROM eval_cache").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM eval_cache WHERE key IN (SELECT key FROM eval_cache ORDER BY last_access LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+
+    def stats(self) -> dict:
+        entries = None
+        if self.enabled:
+            try:
+                entries = self._conn().execute("SELECT COUNT(*) FROM eval_cache").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': entries,
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+                'saved_latency_seconds': round(self.saved_seconds, 3),
+                'errors': self.errors,
+            }
+
+
+eval_cache = _EvalCache(EVAL_CACHE_PATH, EVAL_CACHE_TTL, EVAL_CACHE_MAX_ENTRIES, EVAL_CACHE_ENABLED)
+
+
+def _image_url_digest(image_url: str) -> str:
+    """data URL 按解码后的图片字节哈希，其余地址按规范化后的 URL 哈希。"""
+    url = (image_url or '').strip()
+    if url.startswith('data:') and ',' in url:
+        header, payload = url.split(',', 1)
+        try:
+            data = base64.b64decode(payload) if ';base64' in header else payload.encode('utf-8')
+            return 'bytes:' + hashlib.sha256(data).hexdigest()
+        except ValueError:
+            pass
+    return 'url:' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
 @app.route('/api/evaluate/photo', methods=['POST'])
 def evaluate_photo():
+    """照片评估。默认返回 JSON；请求参数 stream=1（或 Accept: text/event-stream）时以 SSE 流式返回。
+    相同图片与提示词的评估结果会被缓存，no_cache=1 时跳过缓存。
+    """
     try:
         image_url = None
+        upload = None
+        data = {}
         if request.content_type and 'application/json' in request.content_type:
             data = request.get_json() or {}
             image_url = data.get('image_url')
+            image_digest = _image_url_digest(image_url or '')
         elif 'file' in request.files:
-            image_url = _image_file_to_data_url(request.files['file'])
+            upload = request.files['file']
+            # 规范化（缩放、重编码）只依赖原始字节，直接按原始字节哈希，命中时无需解码
+            image_digest = 'file:' + hashlib.sha256(upload.stream.read()).hexdigest()
+            upload.stream.seek(0)
         else:
             return jsonify({'success': False, 'error': '请上传图片或提供image_url'}), 400
 
-        prompt_text = '请作为专业的摄影与图像审美评估助手，用中文列点评估这张照片的优点、缺点，并给出具体且可操作的改进建议。语言简洁，避免空话。'
-        resp = ms_client.chat.completions.create(
-            model='Qwen/Qwen3-VL-8B-Instruct',
-            messages=[{
-                'role': 'user',
-                'content': [
-                    {'type': 'text', 'text': prompt_text},
-                    {'type': 'image_url', 'image_url': {'url': image_url}},
-                ],
-            }],
+        prompt_text = EVALUATE_PROMPT
+        bypass = _request_flag(data, 'no_cache')
+        cache_key = None if bypass else eval_cache.make_key(image_digest, prompt_text, EVALUATE_MODEL)
+        cached = eval_cache.get(cache_key) if cache_key else None
+        streaming = _wants_event_stream(data)
+
+        if cached:
+            _record_evaluation(image_url, prompt_text)
+            if streaming:
+                def replay():
+                    yield _sse('delta', {'text': cached})
+                    yield _sse('done', {'success': True, 'evaluation': cached, 'cached': True})
+                return Response(replay(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+            return jsonify({'success': True, 'evaluation': cached, 'cached': True})
+
+        if upload is not None:
+            image_url = _image_file_to_data_url(upload)
+        if streaming:
+            return _stream_evaluation(image_url, prompt_text, cache_key)
+
+        start = time.monotonic()
+        resp = ms_upstream.call(
+            ms_client.chat.completions.create,
+            model=EVALUATE_MODEL,
+            messages=_evaluate_messages(image_url, prompt_text),
             stream=False,
         )
 
-        text = ''
-        try:
-            text = (resp.choices[0].message.content or '').strip()
-        except Exception:
-            text = ''
-
+        text = _completion_text(resp)
         if not text:
             return jsonify({'success': False, 'error': 'AI未返回有效内容'}), 502
 
-        _add_history_entry({
-            'id': str(uuid.uuid4()),
-            'mode': 'evaluate',
-            'prompt': prompt_text,
-            'image_url': image_url if isinstance(image_url, str) and image_url.startswith('http') else '',
-            'created_at': datetime.utcnow().isoformat()
-        })
+        if cache_key:
+            eval_cache.put(cache_key, text, time.monotonic() - start)
+        _record_evaluation(image_url, prompt_text)
 
         return jsonify({'success': True, 'evaluation': text})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _encode_history_cursor(key: tuple[str, str] | None) -> str | None:
+    if not key:
+        return None
+    raw = json.dumps([key[0], key[1]], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_history_cursor(cursor: str | None) -> tuple[str, str] | None:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, item_id = json.loads(raw)
+        return str(created_at), str(item_id)
+    except Exception:
+        raise ValueError('无效的分页游标')
+
+
+def _history_row_to_item(r) -> dict:
+    return {
+        'id': r[0],
+        'mode': r[1],
+        'prompt': r[2],
+        'source_image_url': r[3],
+        'image_url': r[4],
+        'size': r[5],
+        'watermark': bool(r[6]),
+        # 缺失时间如实返回 null，不能用当前时间填充：否则该行的游标值每次请求都会变化，翻页时重复或漏掉
+        'created_at': r[7].strftime('%Y-%m-%d %H:%M:%S') if r[7] else None
+    }
+
+
+def _history_page_db(limit: int, cursor: tuple[str, str] | None, mode: str | None):
+    """键集分页：走 (created_at, id) / (mode, created_at, id) 索引，翻到第 N 页与第 1 页代价相同。"""
+    where = []
+    params: list = []
+    if mode:
+        where.append("mode = %s")
+        params.append(mode)
+    # created_at 为 NULL 的行在倒序中排在最后，游标中以空字符串表示（与文件存储的排序键一致）
+    if cursor and cursor[0]:
+        where.append("(created_at < %s OR (created_at = %s AND id < %s) OR created_at IS NULL)")
+        params.extend([cursor[0], cursor[0], cursor[1]])
+    elif cursor:
+        where.append("(created_at IS NULL AND id < %s)")
+        params.append(cursor[1])
+    sql = "SELECT id, mode, prompt, source_image_url, image_url, size, watermark, created_at FROM history_items"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT %s"
+    params.append(limit + 1)
+    with db_pool.connection('history_page') as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+    items = [_history_row_to_item(r) for r in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit and items:
+        next_cursor = (items[-1]['created_at'] or '', items[-1]['id'])
+    return items, next_cursor
+
+
+def _history_page(limit: int, cursor: tuple[str, str] | None, mode: str | None):
+    if DB_READY:
+        return _history_page_db(limit, cursor, mode)
+    return history_store.page(limit, cursor, mode)
+
+
 # 查询历史记录
 @app.route('/api/history', methods=['GET'])
 def history_list():
+    """历史记录，按时间倒序分页。
+    参数：limit（1~1000，默认 100）、cursor（上一页返回的 next_cursor）、mode（按模式过滤）
+    响应：success, items[], next_cursor（无更多数据时为 null）
+    """
     try:
-        limit = int(request.args.get('limit', '100'))
-        if DB_READY:
-            conn = _db_connect(DB_NAME)
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT id, mode, prompt, source_image_url, image_url, size, watermark, created_at FROM history_items ORDER BY created_at DESC LIMIT %s",
-                    (max(1, min(1000, limit)),),
-                )
-                rows = cur.fetchall()
-                items = []
-                for r in rows:
-                    items.append({
-                        'id': r[0],
-                        'mode': r[1],
-                        'prompt': r[2],
-                        'source_image_url': r[3],
-                        'image_url': r[4],
-                        'size': r[5],
-                        'watermark': bool(r[6]),
-                        'created_at': (r[7].strftime('%Y-%m-%d %H:%M:%S') if r[7] else datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
-                    })
-            return jsonify({'success': True, 'items': items})
-        items = _load_history()
-        items.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-        return jsonify({'success': True, 'items': items[:max(1, min(1000, limit))]})
+        limit = max(1, min(1000, int(request.args.get('limit', '100'))))
+        mode = request.args.get('mode') or None
+        try:
+            cursor = _decode_history_cursor(request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        items, next_key = _history_page(limit, cursor, mode)
+        return jsonify({'success': True, 'items': items, 'next_cursor': _encode_history_cursor(next_key)})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -437,6 +3642,80 @@ def delete_history_item(item_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+def _resolve_source_image(image_url: str) -> tuple[str, str | None]:
+    """把参考图地址转换为上游可用的 image 参数，返回 (source_image, error)。
+
+    Ark 图生图要求参数 image 为可公开访问的 URL。
+    若用户使用了本地上传（/uploads/xxx），尝试读取本地文件并以 data URL 形式传入。
+    注意：如果服务端不支持 data URL，将返回错误；此时需要使用公网可访问的图片 URL。
+    """
+    source_image = image_url
+    try:
+        if image_url and not (image_url.startswith('http://') or image_url.startswith('https://')):
+            # 仅处理本地上传到 /uploads 的情况
+            # 兼容以 "/uploads/" 或 "uploads/" 开头
+            rel = image_url[1:] if image_url.startswith('/') else image_url
+            if rel.startswith('uploads/'):
+                filename = rel.split('/', 1)[1]
+                if not _is_upload_name(filename):
+                    return image_url, '本地参考图不存在，请重新上传或填写公网URL'
+                path = os.path.join(UPLOAD_DIR, filename)
+                if not os.path.exists(path):
+                    return image_url, '本地参考图不存在，请重新上传或填写公网URL'
+                # 上传时已生成的 data URL（超过 10MB 时为压缩后的 JPEG），缺失时现场生成并保存
+                source_image = _reference_data_url(path, filename)
+    except Exception:
+        # 读取或编码失败，维持原始 URL，交由后续调用报错
+        source_image = image_url
+    return source_image, None
+
+
+def _build_history_entry(mode: str, prompt: str, size, watermark, image_url: str | None,
+                         result_url: str) -> dict:
+    entry = {
+        'id': str(uuid.uuid4()),
+        'mode': mode,
+        'prompt': prompt,
+        'image_url': result_url,
+        'size': size,
+        'watermark': bool(watermark),
+        'created_at': datetime.utcnow().isoformat()
+    }
+    if mode == 'image_to_image':
+        entry['source_image_url'] = image_url
+    return entry
+
+
+def _generate_and_record(mode: str, prompt: str, size, watermark,
+                         image_url: str | None = None, source_image: str | None = None,
+                         bypass_cache: bool = False) -> dict:
+    """调用生成接口，成功时写入历史记录；返回 safe_generate_image 的结果。"""
+    kwargs = {'size': size, 'response_format': "url", 'watermark': watermark}
+    if source_image:
+        kwargs['image'] = source_image
+    result = safe_generate_image(prompt=prompt, bypass_cache=bypass_cache, **kwargs)
+    if result['success']:
+        # 写入历史记录，并在后台把结果图镜像到本地
+        entry = _add_history_entry(_build_history_entry(mode, prompt, size, watermark, image_url, result['image_url']))
+        _mirror_history_entries([entry])
+    return result
+
+
+async def _generate_and_record_async(mode: str, prompt: str, size, watermark,
+                                     image_url: str | None = None, source_image: str | None = None,
+                                     bypass_cache: bool = False) -> dict:
+    """_generate_and_record 的协程版本：等待上游时不占线程，历史写入交给数据库线程池。"""
+    kwargs = {'size': size, 'response_format': "url", 'watermark': watermark}
+    if source_image:
+        kwargs['image'] = source_image
+    result = await safe_generate_image_async(prompt=prompt, bypass_cache=bypass_cache, **kwargs)
+    if result['success']:
+        entry = await _run_db(_add_history_entry,
+                              _build_history_entry(mode, prompt, size, watermark, image_url, result['image_url']))
+        _mirror_history_entries([entry])
+    return result
+
+
 @app.route('/api/generate/text-to-image', methods=['POST'])
 def text_to_image():
     """文生图API接口"""
@@ -449,24 +3728,10 @@ def text_to_image():
         if not prompt:
             return jsonify({'error': '缺少prompt参数'}), 400
 
-        result = safe_generate_image(
-            prompt=prompt,
-            size=size,
-            response_format="url",
-            watermark=watermark
-        )
+        result = _generate_and_record('text_to_image', prompt, size, watermark,
+                                      bypass_cache=bool(_request_flag(data, 'no_cache')))
 
         if result['success']:
-            # 写入历史记录
-            _add_history_entry({
-                'id': str(uuid.uuid4()),
-                'mode': 'text_to_image',
-                'prompt': prompt,
-                'image_url': result['image_url'],
-                'size': size,
-                'watermark': bool(watermark),
-                'created_at': datetime.utcnow().isoformat()
-            })
             return jsonify({
                 'success': True,
                 'image_url': result['image_url']
@@ -490,85 +3755,15 @@ def image_to_image():
 
         if not prompt or not image_url:
             return jsonify({'success': False, 'error': '缺少prompt或image_url参数'}), 400
-        # Ark 图生图要求参数 image 为可公开访问的 URL。
-        # 若用户使用了本地上传（/uploads/xxx），尝试读取本地文件并以 data URL 形式传入。
-        # 注意：如果服务端不支持 data URL，将返回错误；此时需要使用公网可访问的图片 URL。
-        source_image = image_url
-        try:
-            if image_url and not (image_url.startswith('http://') or image_url.startswith('https://')):
-                # 仅处理本地上传到 /uploads 的情况
-                # 兼容以 "/uploads/" 或 "uploads/" 开头
-                rel = image_url[1:] if image_url.startswith('/') else image_url
-                if rel.startswith('uploads/'):
-                    filename = rel.split('/', 1)[1]
-                    path = os.path.join(UPLOAD_DIR, filename)
-                    if not os.path.exists(path):
-                        return jsonify({'success': False, 'error': '本地参考图不存在，请重新上传或填写公网URL'}), 400
-                    # 若文件超过 10MB，自动压缩为 JPEG 并编码为 data URL
-                    try:
-                        size_bytes = os.path.getsize(path)
-                    except Exception:
-                        size_bytes = 0
-                    if size_bytes > (10 * 1024 * 1024):
-                        try:
-                            img = Image.open(path)
-                            # 去除透明通道并限制尺寸
-                            if img.mode not in ('RGB', 'L'):
-                                img = img.convert('RGB')
-                            max_dim = 2048
-                            w, h = img.size
-                            if max(w, h) > max_dim:
-                                img = img.copy()
-                                img.thumbnail((max_dim, max_dim), Image.LANCZOS)
-                            # 逐步降低质量直到 <=10MB
-                            for q in (85, 75, 65, 55, 45, 35):
-                                buf = io.BytesIO()
-                                img.save(buf, format='JPEG', quality=q, optimize=True)
-                                data = buf.getvalue()
-                                if len(data) <= (10 * 1024 * 1024) or q == 35:
-                                    b64 = base64.b64encode(data).decode('ascii')
-                                    source_image = f"data:image/jpeg;base64,{b64}"
-                                    break
-                        except Exception:
-                            # 压缩失败则回退到原始编码
-                            with open(path, 'rb') as f:
-                                b64 = base64.b64encode(f.read()).decode('ascii')
-                            source_image = f"data:image/jpeg;base64,{b64}"
-                    else:
-                        # 推测 MIME 类型，直接按原格式编码
-                        lower = filename.lower()
-                        mime = 'image/jpeg'
-                        if lower.endswith('.png'):
-                            mime = 'image/png'
-                        elif lower.endswith('.webp'):
-                            mime = 'image/webp'
-                        with open(path, 'rb') as f:
-                            b64 = base64.b64encode(f.read()).decode('ascii')
-                        source_image = f"data:{mime};base64,{b64}"
-        except Exception as _e:
-            # 读取或编码失败，维持原始 URL，交由后续调用报错
-            source_image = image_url
-
-        result = safe_generate_image(
-            prompt=prompt,
-            image=source_image,
-            size=size,
-            response_format="url",
-            watermark=watermark
-        )
+        source_image, error = _resolve_source_image(image_url)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+
+        result = _generate_and_record('image_to_image', prompt, size, watermark,
+                                      image_url=image_url, source_image=source_image,
+                                      bypass_cache=bool(_request_flag(data, 'no_cache')))
 
         if result['success']:
-            # 写入历史记录
-            _add_history_entry({
-                'id': str(uuid.uuid4()),
-                'mode': 'image_to_image',
-                'prompt': prompt,
-                'source_image_url': image_url,
-                'image_url': result['image_url'],
-                'size': size,
-                'watermark': bool(watermark),
-                'created_at': datetime.utcnow().isoformat()
-            })
             return jsonify({
                 'success': True,
                 'image_url': result['image_url']
@@ -580,39 +3775,589 @@ def image_to_image():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+GENERATE_BATCH_MAX_ITEMS = int(os.environ.get("GENERATE_BATCH_MAX_ITEMS", "20"))
+GENERATE_BATCH_CONCURRENCY = int(os.environ.get("GENERATE_BATCH_CONCURRENCY", "4"))
+
+
+def _prepare_batch(data: dict) -> tuple[list, list, int]:
+    """解析批量生成请求，返回 (tasks, results, concurrency)。
+    tasks 为待生成的 (index, item, source_image)；参数不合法的项已直接写入 results。
+    请求整体不合法时抛出 ValueError。"""
+    defaults = {
+        'size': data.get('size', '2K'),
+        'watermark': data.get('watermark', True),
+        'image_url': data.get('image_url'),
+        'no_cache': data.get('no_cache', False),
+    }
+    raw_items = data.get('items')
+    if raw_items is None:
+        raw_items = [{'prompt': p} for p in (data.get('prompts') or [])]
+    if not isinstance(raw_items, list) or not raw_items:
+        raise ValueError('缺少items或prompts参数')
+    if len(raw_items) > GENERATE_BATCH_MAX_ITEMS:
+        raise ValueError(f'单次最多提交 {GENERATE_BATCH_MAX_ITEMS} 项')
+
+    concurrency = GENERATE_BATCH_CONCURRENCY
+    try:
+        req_concurrency = int(data.get('concurrency') or 0)
+    except (TypeError, ValueError):
+        req_concurrency = 0
+    if req_concurrency > 0:
+        concurrency = min(concurrency, req_concurrency)
+
+    # 同一参考图只读取、编码一次，由所有引用它的项共享
+    sources: dict[str, tuple[str, str | None]] = {}
+    tasks = []
+    results: list[dict | None] = [None] * len(raw_items)
+    for i, raw in enumerate(raw_items):
+        item = {**defaults, **(raw if isinstance(raw, dict) else {'prompt': raw})}
+        if not item.get('prompt'):
+            results[i] = {'index': i, 'success': False, 'error': '缺少prompt参数'}
+            continue
+        image_url = item.get('image_url')
+        source_image = None
+        if image_url:
+            if image_url not in sources:
+                sources[image_url] = _resolve_source_image(image_url)
+            source_image, error = sources[image_url]
+            if error:
+                results[i] = {'index': i, 'success': False, 'error': error}
+                continue
+        tasks.append((i, item, source_image))
+    return tasks, results, concurrency
+
+
+def _batch_generate_kwargs(item: dict, source_image: str | None) -> dict:
+    kwargs = {'size': item['size'], 'response_format': "url", 'watermark': item['watermark']}
+    if source_image:
+        kwargs['image'] = source_image
+    return kwargs
+
+
+def _collect_batch_results(tasks: list, outcomes: list[dict], results: list) -> list[dict]:
+    """把生成结果按原序号写入 results，返回成功项对应的历史记录。"""
+    entries = []
+    for (i, item, _), result in zip(tasks, outcomes):
+        if result['success']:
+            mode = 'image_to_image' if item.get('image_url') else 'text_to_image'
+            entries.append(_build_history_entry(
+                mode, item['prompt'], item['size'], item['watermark'],
+                item.get('image_url'), result['image_url']))
+            results[i] = {'index': i, 'success': True, 'image_url': result['image_url']}
+        else:
+            results[i] = {'index': i, 'success': False, 'error': result['error']}
+    return entries
+
+
+def _batch_response(results: list[dict]) -> dict:
+    return {
+        'success': True,
+        'results': results,
+        'succeeded': sum(1 for r in results if r['success']),
+        'failed': sum(1 for r in results if not r['success']),
+    }
+
+
+@app.route('/api/generate/batch', methods=['POST'])
+def generate_batch():
+    """批量生成API接口
+    请求：{"items": [{"prompt", "size", "watermark", "image_url"}...], "concurrency"}
+         或 {"prompts": [...], "size", "watermark", "image_url"}（共享参数）
+    items 中缺省的 size / watermark / image_url 取顶层同名字段。
+    响应：success, results[]（与请求顺序一致，每项含 success 与 image_url 或 error）
+    """
+    try:
+        data = request.get_json() or {}
+        try:
+            tasks, results, concurrency = _prepare_batch(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        def run(task):
+            _, item, source_image = task
+            return safe_generate_image(prompt=item['prompt'], bypass_cache=_flag_value(item.get('no_cache')),
+                                       **_batch_generate_kwargs(item, source_image))
+
+        outcomes = []
+        if tasks:
+            with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(tasks)))) as executor:
+                outcomes = list(executor.map(run, tasks))
+        entries = _collect_batch_results(tasks, outcomes, results)
+        # 所有成功项的历史记录一次批量写入
+        _add_history_entries(entries)
+        _mirror_history_entries(entries)
+
+        return jsonify(_batch_response(results))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+# ===== 异步生成任务 =====
+# 生成请求立即返回 job_id，由有界线程池等待上游返回；客户端轮询或通过 SSE 获取状态。
+# 任务记录写入 HISTORY_DIR 下的 SQLite，多个 gunicorn worker 共享：轮询与 SSE 可落到任意 worker，
+# 执行任务的 worker 在状态变化时更新记录，其余 worker 读取该记录。
+GENERATE_JOB_WORKERS = int(os.environ.get("GENERATE_JOB_WORKERS", "16"))
+GENERATE_JOB_MAX_PENDING = int(os.environ.get("GENERATE_JOB_MAX_PENDING", "256"))
+GENERATE_JOB_TTL = float(os.environ.get("GENERATE_JOB_TTL", "600"))
+GENERATE_JOB_DB_PATH = os.environ.get("GENERATE_JOB_DB_PATH", os.path.join(HISTORY_DIR, 'jobs.sqlite3'))
+# 等待其他 worker 上的任务时读取任务记录的间隔（秒）
+GENERATE_JOB_POLL_INTERVAL = float(os.environ.get("GENERATE_JOB_POLL_INTERVAL", "0.5"))
+SSE_HEARTBEAT_INTERVAL = 15.0
+# 同步（Flask）SSE 不在连接上等待任务结束：发送当前状态后即关闭，由 EventSource 按该间隔（毫秒）自动重连，
+# 不占用 worker 线程；需要长连接推送时使用 asgi.py 入口
+SSE_RETRY_MS = int(os.environ.get("SSE_RETRY_MS", "1000"))
+
+_JOB_TERMINAL = ('succeeded', 'failed')
+# 未结束的任务超过该时长仍无状态更新，视为执行它的进程已退出，按过期处理
+_JOB_STALE_AFTER = 3600.0
+
+
+class _JobStore:
+    """生成任务表：有界并发执行、状态变更通知与完成后按 TTL 过期。
+    本进程提交的任务同时保存在内存中（在途计数与通知），状态写入共享的 SQLite 供其他进程读取。"""
+
+    def __init__(self, workers: int, max_pending: int, ttl: float, path: str, poll_interval: float):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.path = path
+        self.poll_interval = max(0.05, poll_interval)
+        self._jobs: dict[str, dict] = {}
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        # 协程等待者：job_id -> [(事件循环, asyncio.Event)]
+        self._async_waiters: dict[str, list] = {}
+        self._tasks: set = set()
+        self._executor = None
+        self._pid = None
+        self._active = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.errors = 0
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='generate-job')
+            self._pid = os.getpid()
+        return self._executor
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS generate_jobs ("
+                " id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, result TEXT, error TEXT,"
+                " version INTEGER NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL, finished_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_generate_jobs_updated ON generate_jobs (updated_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _persist(self, job: dict):
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO generate_jobs"
+                " (id, kind, status, result, error, version, created_at, updated_at, finished_at)"
+                " VALUES (?,?,?,?,?,?,?,?,?)",
+                (job['id'], job['kind'], job['status'],
+                 json.dumps(job['result'], ensure_ascii=False) if job['result'] else None,
+                 job['error'], job['version'], job['created_at'], time.time(), job['finished_at']),
+            )
+        except sqlite3.Error:
+            with self._cond:
+                self.errors += 1
+
+    def _load(self, job_id: str) -> dict | None:
+        """读取共享任务记录（其他进程提交的任务），已过期时返回 None。"""
+        try:
+            row = self._conn().execute(
+                "SELECT id, kind, status, result, error, version, updated_at, finished_at"
+                " FROM generate_jobs WHERE id=?", (job_id,)).fetchone()
+        except sqlite3.Error:
+            with self._cond:
+                self.errors += 1
+            return None
+        if row is None:
+            return None
+        now = time.time()
+        if row[2] in _JOB_TERMINAL and now - row[7] > self.ttl:
+            return None
+        if row[2] not in _JOB_TERMINAL and now - row[6] > _JOB_STALE_AFTER:
+            return None
+        return {'id': row[0], 'kind': row[1], 'status': row[2], 'result': json.loads(row[3]) if row[3] else None,
+                'error': row[4], 'version': row[5], 'finished_at': row[7]}
+
+    def _get(self, job_id: str) -> dict | None:
+        """本进程的任务直接取内存中的副本，否则读取共享记录。"""
+        with self._cond:
+            self._purge()
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        return self._load(job_id)
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [k for k, j in self._jobs.items()
+                       if j['status'] in _JOB_TERMINAL and now - j['finished_at'] > self.ttl]:
+            del self._jobs[job_id]
+            self.expired += 1
+
+    def _purge_shared(self):
+        now = time.time()
+        try:
+            self._conn().execute(
+                "DELETE FROM generate_jobs WHERE (finished_at IS NOT NULL AND finished_at < ?) OR updated_at < ?",
+                (now - self.ttl, now - max(self.ttl, _JOB_STALE_AFTER)),
+            )
+        except sqlite3.Error:
+            with self._cond:
+                self.errors += 1
+
+    def _create(self, kind: str) -> dict | None:
+        with self._cond:
+            self._purge()
+            if self._active >= self.max_pending:
+                self.rejected += 1
+                return None
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'status': 'queued',
+                'created_at': time.time(),
+                'finished_at': None,
+                'result': None,
+                'error': None,
+                'version': 0,
+            }
+            self._jobs[job['id']] = job
+            self._active += 1
+            self.submitted += 1
+            record = dict(job)
+        self._purge_shared()
+        # 先写入共享记录再开始执行，返回 job_id 后任意 worker 均可查询
+        self._persist(record)
+        return job
+
+    def submit(self, kind: str, fn, *args, **kwargs) -> dict | None:
+        """提交任务；在途任务数已满时返回 None。"""
+        job = self._create(kind)
+        if job is None:
+            return None
+        with self._cond:
+            executor = self._get_executor()
+        executor.submit(self._run, job['id'], fn, args, kwargs)
+        return self.snapshot(job['id'])
+
+    def submit_async(self, kind: str, fn, *args, **kwargs) -> dict | None:
+        """在事件循环中提交任务：fn 为协程函数，以 asyncio 任务运行，不占用线程池；
+        与 submit 共用在途上限与任务表。"""
+        job = self._create(kind)
+        if job is None:
+            return None
+        task = asyncio.get_running_loop().create_task(self._run_async(job['id'], fn, args, kwargs))
+        # 持有任务引用，避免执行中被垃圾回收
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return self.snapshot(job['id'])
+
+    def _update(self, job_id: str, **fields):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            job['version'] += 1
+            if job['status'] in _JOB_TERMINAL:
+                job['finished_at'] = time.time()
+                self._active -= 1
+            record = dict(job)
+        # 同一任务的状态更新只来自执行它的线程 / 协程，先后顺序不会交错
+        self._persist(record)
+        with self._cond:
+            self._cond.notify_all()
+            for loop, event in self._async_waiters.get(job_id, ()):
+                loop.call_soon_threadsafe(event.set)
+
+    def _run(self, job_id: str, fn, args, kwargs):
+        self._update(job_id, status='running')
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._update(job_id, status='failed', error=str(e))
+            return
+        self._finish(job_id, result)
+
+    async def _run_async(self, job_id: str, fn, args, kwargs):
+        self._update(job_id, status='running')
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            # 如事件循环关闭：任务必须进入终态，否则在途计数永远不会归还
+            self._update(job_id, status='failed', error='任务已取消')
+            raise
+        except Exception as e:
+            self._update(job_id, status='failed', error=str(e))
+            return
+        self._finish(job_id, result)
+
+    def _finish(self, job_id: str, result: dict):
+        if result.get('success'):
+            self._update(job_id, status='succeeded', result={'image_url': result['image_url']})
+        else:
+            self._update(job_id, status='failed', error=result.get('error'))
+
+    @staticmethod
+    def _public(job: dict) -> dict:
+        out = {'job_id': job['id'], 'kind': job['kind'], 'status': job['status']}
+        if job['result']:
+            out.update(job['result'])
+        if job['error']:
+            out['error'] = job['error']
+        return out
+
+    def snapshot(self, job_id: str) -> dict | None:
+        job = self._get(job_id)
+        return self._public(job) if job else None
+
+    def versioned(self, job_id: str) -> tuple[dict | None, int]:
+        """返回 (快照, 版本号)；任务不存在时快照为 None。"""
+        job = self._get(job_id)
+        if job is None:
+            return None, -1
+        return self._public(job), job['version']
+
+    async def wait_for_change_async(self, job_id: str, version: int, timeout: float) -> tuple[dict | None, int]:
+        """等待任务状态版本号变化，返回 (快照, 版本号)；等待期间不占用线程。
+        本进程的任务由状态更新直接唤醒，其他进程的任务按 poll_interval 读取共享记录。"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                if job['version'] != version:
+                    return self._public(job), job['version']
+                self._async_waiters.setdefault(job_id, []).append(waiter)
+        if job is None:
+            return await self._poll_async(job_id, version, timeout)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                waiters = self._async_waiters.get(job_id, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._async_waiters.pop(job_id, None)
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None, version
+            return self._public(job), job['version']
+
+    async def _poll_async(self, job_id: str, version: int, timeout: float) -> tuple[dict | None, int]:
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await _run_db(self._load, job_id)
+            if job is None:
+                return None, version
+            remaining = deadline - time.monotonic()
+            if job['version'] != version or remaining <= 0:
+                return self._public(job), job['version']
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+    def stats(self) -> dict:
+        with self._cond:
+            counts: dict[str, int] = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return {
+                'workers': self.workers,
+                'active': self._active,
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'expired': self.expired,
+                'errors': self.errors,
+                'by_status': counts,
+            }
+
+
+generate_jobs = _JobStore(GENERATE_JOB_WORKERS, GENERATE_JOB_MAX_PENDING, GENERATE_JOB_TTL,
+                          GENERATE_JOB_DB_PATH, GENERATE_JOB_POLL_INTERVAL)
+
+
+def _job_accepted(job: dict | None):
+    if job is None:
+        return jsonify({'success': False, 'error': '任务队列已满，请稍后重试'}), 429
+    return jsonify({'success': True, **job}), 202
+
+
+@app.route('/api/jobs/text-to-image', methods=['POST'])
+def submit_text_to_image_job():
+    """异步文生图：立即返回 job_id，参数同 /api/generate/text-to-image"""
+    try:
+        data = request.get_json() or {}
+        prompt = data.get('prompt')
+        size = data.get('size', '2K')
+        watermark = data.get('watermark', True)
+        if not prompt:
+            return jsonify({'success': False, 'error': '缺少prompt参数'}), 400
+        return _job_accepted(generate_jobs.submit(
+            'text_to_image', _generate_and_record, 'text_to_image', prompt, size, watermark,
+            bypass_cache=bool(_request_flag(data, 'no_cache'))))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/jobs/image-to-image', methods=['POST'])
+def submit_image_to_image_job():
+    """异步图文生图：立即返回 job_id，参数同 /api/generate/image-to-image"""
+    try:
+        data = request.get_json() or {}
+        prompt = data.get('prompt')
+        image_url = data.get('image_url')
+        size = data.get('size', '2K')
+        watermark = data.get('watermark', True)
+        if not prompt or not image_url:
+            return jsonify({'success': False, 'error': '缺少prompt或image_url参数'}), 400
+        source_image, error = _resolve_source_image(image_url)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        return _job_accepted(generate_jobs.submit(
+            'image_to_image', _generate_and_record, 'image_to_image', prompt, size, watermark,
+            image_url=image_url, source_image=source_image, bypass_cache=bool(_request_flag(data, 'no_cache'))))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """轮询任务状态：queued / running / succeeded / failed"""
+    job = generate_jobs.snapshot(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': '任务不存在或已过期'}), 404
+    return jsonify({'success': True, **job})
+
+
+def _sse(event: str, payload: dict, event_id: int | None = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ''
+    return f"{head}event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _last_event_version(value: str | None) -> int:
+    """EventSource 重连时带回的 Last-Event-ID 即上次收到的任务版本号。"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job(job_id):
+    """以 Server-Sent Events 返回任务状态。同步部署下不在连接上等待：
+    发送当前状态（与上次相同时不发送）后关闭，EventSource 按 retry 间隔自动重连；
+    任务已结束且客户端已收到终态时返回 204，EventSource 收到后不再重连。"""
+    snap, version = generate_jobs.versioned(job_id)
+    if snap is None:
+        return jsonify({'success': False, 'error': '任务不存在或已过期'}), 404
+    seen = _last_event_version(request.headers.get('Last-Event-ID'))
+    if version == seen and snap['status'] in _JOB_TERMINAL:
+        return Response(status=204)
+    body = f"retry: {SSE_RETRY_MS}\n\n"
+    if version != seen:
+        body += _sse('status', snap, version)
+    return Response(body, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @app.route('/api/select/best-image', methods=['POST'])
 def select_best_image():
     """批量上传图片，评估质量后选出最佳一张返回（base64）。
     请求：multipart/form-data，字段名为 images，可多文件。
     响应：success, best_index, scores[], best_image_b64, format
+    开启近似重复聚类（dedup=1）时另返回 dedup, cluster_ids[], clusters[]，
+    未参与完整评分的图片在 scores 中为 null。
     """
     try:
         files = request.files.getlist('images')
         if not files:
             return jsonify({'success': False, 'error': '请上传至少一张图片'}), 400
 
+        dedup = SELECT_DEDUP
+        if 'dedup' in request.form:
+            dedup = request.form.get('dedup') in ('1', 'true')
+        max_count = SELECT_DEDUP_MAX_COUNT if dedup else SELECT_MAX_COUNT
+        concurrency = SCORE_MAX_CONCURRENCY
+        try:
+            req_concurrency = int(request.form.get('concurrency', '0'))
+        except ValueError:
+            req_concurrency = 0
+        if req_concurrency > 0:
+            concurrency = min(concurrency, req_concurrency) if concurrency > 0 else req_concurrency
+
+        streaming = SELECT_STREAMING
+        if 'streaming' in request.form:
+            streaming = request.form.get('streaming') in ('1', 'true')
+        # 流式模式每轮最多读入与并行度相当的文件数，读完即释放
+        window = max_count
+        if streaming:
+            window = max(1, concurrency if concurrency > 0 else SCORE_WORKERS)
+        elif dedup:
+            # 聚类模式的上限较大，仍按原上限分窗读取，避免一次持有全部上传字节
+            window = SELECT_MAX_COUNT
+
+        if dedup:
+            picked = _select_best_deduplicated(files, max_count, window, concurrency, streaming)
+            if picked is None:
+                return jsonify({'success': False, 'error': '未能解析任何有效图片'}), 400
+            with _timed('image', 'decode'):
+                best_img = Image.open(io.BytesIO(picked['best_blob'])).convert('RGB')
+            return jsonify({
+                'success': True,
+                'best_index': picked['best_index'],
+                'scores': picked['scores'],
+                'best_image_b64': _encode_image_b64(best_img, fmt='JPEG'),
+                'format': 'jpeg',
+                'dedup': True,
+                'cluster_ids': picked['cluster_ids'],
+                'clusters': picked['clusters'],
+            })
+
+        # 按上传顺序分轮评分：每轮只补足尚缺的有效图片数，
+        # 与逐张处理时“跳过无法解析的文件、最多取 max_count 张”的语义一致。
+        # 仅保留当前最佳图片的原始字节，最终只完整解码胜出者。
         scores = []
-        pil_images = []
-        max_count = 20
-        count = 0
-        for f in files:
-            if count >= max_count:
-                break
-            try:
-                img = Image.open(f.stream).convert('RGB')
-                pil_images.append(img)
-                score = _compute_quality_score(img)
+        best_index = -1
+        best_blob = None
+        pending = list(files)
+        while pending and len(scores) < max_count:
+            need = min(max_count - len(scores), window)
+            batch, pending = pending[:need], pending[need:]
+            blobs = [f.read() for f in batch]
+            for data, score in zip(blobs, _score_many_cached(blobs, concurrency, reduced=streaming)):
+                if score is None:
+                    # 跳过无法解析的文件
+                    continue
+                # 严格大于：与 np.argmax 取首个最大值一致
+                if best_blob is None or score > scores[best_index]:
+                    best_index = len(scores)
+                    best_blob = data
                 scores.append(score)
-                count += 1
-            except Exception:
-                # 跳过无法解析的文件
-                continue
+            del blobs
 
         if not scores:
             return jsonify({'success': False, 'error': '未能解析任何有效图片'}), 400
 
-        best_index = int(np.argmax(np.array(scores)))
-        best_img = pil_images[best_index]
+        with _timed('image', 'decode'):
+            best_img = Image.open(io.BytesIO(best_blob)).convert('RGB')
         best_b64 = _encode_image_b64(best_img, fmt='JPEG')
 
         return jsonify({
@@ -626,25 +4371,59 @@ def select_best_image():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/stats', methods=['GET'])
+def service_stats():
+    """运行时统计信息（缓存命中率等），便于观测性能"""
+    return jsonify({
+        'success': True,
+        'score_cache': score_cache.stats(),
+        'db_pool': db_pool.stats(),
+        'db_init': db_bootstrap.stats(),
+        'history_file': history_store.stats(),
+        'history_write_behind': history_writer.stats(),
+        'generate_jobs': generate_jobs.stats(),
+        'generate_single_flight': generate_flight.stats(),
+        'generate_cache': generate_cache.stats(),
+        'uploads': upload_store.stats(),
+        'eval_cache': eval_cache.stats(),
+        'upstream': {'ark': ark_upstream.stats(), 'modelscope': ms_upstream.stats()},
+        'thumbnails': thumb_cache.stats(),
+        'image_mirror': image_mirror.stats(),
+        'static_manifest': {'video': len(video_manifest), 'uploads': len(upload_manifest),
+                            'generated': len(mirror_manifest)},
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文本格式的延迟直方图与计数器，另附连接池、队列与熔断状态等即时值"""
+    if not METRICS_ENABLED:
+        return jsonify({'success': False, 'error': 'metrics disabled'}), 404
+    pool = db_pool.stats()
+    jobs = generate_jobs.stats()
+    gauges = [
+        ('db_pool_connections', (('state', 'in_use'),), pool['in_use']),
+        ('db_pool_connections', (('state', 'idle'),), pool['idle']),
+        ('history_write_queue_depth', (), history_writer.stats()['queue_depth']),
+        ('generate_jobs_active', (), jobs['active']),
+    ]
+    for upstream in (ark_upstream, ms_upstream):
+        gauges.append(('upstream_breaker_open', (('upstream', upstream.label),),
+                       0 if upstream.breaker.stats()['state'] == 'closed' else 1))
+    for name, cache in (('score', score_cache), ('eval', eval_cache), ('thumbnail', thumb_cache)):
+        st = cache.stats()
+        gauges.append(('cache_hits_total', (('cache', name),), st.get('hits', 0)))
+        gauges.append(('cache_misses_total', (('cache', name),), st.get('misses', 0)))
+    return Response(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/video/<path:filename>')
 def serve_video(filename):
     """静态视频文件服务，支持中文文件名"""
     try:
-        # 确保文件名正确解码
-        import urllib.parse
-        decoded_filename = urllib.parse.unquote(filename, encoding='utf-8')
-        
-        # 检查文件是否存在
-        video_path = os.path.join(app.root_path, 'video', decoded_filename)
-        if not os.path.exists(video_path):
-            return jsonify({'error': 'Video file not found'}), 404
-            
-        return send_from_directory(
-            os.path.join(app.root_path, 'video'), 
-            decoded_filename,
-            as_attachment=False,
-            mimetype='video/mp4'
-        )
+        # 路由参数已解码；兼容客户端重复编码的文件名
+        rel = filename if video_manifest.lookup(filename) else urllib.parse.unquote(filename, encoding='utf-8')
+        return _send_static(video_manifest, rel, mimetype='video/mp4', not_found='Video file not found')
     except Exception as e:
         return jsonify({'error': f'Error serving video: {str(e)}'}), 500
 
@@ -0,0 +1,665 @@
+"""ASGI 入口：等待上游的接口以协程处理，其余接口交给 Flask 应用在线程池中执行。
+
+    gunicorn -k asgi -w 2 --worker-connections 1000 --bind 0.0.0.0:5000 asgi:app
+
+协程处理的接口：文生图 / 图文生图 / 批量生成、照片评估（含 SSE）、异步任务的提交、查询与状态推送、
+历史记录分页与删除。上游调用使用 AsyncArk / AsyncOpenAI（每个 worker 一个客户端，共享 keep-alive 连接池），
+与同步入口共用限流、熔断、请求合并与各类缓存；数据库与历史文件操作在与连接池等大的线程池中执行。
+页面、上传、静态文件、图片优选与统计等接口仍由 Flask 处理，行为与 app:app 完全一致；
+转交的请求体不预先缓冲，Flask 读取时才从连接上接收。
+"""
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import ClientDisconnected, HTTPException, RequestEntityTooLarge
+from werkzeug.routing import Map, Rule
+from werkzeug.wrappers import Request
+from werkzeug.wsgi import FileWrapper
+
+import app as core
+
+# 转交 Flask 的请求与阻塞的 CPU / 文件操作共用的线程数
+ASGI_OFFLOAD_THREADS = int(os.environ.get("ASGI_OFFLOAD_THREADS", "32"))
+# 请求体上限（默认与上传接口相同），Content-Length 超限时不读取请求体直接返回 413，
+# 分块传输时读到超限即中止；图片优选一次提交多张图片，单独设置上限
+ASGI_MAX_BODY_BYTES = int(os.environ.get("ASGI_MAX_BODY_BYTES",
+                                         str(core.UPLOAD_MAX_BYTES + core._MULTIPART_OVERHEAD)))
+ASGI_SELECT_MAX_BODY_BYTES = int(os.environ.get("ASGI_SELECT_MAX_BODY_BYTES", str(512 * 1024 * 1024)))
+_BODY_LIMITS = {
+    '/api/upload': core.UPLOAD_MAX_BYTES + core._MULTIPART_OVERHEAD,
+    '/api/select/best-image': ASGI_SELECT_MAX_BODY_BYTES,
+}
+# 协程接口的请求体超过 1MB 时落到临时文件
+ASGI_SPOOL_BYTES = 1024 * 1024
+# 转交 Flask 的文件响应（视频、上传图片）每次读取的块大小
+ASGI_FILE_CHUNK = 256 * 1024
+
+_offload_executor = None
+_offload_pid = None
+_offload_lock = threading.Lock()
+
+
+def _get_offload_executor() -> ThreadPoolExecutor:
+    global _offload_executor, _offload_pid
+    with _offload_lock:
+        if _offload_executor is None or _offload_pid != os.getpid():
+            _offload_executor = ThreadPoolExecutor(max_workers=max(1, ASGI_OFFLOAD_THREADS),
+                                                   thread_name_prefix='asgi-offload')
+            _offload_pid = os.getpid()
+        return _offload_executor
+
+
+async def _offload(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_offload_executor(), fn, *args)
+
+
+# ===== 请求与响应 =====
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class _ClientDisconnected(Exception):
+    pass
+
+
+def _content_length(scope: dict) -> int | None:
+    for name, value in scope.get('headers', []):
+        if name == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+async def _read_body(receive, limit: int):
+    """读完请求体（协程接口使用），返回 (文件对象, 字节数)。"""
+    body = tempfile.SpooledTemporaryFile(max_size=ASGI_SPOOL_BYTES)
+    size = 0
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise _ClientDisconnected()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > limit:
+                raise _BodyTooLarge()
+            if chunk:
+                body.write(chunk)
+            if not message.get('more_body'):
+                break
+    except BaseException:
+        body.close()
+        raise
+    body.seek(0)
+    return body, size
+
+
+class _ReceiveStream:
+    """转交 Flask 的 wsgi.input：Flask 在线程池中读取时才从事件循环拉取下一块请求体，
+    不预先缓冲；上传接口因此能在收到文件头时就拒绝，而不必先收完整个请求。"""
+
+    def __init__(self, receive, loop: asyncio.AbstractEventLoop, limit: int):
+        self._receive = receive
+        self._loop = loop
+        self._limit = limit
+        self._buffer = bytearray()
+        self._received = 0
+        self._done = False
+
+    def _pull(self) -> bool:
+        if self._done:
+            return False
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._done = True
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        self._received += len(chunk)
+        if self._received > self._limit:
+            self._done = True
+            raise RequestEntityTooLarge()
+        self._buffer += chunk
+        if not message.get('more_body'):
+            self._done = True
+        return True
+
+    def _take(self, size: int) -> bytes:
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            while self._pull():
+                pass
+            return self._take(len(self._buffer))
+        while not self._buffer and self._pull():
+            pass
+        return self._take(size)
+
+    def readline(self, size: int = -1) -> bytes:
+        while b'\n' not in self._buffer and (size < 0 or len(self._buffer) < size) and self._pull():
+            pass
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self._take(end if size < 0 else min(end, size))
+
+    def readlines(self, hint: int = -1) -> list[bytes]:
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def _wsgi_environ(scope: dict, body, length: int | None) -> dict:
+    """length 为 None 时沿用请求头中的 Content-Length；没有该请求头（分块传输）时读到结束为止。"""
+    server = scope.get('server') or ('localhost', None)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': lambda f, buffer_size=8192: FileWrapper(f, max(buffer_size, ASGI_FILE_CHUNK)),
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            if length is None:
+                environ[name] = value
+            continue
+        if name != 'CONTENT_TYPE':
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    if length is not None:
+        environ['CONTENT_LENGTH'] = str(length)
+    elif 'CONTENT_LENGTH' not in environ:
+        environ['wsgi.input_terminated'] = True
+    return environ
+
+
+class _Response:
+    """协程接口的响应：固定响应体，或 stream 给出的异步文本片段（SSE）。"""
+
+    def __init__(self, body: bytes = b'', status: int = 200, content_type: str = 'application/json',
+                 headers: dict | None = None, stream=None):
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.stream = stream
+
+    async def send(self, send):
+        headers = [(b'content-type', self.content_type.encode('latin-1'))]
+        headers.extend((k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in self.headers.items())
+        if self.stream is None:
+            headers.append((b'content-length', str(len(self.body)).encode('ascii')))
+            await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': self.body})
+            return
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        try:
+            async for piece in self.stream:
+                await send({'type': 'http.response.body', 'body': piece.encode('utf-8'), 'more_body': True})
+        finally:
+            await self.stream.aclose()
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def _json(payload: dict, status: int = 200) -> _Response:
+    # 与 Flask jsonify 使用同一 JSON 配置
+    return _Response((core.app.json.dumps(payload) + '\n').encode('utf-8'), status)
+
+
+def _too_large(limit: int) -> _Response:
+    return _json({'success': False, 'error': f'请求体过大，最大支持 {limit // (1024 * 1024)}MB'}, 413)
+
+
+def _event_stream(events) -> _Response:
+    return _Response(stream=events, content_type='text/event-stream; charset=utf-8', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+# ===== 生成接口 =====
+
+async def text_to_image(req: Request) -> _Response:
+    """文生图API接口"""
+    try:
+        data = req.get_json()
+        prompt = data.get('prompt')
+        size = data.get('size', '2K')
+        watermark = data.get('watermark', True)
+
+        if not prompt:
+            return _json({'error': '缺少prompt参数'}, 400)
+
+        result = await core._generate_and_record_async('text_to_image', prompt, size, watermark,
+                                                       bypass_cache=bool(core._request_flag(data, 'no_cache', req)))
+        if result['success']:
+            return _json({'success': True, 'image_url': result['image_url']})
+        return _json({'success': False, 'error': result['error']}, 400)
+    except Exception as e:
+        return _json({'success': False, 'error': str(e)}, 500)
+
+
+async def image_to_image(req: Request) -> _Response:
+    """图文生图API接口"""
+    try:
+        data = req.get_json()
+        prompt = data.get('prompt')
+        image_url = data.get('image_url')
+        size = data.get('size', '2K')
+        watermark = data.get('watermark', True)
+
+        if not prompt or not image_url:
+            return _json({'success': False, 'error': '缺少prompt或image_url参数'}, 400)
+        # 本地参考图需要读文件并编码，放到线程池
+        source_image, error = await _offload(core._resolve_source_image, image_url)
+        if error:
+            return _json({'success': False, 'error': error}, 400)
+
+        result = await core._generate_and_record_async('image_to_image', prompt, size, watermark,
+                                                       image_url=image_url, source_image=source_image,
+                                                       bypass_cache=bool(core._request_flag(data, 'no_cache', req)))
+        if result['success']:
+            return _json({'success': True, 'image_url': result['image_url']})
+        return _json({'success': False, 'error': result['error']}, 400)
+    except Exception as e:
+        return _json({'success': False, 'error': str(e)}, 500)
+
+
+async def generate_batch(req: Request) -> _Response:
+    """批量生成API接口，参数与响应同 app.generate_batch；每个请求内的并发数受 concurrency 限制"""
+    try:
+        data = req.get_json() or {}
+        try:
+            tasks, results, concurrency = await _offload(core._prepare_batch, data)
+        except ValueError as e:
+            return _json({'success': False, 'error': str(e)}, 400)
+
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(task):
+            _, item, source_image = task
+            async with semaphore:
+                return await core.safe_generate_image_async(
+                    prompt=item['prompt'], bypass_cache=core._flag_value(item.get('no_cache')),
+                    **core._batch_generate_kwargs(item, source_image))
+
+        outcomes = await asyncio.gather(*(run(task) for task in tasks))
+        entries = core._collect_batch_results(tasks, outcomes, results)
+        # 所有成功项的历史记录一次批量写入
+        await core._run_db(core._add_history_entries, entries)
+        core._mirror_history_entries(entries)
+        return _json(core._batch_response(results))
+    except Exception as e:
+        return _json({'success': False, 'error': str(e)}, 500)
+
+
+# ===== 照片评估 =====
+
+def _upload_digest(upload) -> str:
+    digest = 'file:' + hashlib.sha256(upload.stream.read()).hexdigest()
+    upload.stream.seek(0)
+    return digest
+
+
+async def _stream_evaluation(image_url: str, prompt_text: str, cache_key: str | None):
+    """以 SSE 转发模型的增量输出，事件格式同 app._stream_evaluation。"""
+    parts = []
+    start = time.monotonic()
+    stream = None
+    try:
+        stream = await core.ms_upstream.call_async(
+            core.async_ms_client.chat.completions.create,
+            model=core.EVALUATE_MODEL,
+            messages=core._evaluate_messages(image_url, prompt_text),
+            stream=True,
+        )
+        async for chunk in stream:
+            piece = core._chunk_text(chunk)
+            if piece:
+                parts.append(piece)
+                yield core._sse('delta', {'text': piece})
+    except Exception as e:
+        yield core._sse('error', {'success': False, 'error': str(e)})
+        return
+    finally:
+        # 客户端中途断开时及时归还上游连接
+        if stream is not None:
+            await stream.close()
+    text = ''.join(parts).strip()
+    if not text:
+        yield core._sse('error', {'success': False, 'error': 'AI未返回有效内容'})
+        return
+    if cache_key:
+        await _offload(core.eval_cache.put, cache_key, text, time.monotonic() - start)
+    await core._run_db(core._record_evaluation, image_url, prompt_text)
+    yield core._sse('done', {'success': True, 'evaluation': text})
+
+
+async def evaluate_photo(req: Request) -> _Response:
+    """照片评估，参数与响应同 app.evaluate_photo"""
+    try:
+        image_url = None
+        upload = None
+        data = {}
+        if req.content_type and 'application/json' in req.content_type:
+            data = req.get_json() or {}
+            image_url = data.get('image_url')
+            image_digest = await _offload(core._image_url_digest, image_url or '')
+        else:
+            # 解析 multipart 表单并对文件做哈希，均在线程池中完成
+            files = await _offload(lambda: req.files)
+            if 'file' not in files:
+                return _json({'success': False, 'error': '请上传图片或提供image_url'}, 400)
+            upload = files['file']
+            image_digest = await _offload(_upload_digest, upload)
+
+        prompt_text = core.EVALUATE_PROMPT
+        bypass = core._request_flag(data, 'no_cache', req)
+        cache_key = None if bypass else core.eval_cache.make_key(image_digest, prompt_text, core.EVALUATE_MODEL)
+        cached = await _offload(core.eval_cache.get, cache_key) if cache_key else None
+        streaming = core._wants_event_stream(data, req)
+
+        if cached:
+            await core._run_db(core._record_evaluation, image_url, prompt_text)
+            if streaming:
+                async def replay():
+                    yield core._sse('delta', {'text': cached})
+                    yield core._sse('done', {'success': True, 'evaluation': cached, 'cached': True})
+                return _Response(stream=replay(), content_type='text/event-stream; charset=utf-8',
+                                 headers={'Cache-Control': 'no-cache'})
+            return _json({'success': True, 'evaluation': cached, 'cached': True})
+
+        if upload is not None:
+            image_url = await _offload(core._image_file_to_data_url, upload)
+        if streaming:
+            return _event_stream(_stream_evaluation(image_url, prompt_text, cache_key))
+
+        start = time.monotonic()
+        resp = await core.ms_upstream.call_async(
+            core.async_ms_client.chat.completions.create,
+            model=core.EVALUATE_MODEL,
+            messages=core._evaluate_messages(image_url, prompt_text),
+            stream=False,
+        )
+        text = core._completion_text(resp)
+        if not text:
+            return _json({'success': False, 'error': 'AI未返回有效内容'}, 502)
+
+        if cache_key:
+            await _offload(core.eval_cache.put, cache_key, text, time.monotonic() - start)
+        await core._run_db(core._record_evaluation, image_url, prompt_text)
+        return _json({'success': True, 'evaluation': text})
+    except Exception as e:
+        return _json({'success': False, 'error': str(e)}, 500)
+
+
+# ===== 异步生成任务 =====
+# 任务以 asyncio 任务运行，只受 GENERATE_JOB_MAX_PENDING 限制，不再受 GENERATE_JOB_WORKERS 线程数限制
+
+def _job_accepted(job: dict | None) -> _Response:
+    if job is None:
+        return _json({'success': False, 'error': '任务队列已满，请稍后重试'}, 429)
+    return _json({'success': True, **job}, 202)
+
+
+async def submit_text_to_image_job(req: Request) -> _Response:
+    """异步文生图：立即返回 job_id，参数同 /api/generate/text-to-image"""
+    try:
+        data = req.get_json() or {}
+        prompt = data.get('prompt')
+        size = data.get('size', '2K')
+        watermark = data.get('watermark', True)
+        if not prompt:
+            return _json({'success': False, 'error': '缺少prompt参数'}, 400)
+        return _job_accepted(core.generate_jobs.submit_async(
+            'text_to_image', core._generate_and_record_async, 'text_to_image', prompt, size, watermark,
+            bypass_cache=bool(core._request_flag(data, 'no_cache', req))))
+    except Exception as e:
+        return _json({'success': False, 'error': str(e)}, 500)
+
+
+async def submit_image_to_image_job(req: Request) -> _Response:
+    """异步图文生图：立即返回 job_id，参数同 /api/generate/image-to-image"""
+    try:
+        data = req.get_json() or {}
+        prompt = data.get('prompt')
+        image_url = data.get('image_url')
+        size = data.get('size', '2K')
+        watermark = data.get('watermark', True)
+        if not prompt or not image_url:
+            return _json({'success': False, 'error': '缺少prompt或image_url参数'}, 400)
+        source_image, error = await _offload(core._resolve_source_image, image_url)
+        if error:
+            return _json({'success': False, 'error': error}, 400)
+        return _job_accepted(core.generate_jobs.submit_async(
+            'image_to_image', core._generate_and_record_async, 'image_to_image', prompt, size, watermark,
+            image_url=image_url, source_image=source_image, bypass_cache=bool(core._request_flag(data, 'no_cache', req))))
+    except Exception as e:
+        return _json({'success': False, 'error': str(e)}, 500)
+
+
+async def get_job(req: Request, job_id: str) -> _Response:
+    """轮询任务状态：queued / running / succeeded / failed"""
+    job = await core._run_db(core.generate_jobs.snapshot, job_id)
+    if job is None:
+        return _json({'success': False, 'error': '任务不存在或已过期'}, 404)
+    return _json({'success': True, **job})
+
+
+async def stream_job(req: Request, job_id: str) -> _Response:
+    """以 Server-Sent Events 推送任务状态变化，任务结束后关闭连接；
+    任务可由其他 worker 执行，重连时按 Last-Event-ID 跳过已收到的状态"""
+    snap, current = await core._run_db(core.generate_jobs.versioned, job_id)
+    if snap is None:
+        return _json({'success': False, 'error': '任务不存在或已过期'}, 404)
+    seen = core._last_event_version(req.headers.get('Last-Event-ID'))
+    if current == seen and snap['status'] in core._JOB_TERMINAL:
+        return _Response(status=204)
+
+    async def events():
+        version = seen
+        while True:
+            snap, new_version = await core.generate_jobs.wait_for_change_async(
+                job_id, version, core.SSE_HEARTBEAT_INTERVAL)
+            if snap is None:
+                return
+            if new_version == version:
+                # 心跳注释行，防止代理断开空闲连接
+                yield ': keep-alive\n\n'
+                continue
+            version = new_version
+            yield core._sse('status', snap, version)
+            if snap['status'] in core._JOB_TERMINAL:
+                return
+
+    return _event_stream(events())
+
+
+# ===== 历史记录 =====
+
+async def history_list(req: Request) -> _Response:
+    """历史记录，按时间倒序分页，参数与响应同 app.history_list"""
+    try:
+        limit = max(1, min(1000, int(req.args.get('limit', '100'))))
+        mode = req.args.get('mode') or None
+        try:
+            cursor = core._decode_history_cursor(req.args.get('cursor'))
+        except ValueError as e:
+            return _json({'success': False, 'error': str(e)}, 400)
+        items, next_key = await core._run_db(core._history_page, limit, cursor, mode)
+        return _json({'success': True, 'items': items, 'next_cursor': core._encode_history_cursor(next_key)})
+    except Exception as e:
+        return _json({'success': False, 'error': str(e)}, 500)
+
+
+async def delete_history_item(req: Request, item_id: str) -> _Response:
+    try:
+        if await core._run_db(core._delete_history_entry, item_id):
+            return _json({'success': True})
+        return _json({'success': False, 'error': 'Item not found'}, 404)
+    except Exception as e:
+        return _json({'success': False, 'error': str(e)}, 500)
+
+
+# 路由规则与 app.py 中对应的 Flask 路由保持一致（同时用作指标的 route 标签）
+_routes = Map([
+    Rule('/api/generate/text-to-image', methods=['POST'], endpoint=text_to_image),
+    Rule('/api/generate/image-to-image', methods=['POST'], endpoint=image_to_image),
+    Rule('/api/generate/batch', methods=['POST'], endpoint=generate_batch),
+    Rule('/api/evaluate/photo', methods=['POST'], endpoint=evaluate_photo),
+    Rule('/api/jobs/text-to-image', methods=['POST'], endpoint=submit_text_to_image_job),
+    Rule('/api/jobs/image-to-image', methods=['POST'], endpoint=submit_image_to_image_job),
+    Rule('/api/jobs/<job_id>', methods=['GET'], endpoint=get_job),
+    Rule('/api/jobs/<job_id>/events', methods=['GET'], endpoint=stream_job),
+    Rule('/api/history', methods=['GET'], endpoint=history_list),
+    Rule('/api/history/<item_id>', methods=['DELETE'], endpoint=delete_history_item),
+]).bind('')
+
+
+# ===== 转交 Flask =====
+
+async def _call_flask(environ: dict, send):
+    """在线程池中执行 WSGI 应用，逐块转发响应体（流式响应同样逐块推送）。"""
+    started = {}
+    result = None
+    chunks = None
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    def close():
+        if hasattr(result, 'close'):
+            result.close()
+
+    def pull():
+        """取下一块响应体；读完时在同一次线程调用中关闭可迭代对象并返回 None。"""
+        nonlocal result, chunks
+        try:
+            if result is None:
+                result = core.app(environ, start_response)
+                chunks = iter(result)
+            chunk = next(chunks, None)
+        except BaseException:
+            close()
+            raise
+        if chunk is None:
+            close()
+        return chunk
+
+    chunk = await _offload(pull)
+    # 定长响应预取下一块，让最后一块数据以 more_body=False 发出：客户端收齐响应体后可能立刻在
+    # 同一 keep-alive 连接上发出下一个请求，服务器在本次响应结束前收到的数据会被丢弃。
+    # 流式（chunked）响应以结束块为界，不受影响，也不能预取，否则推送会慢一拍。
+    sized = any(name == b'content-length' for name, _ in started['headers'])
+    try:
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while chunk is not None:
+            if sized:
+                upcoming = await _offload(pull)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': upcoming is not None})
+                chunk = upcoming
+                if chunk is None:
+                    return
+            else:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await _offload(pull)
+    except BaseException:
+        # 客户端断开等情况下提前结束，释放流式响应占用的资源
+        if chunk is not None:
+            await _offload(close)
+        raise
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+# ===== ASGI 应用 =====
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            core.db_bootstrap.start()
+            core.upload_store.start_gc()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await core.async_client.aclose()
+            await core.async_ms_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _handle_native(endpoint, rule: str, args: dict, environ: dict, send):
+    started = time.perf_counter()
+    core.db_bootstrap.start()
+    core.upload_store.start_gc()
+    response = await endpoint(Request(environ), **args)
+    # 与 Flask 路由相同的指标口径：耗时计到返回响应头为止
+    core.metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                         method=environ['REQUEST_METHOD'], route=rule)
+    core.metrics.inc('http_requests_total', method=environ['REQUEST_METHOD'], route=rule,
+                     status=response.status)
+    await response.send(send)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        if scope['type'] == 'websocket':
+            await send({'type': 'websocket.close'})
+        return
+    # 先按 Content-Length 拒绝超限请求，不读取请求体
+    limit = _BODY_LIMITS.get(scope['path'], ASGI_MAX_BODY_BYTES)
+    declared = _content_length(scope)
+    if declared is not None and declared > limit:
+        await _too_large(limit).send(send)
+        return
+    try:
+        rule, args = _routes.match(scope['path'], method=scope['method'], return_rule=True)
+    except HTTPException:
+        # 未命中协程路由（含 404 / 405）时交给 Flask，保持原有响应；请求体在 Flask 读取时才接收
+        body = _ReceiveStream(receive, asyncio.get_running_loop(), limit)
+        await _call_flask(_wsgi_environ(scope, body, None), send)
+        return
+    try:
+        body, length = await _read_body(receive, limit)
+    except _ClientDisconnected:
+        return
+    except _BodyTooLarge:
+        await _too_large(limit).send(send)
+        return
+    try:
+        await _handle_native(rule.endpoint, rule.rule, args, _wsgi_environ(scope, body, length), send)
+    finally:
+        body.close()
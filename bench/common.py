@@ -0,0 +1,128 @@
+"""基准测试脚本共用的工具：隔离运行环境、延迟分位数统计、RSS 读取与结果对比。"""
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepare_environment(workdir: str, upstream_url: str, extra: dict | None = None) -> dict:
+    """在导入 app 之前调用：上游指向本地假服务，数据与上传目录放到 workdir，避免碰到真实数据。"""
+    data_dir = os.path.join(workdir, 'data')
+    upload_dir = os.path.join(workdir, 'uploads')
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(upload_dir, exist_ok=True)
+    env = {
+        'ARK_BASE_URL': f"{upstream_url}/api/v3",
+        'ARK_API_KEY': 'bench',
+        'MS_BASE_URL': f"{upstream_url}/v1",
+        'MS_API_KEY': 'bench',
+        # 指向不可连接的端口，使启动时的 MySQL 初始化立即失败，再由 SQLite 替身接管
+        'DB_HOST': '127.0.0.1',
+        'DB_PORT': '1',
+        'HISTORY_DIR': data_dir,
+        'UPLOAD_DIR': upload_dir,
+        'UPLOAD_INDEX_LEGACY': '0',
+    }
+    env.update(extra or {})
+    os.environ.update(env)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    return env
+
+
+def summarize(samples: list[float]) -> dict:
+    """毫秒级延迟摘要（最近秩法分位数）。"""
+    if not samples:
+        return {'count': 0}
+    data = sorted(samples)
+    n = len(data)
+
+    def pct(p: float) -> float:
+        return round(data[max(0, math.ceil(p / 100 * n) - 1)] * 1000, 3)
+
+    return {
+        'count': n,
+        'mean': round(sum(data) / n * 1000, 3),
+        'min': round(data[0] * 1000, 3),
+        'p50': pct(50),
+        'p95': pct(95),
+        'p99': pct(99),
+        'max': round(data[-1] * 1000, 3),
+    }
+
+
+def process_rss_mb(pid: int | None = None) -> dict:
+    """读取进程当前与峰值 RSS（MB）；非 Linux 时只能给出本进程的峰值。"""
+    path = f"/proc/{pid or 'self'}/status"
+    try:
+        fields = {}
+        with open(path, 'r', encoding='ascii') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    fields[key] = round(int(value.split()[0]) / 1024, 1)
+        return {'rss_mb': fields.get('VmRSS'), 'rss_peak_mb': fields.get('VmHWM')}
+    except OSError:
+        if pid is not None:
+            return {'rss_mb': None, 'rss_peak_mb': None}
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 为字节，Linux 为 KB
+        return {'rss_mb': None, 'rss_peak_mb': round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)}
+
+
+def run_metadata(config: dict) -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': config,
+    }
+
+
+def write_report(report: dict, out: str | None):
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+def compare_reports(baseline: dict, current: dict, section: str, keys: tuple[str, ...]) -> list[str]:
+    """逐项对比两次结果，返回可读的差异行（正百分比表示数值增大：延迟变慢或吞吐升高）。"""
+    lines = []
+    old_items, new_items = baseline.get(section, {}), current.get(section, {})
+    for name, new in new_items.items():
+        old = old_items.get(name)
+        if not old:
+            lines.append(f"{name}: 基线中不存在")
+            continue
+        parts = []
+        for key in keys:
+            a, b = _lookup(old, key), _lookup(new, key)
+            if a is None or b is None:
+                continue
+            delta = f"{(b - a) / a * 100:+.1f}%" if a else 'n/a'
+            parts.append(f"{key} {a:g} -> {b:g} ({delta})")
+        lines.append(f"{name}: " + '; '.join(parts))
+    return lines
+
+
+def _lookup(d: dict, dotted: str):
+    for part in dotted.split('.'):
+        if not isinstance(d, dict) or part not in d:
+            return None
+        d = d[part]
+    return d if isinstance(d, (int, float)) else None
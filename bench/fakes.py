@@ -0,0 +1,307 @@
+"""离线基准测试用的本地替身：
+
+- FakeUpstream：同时模拟火山方舟 images.generate 与 ModelScope（OpenAI 兼容）chat.completions，
+  可配置延迟、抖动与错误注入（5xx / 429），并提供 /fake-images/ 下的示例图片；
+- SqliteHistoryConnection / install_sqlite_history：以 SQLite 代替 MySQL 走完整的历史记录数据库路径
+  （连接池、executemany 批量写入、键集分页等 SQL 原样执行）。
+
+单独运行可启动一个常驻的假上游：
+    python bench/fakes.py --port 9100 --latency 0.8 --error-rate 0.02
+"""
+import argparse
+import io
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+EVALUATION_TEXT = (
+    "构图：主体位于画面三分线附近，视觉重心稳定。\n"
+    "光线：侧光塑造出明显的明暗层次，高光略有溢出。\n"
+    "色彩：整体偏暖，饱和度适中。\n"
+    "建议：适当压低高光并提高暗部细节。\n"
+    "综合评分：8/10"
+)
+
+
+def _sample_jpeg(size=(512, 512), seed: int = 0) -> bytes:
+    rnd = random.Random(seed)
+    img = Image.new('RGB', size, (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # 默认 listen backlog 只有 5，数百并发同时建连时会被拒绝
+    request_queue_size = 1024
+
+
+class FakeUpstream:
+    """线程化 HTTP 服务：latency 为基础延迟秒数，jitter 为额外均匀随机延迟上限，
+    error_rate / rate_limit_rate 为返回 500 / 429 的概率。"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, stream_chunks: int = 8):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.stream_chunks = max(1, stream_chunks)
+        self.image = _sample_jpeg()
+        self._lock = threading.Lock()
+        self.counts: dict[str, int] = {}
+        self._server = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeUpstream':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-upstream', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _delay(self) -> float:
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter > 0 else 0.0)
+
+    def _handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, status: int, payload: dict, headers: dict | None = None):
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _inject_error(self, kind: str) -> bool:
+                roll = random.random()
+                if roll < upstream.error_rate:
+                    upstream._count(f'{kind}:500')
+                    self._json(500, {'error': {'code': 'InternalServiceError', 'message': 'injected failure'}})
+                    return True
+                if roll < upstream.error_rate + upstream.rate_limit_rate:
+                    upstream._count(f'{kind}:429')
+                    self._json(429, {'error': {'code': 'RateLimitExceeded', 'message': 'injected rate limit'}},
+                               {'Retry-After': '0'})
+                    return True
+                return False
+
+            def do_GET(self):
+                if self.path.startswith('/fake-images/'):
+                    upstream._count('image')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', str(len(upstream.image)))
+                    self.end_headers()
+                    self.wfile.write(upstream.image)
+                elif self.path == '/__stats':
+                    with upstream._lock:
+                        counts = dict(upstream.counts)
+                    self._json(200, counts)
+                else:
+                    self._json(404, {'error': {'message': 'not found'}})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    body = {}
+                if self.path.endswith('/images/generations'):
+                    self._generate(body)
+                elif self.path.endswith('/chat/completions'):
+                    self._chat(body)
+                else:
+                    self._json(404, {'error': {'message': 'not found'}})
+
+            def _generate(self, body: dict):
+                time.sleep(upstream._delay())
+                if self._inject_error('generate'):
+                    return
+                upstream._count('generate')
+                self._json(200, {
+                    'model': body.get('model'),
+                    'created': int(time.time()),
+                    'data': [{'url': f"{upstream.base_url}/fake-images/{uuid.uuid4().hex}.jpeg", 'size': '2048x2048'}],
+                    'usage': {'generated_images': 1, 'output_tokens': 16384, 'total_tokens': 16384},
+                })
+
+            def _chat(self, body: dict):
+                delay = upstream._delay()
+                if not body.get('stream'):
+                    time.sleep(delay)
+                    if self._inject_error('chat'):
+                        return
+                    upstream._count('chat')
+                    self._json(200, {
+                        'id': f"chatcmpl-{uuid.uuid4().hex}",
+                        'object': 'chat.completion',
+                        'created': int(time.time()),
+                        'model': body.get('model'),
+                        'choices': [{'index': 0, 'finish_reason': 'stop',
+                                     'message': {'role': 'assistant', 'content': EVALUATION_TEXT}}],
+                        'usage': {'prompt_tokens': 1000, 'completion_tokens': 100, 'total_tokens': 1100},
+                    })
+                    return
+                # 流式：首个片段前等待一半延迟，其余延迟均摊到各片段之间
+                time.sleep(delay / 2)
+                if self._inject_error('chat_stream'):
+                    return
+                upstream._count('chat_stream')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                n = upstream.stream_chunks
+                step = -(-len(EVALUATION_TEXT) // n)
+                chat_id = f"chatcmpl-{uuid.uuid4().hex}"
+                for i in range(0, len(EVALUATION_TEXT), step):
+                    chunk = {
+                        'id': chat_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                        'model': body.get('model'),
+                        'choices': [{'index': 0, 'delta': {'content': EVALUATION_TEXT[i:i + step]}, 'finish_reason': None}],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                    time.sleep(delay / 2 / n)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+# ===== MySQL 历史记录路径的 SQLite 替身 =====
+
+def _translate_sql(sql: str) -> str:
+    sql = sql.replace('%s', '?')
+    return re.sub(r'^\s*INSERT IGNORE', 'INSERT OR IGNORE', sql)
+
+
+class _SqliteCursor:
+    def __init__(self, conn: sqlite3.Connection):
+        self._cur = conn.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cur.close()
+
+    @property
+    def rowcount(self) -> int:
+        return self._cur.rowcount
+
+    def execute(self, sql: str, params=()):
+        self._cur.execute(_translate_sql(sql), tuple(params or ()))
+        return self._cur.rowcount
+
+    def executemany(self, sql: str, seq):
+        self._cur.executemany(_translate_sql(sql), [tuple(p) for p in seq])
+        return self._cur.rowcount
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+
+class SqliteHistoryConnection:
+    """提供应用用到的 pymysql 连接子集（cursor / ping / close / open）。"""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False,
+                                     detect_types=sqlite3.PARSE_DECLTYPES)
+        self.open = True
+
+    def cursor(self) -> _SqliteCursor:
+        return _SqliteCursor(self._conn)
+
+    def ping(self, reconnect: bool = False):
+        self._conn.execute('SELECT 1')
+
+    def close(self):
+        self.open = False
+        self._conn.close()
+
+
+sqlite3.register_converter('DATETIME', lambda raw: datetime.strptime(raw.decode('ascii')[:19], '%Y-%m-%d %H:%M:%S'))
+
+
+def install_sqlite_history(app_module, path: str):
+    """建表并把应用的连接池切换到 SQLite，使历史记录走数据库分支。"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS history_items (
+            id VARCHAR(64) PRIMARY KEY,
+            mode VARCHAR(32),
+            prompt TEXT,
+            source_image_url TEXT,
+            image_url TEXT,
+            size VARCHAR(16),
+            watermark TINYINT(1),
+            created_at DATETIME
+        )
+        """
+    )
+    for name, cols in app_module.HISTORY_DB_INDEXES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON history_items ({cols})")
+    conn.close()
+    app_module.db_pool.close_all()
+    app_module.db_pool.factory = lambda: SqliteHistoryConnection(path)
+    app_module.DB_READY = True
+    # 替身库无需导入文件历史，视同补导已完成
+    app_module.db_bootstrap.caught_up = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地假上游（Ark 生成 + OpenAI 兼容对话）')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.5, help='基础延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.1, help='额外随机延迟上限（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的概率')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='返回 429 的概率')
+    args = parser.parse_args()
+    fake = FakeUpstream(args.host, args.port, args.latency, args.jitter, args.error_rate, args.rate_limit_rate)
+    print(f"fake upstream listening on {fake.base_url}", flush=True)
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
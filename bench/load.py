@@ -0,0 +1,364 @@
+"""离线压测：启动本地假上游与隔离的应用进程，逐个场景覆盖全部 /api/* 路由，
+输出各场景的 p50/p95/p99 延迟、吞吐与服务进程 RSS（JSON，可作为版本间对比的基线）。
+
+    python bench/load.py --duration 10 --concurrency 8 --out baseline.json
+    python bench/load.py --compare baseline.json --out current.json
+    python bench/load.py --url http://127.0.0.1:5008 --scenarios stats,history_list   # 压测已运行的实例
+
+上游延迟与错误注入通过 --latency / --jitter / --error-rate / --rate-limit-rate 调整。
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+from PIL import Image
+
+from common import compare_reports, process_rss_mb, run_metadata, summarize, write_report
+from fakes import FakeUpstream
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _jpeg(seed: int, size=(640, 480)) -> bytes:
+    rnd = random.Random(seed)
+    img = Image.effect_noise(size, 40 + rnd.randrange(40)).convert('RGB')
+    img = Image.blend(img, Image.new('RGB', size, (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))), 0.5)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+
+def _multipart(fields: list[tuple[str, str | tuple[str, bytes, str]]]) -> tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for name, value in fields:
+        out.write(f"--{boundary}\r\n".encode())
+        if isinstance(value, tuple):
+            filename, data, ctype = value
+            out.write(f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                      f'Content-Type: {ctype}\r\n\r\n'.encode())
+            out.write(data)
+        else:
+            out.write(f'Content-Disposition: form-data; name="{name}"\r\n\r\n{value}'.encode())
+        out.write(b"\r\n")
+    out.write(f"--{boundary}--\r\n".encode())
+    return out.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+
+class _Client:
+    """每个压测线程一个长连接。"""
+
+    def __init__(self, base_url: str, timeout: float):
+        u = urllib.parse.urlsplit(base_url)
+        self.host, self.port, self.timeout = u.hostname, u.port or 80, timeout
+        self.conn = None
+
+    def request(self, method: str, path: str, body: bytes | None = None,
+                headers: dict | None = None) -> tuple[int, bytes]:
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers or {})
+                resp = self.conn.getresponse()
+                # SSE 响应在服务端生成器结束（任务完成 / 评估结束）时自然结束
+                return resp.status, resp.read()
+            except (http.client.HTTPException, ConnectionError, OSError):
+                self.close()
+                if attempt:
+                    raise
+        raise RuntimeError('unreachable')
+
+    def json(self, method: str, path: str, payload=None) -> tuple[int, dict]:
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        status, data = self.request(method, path, body, {'Content-Type': 'application/json'} if body else None)
+        try:
+            return status, json.loads(data or b'{}')
+        except ValueError:
+            return status, {}
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Scenarios:
+    """场景函数返回 True 表示业务成功（HTTP 2xx 且 success 不为 False）。"""
+
+    def __init__(self, images: list[bytes], poll_interval: float):
+        self.images = images
+        self.poll_interval = poll_interval
+        self.upload_url = None
+        self._delete_ids: list[str] = []
+        self._lock = threading.Lock()
+
+    def _image(self) -> bytes:
+        return random.choice(self.images)
+
+    @staticmethod
+    def _ok(status: int, payload: dict) -> bool:
+        return 200 <= status < 300 and payload.get('success', True) is not False
+
+    def setup(self, c: _Client):
+        body, ctype = _multipart([('file', ('ref.jpg', self.images[0], 'image/jpeg'))])
+        status, data = c.request('POST', '/api/upload', body, {'Content-Type': ctype})
+        payload = json.loads(data or b'{}')
+        if status != 200 or not payload.get('success'):
+            raise RuntimeError(f'上传参考图失败: {status} {data[:200]!r}')
+        self.upload_url = payload['url']
+
+    def prepare_delete(self, c: _Client):
+        status, payload = c.json('GET', '/api/history?limit=1000')
+        with self._lock:
+            self._delete_ids = [it['id'] for it in payload.get('items', [])]
+
+    def stats(self, c):
+        return self._ok(*c.json('GET', '/api/stats'))
+
+    def metrics(self, c):
+        status, _ = c.request('GET', '/metrics')
+        return status == 200
+
+    def history_list(self, c):
+        return self._ok(*c.json('GET', '/api/history?limit=50'))
+
+    def history_page(self, c):
+        status, payload = c.json('GET', '/api/history?limit=20')
+        if not self._ok(status, payload):
+            return False
+        cursor = payload.get('next_cursor')
+        if cursor:
+            status, payload = c.json('GET', f'/api/history?limit=20&cursor={urllib.parse.quote(cursor)}')
+        return self._ok(status, payload)
+
+    def history_delete(self, c):
+        with self._lock:
+            item_id = self._delete_ids.pop() if self._delete_ids else None
+        if item_id is None:
+            return None
+        return self._ok(*c.json('DELETE', f'/api/history/{urllib.parse.quote(item_id)}'))
+
+    def upload(self, c):
+        body, ctype = _multipart([('file', ('photo.jpg', self._image(), 'image/jpeg'))])
+        status, data = c.request('POST', '/api/upload', body, {'Content-Type': ctype})
+        return self._ok(status, json.loads(data or b'{}'))
+
+    def generate_t2i(self, c):
+        # 每次使用不同的提示词，避免被请求合并与结果缓存吸收
+        return self._ok(*c.json('POST', '/api/generate/text-to-image',
+                                {'prompt': f'bench {uuid.uuid4().hex}', 'size': '2K'}))
+
+    def generate_i2i(self, c):
+        return self._ok(*c.json('POST', '/api/generate/image-to-image',
+                                {'prompt': f'bench {uuid.uuid4().hex}', 'image_url': self.upload_url}))
+
+    def generate_batch(self, c):
+        return self._ok(*c.json('POST', '/api/generate/batch',
+                                {'prompts': [f'bench {uuid.uuid4().hex}' for _ in range(4)]}))
+
+    def _wait_job(self, c, job_id: str) -> bool:
+        while True:
+            status, payload = c.json('GET', f'/api/jobs/{job_id}')
+            if status != 200:
+                return False
+            job = payload.get('job') or payload
+            if job.get('status') in ('succeeded', 'failed'):
+                return job.get('status') == 'succeeded'
+            time.sleep(self.poll_interval)
+
+    def jobs_t2i(self, c):
+        status, payload = c.json('POST', '/api/jobs/text-to-image', {'prompt': f'bench {uuid.uuid4().hex}'})
+        return self._ok(status, payload) and self._wait_job(c, payload['job_id'])
+
+    def jobs_i2i(self, c):
+        status, payload = c.json('POST', '/api/jobs/image-to-image',
+                                 {'prompt': f'bench {uuid.uuid4().hex}', 'image_url': self.upload_url})
+        return self._ok(status, payload) and self._wait_job(c, payload['job_id'])
+
+    def jobs_events(self, c):
+        status, payload = c.json('POST', '/api/jobs/text-to-image', {'prompt': f'bench {uuid.uuid4().hex}'})
+        if not self._ok(status, payload):
+            return False
+        status, data = c.request('GET', f"/api/jobs/{payload['job_id']}/events")
+        return status == 200 and b'"succeeded"' in data
+
+    def _evaluate(self, c, extra: list, stream: bool = False):
+        body, ctype = _multipart([('file', ('photo.jpg', self._image(), 'image/jpeg'))] + extra)
+        status, data = c.request('POST', '/api/evaluate/photo', body, {'Content-Type': ctype})
+        if stream:
+            return status == 200 and b'event: done' in data
+        return self._ok(status, json.loads(data or b'{}'))
+
+    def evaluate(self, c):
+        return self._evaluate(c, [('no_cache', '1')])
+
+    def evaluate_cached(self, c):
+        return self._evaluate(c, [])
+
+    def evaluate_stream(self, c):
+        return self._evaluate(c, [('no_cache', '1'), ('stream', '1')], stream=True)
+
+    def select_best(self, c):
+        files = [('images', (f'{i}.jpg', self._image(), 'image/jpeg')) for i in range(8)]
+        body, ctype = _multipart(files)
+        status, data = c.request('POST', '/api/select/best-image', body, {'Content-Type': ctype})
+        return self._ok(status, json.loads(data or b'{}'))
+
+
+# 按顺序执行：先产生历史记录，删除场景放在最后
+SCENARIOS = (
+    'stats', 'metrics', 'upload', 'generate_t2i', 'generate_i2i', 'generate_batch',
+    'jobs_t2i', 'jobs_i2i', 'jobs_events', 'evaluate', 'evaluate_cached', 'evaluate_stream',
+    'select_best', 'history_list', 'history_page', 'history_delete',
+)
+
+
+def run_scenario(base_url: str, fn, duration: float, concurrency: int, timeout: float) -> dict:
+    samples: list[float] = []
+    failures = 0
+    errors: dict[str, int] = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        nonlocal failures
+        client = _Client(base_url, timeout)
+        local, local_failures = [], 0
+        try:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    ok = fn(client)
+                except Exception as e:
+                    ok = False
+                    with lock:
+                        errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                if ok is None:
+                    break
+                local.append(time.perf_counter() - start)
+                local_failures += 0 if ok else 1
+        finally:
+            client.close()
+            with lock:
+                samples.extend(local)
+                failures += local_failures
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(samples),
+        'failures': failures,
+        'exceptions': errors,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed > 0 else 0.0,
+        'latency_ms': summarize(samples),
+    }
+
+
+def _start_server(upstream_url: str, port: int, history: str, asgi: bool = False) -> tuple[subprocess.Popen, str, int]:
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'serve.py'), '--port', str(port),
+         '--upstream-url', upstream_url, '--history', history] + (['--asgi'] if asgi else []),
+        stdout=subprocess.PIPE, text=True, cwd=HERE,
+    )
+    line = proc.stdout.readline().strip()
+    if not line.startswith('READY '):
+        proc.kill()
+        raise RuntimeError(f'应用进程启动失败: {line!r}')
+    _, url, pid = line.split()
+    return proc, url, int(pid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线压测（本地假上游 + 隔离的应用进程）')
+    parser.add_argument('--url', default=None, help='压测已运行的实例，不再启动假上游与应用进程')
+    parser.add_argument('--port', type=int, default=0, help='应用进程端口，默认随机')
+    parser.add_argument('--history', choices=('sqlite', 'file'), default='sqlite')
+    parser.add_argument('--asgi', action='store_true', help='应用进程以 ASGI 模式（asgi:app）运行')
+    parser.add_argument('--duration', type=float, default=10.0, help='每个场景的持续秒数')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=60.0, help='单个请求超时秒数')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='逗号分隔的场景名')
+    parser.add_argument('--latency', type=float, default=0.5, help='假上游基础延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.2, help='假上游额外随机延迟上限（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='异步任务轮询间隔（秒）')
+    parser.add_argument('--out', default=None, help='结果 JSON 输出路径')
+    parser.add_argument('--compare', default=None, help='与之对比的基线 JSON')
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(',') if n.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+
+    random.seed(0)
+    fake = proc = None
+    server_pid = None
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            fake = FakeUpstream(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                rate_limit_rate=args.rate_limit_rate).start()
+            port = args.port or random.randint(20000, 40000)
+            proc, base_url, server_pid = _start_server(fake.base_url, port, args.history, args.asgi)
+
+        scenarios = Scenarios([_jpeg(i) for i in range(32)], args.poll_interval)
+        setup_client = _Client(base_url, args.timeout)
+        scenarios.setup(setup_client)
+        results = {}
+        for name in names:
+            if name == 'history_delete':
+                scenarios.prepare_delete(setup_client)
+            print(f"running {name} ...", file=sys.stderr, flush=True)
+            result = run_scenario(base_url, getattr(scenarios, name), args.duration, args.concurrency, args.timeout)
+            if server_pid:
+                result['server_memory'] = process_rss_mb(server_pid)
+            results[name] = result
+        setup_client.close()
+
+        report = {
+            'meta': run_metadata({k: v for k, v in vars(args).items() if k not in ('out', 'compare')}),
+            'scenarios': results,
+            'server': process_rss_mb(server_pid) if server_pid else None,
+            'upstream_calls': dict(fake.counts) if fake else None,
+        }
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if fake is not None:
+            fake.stop()
+
+    write_report(report, args.out)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        lines = compare_reports(baseline, report, 'scenarios',
+                                ('latency_ms.p50', 'latency_ms.p95', 'latency_ms.p99', 'throughput_rps',
+                                 'server_memory.rss_mb'))
+        print('\n'.join(lines), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""热点函数微基准：质量评分、评估图片预处理与图生图参考图编码。
+
+    python bench/micro.py --out micro.json [--compare baseline_micro.json] [--min-time 1.0]
+
+输出 JSON，每项给出单次耗时的 p50/p95/p99 等（毫秒）。
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from common import compare_reports, prepare_environment, process_rss_mb, run_metadata, summarize, write_report
+
+
+def _noise_image(w: int, h: int, seed: int = 0) -> Image.Image:
+    # 带噪声的渐变图：接近真实照片的压缩率，避免纯色图把编码耗时测得过低
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, w, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, h, dtype=np.float32)[:, None, None]
+    base = (x * 0.6 + y * 0.4) * np.ones((1, 1, 3), dtype=np.float32)
+    arr = np.clip(base + rng.normal(0, 25, (h, w, 3)), 0, 255).astype(np.uint8)
+    return Image.fromarray(arr, 'RGB')
+
+
+def _encoded(img: Image.Image, fmt: str, **kw) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **kw)
+    return buf.getvalue()
+
+
+def _measure(fn, min_time: float, min_runs: int = 3, max_runs: int = 200) -> dict:
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < min_runs or (time.perf_counter() < deadline and len(samples) < max_runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def run(min_time: float) -> dict:
+    import app
+    import scoring
+    from werkzeug.datastructures import FileStorage
+
+    results = {}
+
+    # _compute_quality_score：直接对已解码位图评分
+    for size in (512, 1024, 2048):
+        img = _noise_image(size, size, seed=size)
+        results[f'quality_score_{size}px'] = _measure(lambda: scoring._compute_quality_score(img), min_time)
+
+    # 子进程中实际执行的完整路径：解码 + 评分（全分辨率与降采样两种模式）
+    photo = _encoded(_noise_image(4000, 3000, seed=1), 'JPEG', quality=90)
+    results['score_bytes_4000x3000_full'] = _measure(lambda: scoring._score_image_bytes(photo), min_time)
+    results['score_bytes_4000x3000_reduced'] = _measure(lambda: scoring._score_image_bytes_reduced(photo), min_time)
+
+    # _image_file_to_data_url：评估接口对上传文件的缩放与 base64 编码
+    for label, data in (('1024_jpeg', _encoded(_noise_image(1024, 768, seed=2), 'JPEG', quality=90)),
+                        ('4000x3000_jpeg', photo),
+                        ('2048_png', _encoded(_noise_image(2048, 2048, seed=3), 'PNG'))):
+        def to_data_url(data=data):
+            app._image_file_to_data_url(FileStorage(stream=io.BytesIO(data), filename='x'))
+        results[f'image_file_to_data_url_{label}'] = _measure(to_data_url, min_time)
+
+    # 图生图参考图编码：首次（生成并持久化 data URL，超过 10MB 时压缩）与复用已生成结果
+    small = _encoded(_noise_image(1024, 1024, seed=4), 'JPEG', quality=90)
+    large = _encoded(_noise_image(4096, 3072, seed=5), 'PNG')
+    if len(large) <= app.REFERENCE_MAX_BYTES:
+        print(f"warning: large reference is only {len(large)} bytes", file=sys.stderr)
+    for label, data, ext in (('small_jpeg', small, 'jpg'), ('large_png', large, 'png')):
+        name = f"bench-{label}.{ext}"
+        path = os.path.join(app.UPLOAD_DIR, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        def cold(path=path, name=name):
+            app._build_reference_derivative(path, name)
+
+        results[f'reference_encode_cold_{label}'] = _measure(cold, min_time, max_runs=20)
+        results[f'reference_encode_warm_{label}'] = _measure(
+            lambda name=name: app._resolve_source_image(f'/uploads/{name}'), min_time)
+        results[f'reference_encode_cold_{label}']['input_bytes'] = len(data)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='热点函数微基准')
+    parser.add_argument('--min-time', type=float, default=1.0, help='每项最少测量秒数')
+    parser.add_argument('--out', default=None, help='结果 JSON 输出路径')
+    parser.add_argument('--compare', default=None, help='与之对比的基线 JSON')
+    args = parser.parse_args()
+
+    random.seed(0)
+    workdir = tempfile.mkdtemp(prefix='seedream-micro-')
+    try:
+        # 微基准不访问上游，地址仅用于满足客户端初始化
+        prepare_environment(workdir, 'http://127.0.0.1:9')
+        results = run(args.min_time)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        'meta': run_metadata({'min_time': args.min_time}),
+        'micro': results,
+        'process': process_rss_mb(),
+    }
+    write_report(report, args.out)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('\n'.join(compare_reports(baseline, report, 'micro', ('p50', 'p95', 'p99'))), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""在隔离目录中启动应用供压测使用：上游指向本地假服务，历史记录默认走 SQLite 替身。
+
+    python bench/serve.py --port 5108 --upstream-url http://127.0.0.1:9100
+
+未指定 --upstream-url 时在本进程内启动一个假上游。就绪后向 stdout 输出一行 "READY <url> <pid>"。
+--asgi 时以 gunicorn 的 asgi worker（单 worker）运行 asgi:app，输出的 pid 为 worker 进程。
+"""
+import argparse
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+from common import prepare_environment
+from fakes import FakeUpstream, install_sqlite_history
+
+
+def main():
+    parser = argparse.ArgumentParser(description='以本地替身启动应用')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5108)
+    parser.add_argument('--upstream-url', default=None)
+    parser.add_argument('--workdir', default=None, help='数据与上传目录，默认新建临时目录')
+    parser.add_argument('--history', choices=('sqlite', 'file'), default='sqlite',
+                        help='sqlite：以 SQLite 代替 MySQL；file：走 JSONL 文件回退路径')
+    parser.add_argument('--latency', type=float, default=0.2, help='内置假上游的基础延迟（秒）')
+    parser.add_argument('--asgi', action='store_true', help='以 ASGI 模式（asgi:app）运行')
+    parser.add_argument('--worker-connections', type=int, default=1000, help='ASGI 模式下单 worker 的最大连接数')
+    args = parser.parse_args()
+
+    upstream_url = args.upstream_url
+    if not upstream_url:
+        upstream_url = FakeUpstream(latency=args.latency).start().base_url
+    workdir = args.workdir or tempfile.mkdtemp(prefix='seedream-bench-')
+    # 压测脚本以 SIGTERM 结束本进程，转为正常退出以便清理临时目录
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    prepare_environment(workdir, upstream_url)
+
+    import app as app_module
+    if args.history == 'sqlite':
+        install_sqlite_history(app_module, os.path.join(workdir, 'history.sqlite3'))
+
+    if args.asgi:
+        try:
+            _serve_asgi(args)
+        finally:
+            if not args.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+        return
+
+    from werkzeug.serving import make_server
+    # 逐请求访问日志本身会成为瓶颈，只保留告警
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server(args.host, args.port, app_module.app, threaded=True)
+    host, port = server.server_address[:2]
+    print(f"READY http://{host}:{port} {os.getpid()}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _serve_asgi(args):
+    from gunicorn.app.base import BaseApplication
+    import asgi
+
+    class _Server(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f"{args.host}:{args.port}",
+                'workers': 1,
+                'worker_class': 'asgi',
+                'worker_connections': args.worker_connections,
+                'graceful_timeout': 5,
+                'loglevel': 'warning',
+                # worker 就绪后再输出 READY，pid 取 worker 进程以便压测脚本读取其内存
+                'post_worker_init': lambda worker: print(
+                    f"READY http://{args.host}:{args.port} {os.getpid()}", flush=True),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return asgi.app
+
+    # gunicorn 自行处理 SIGTERM：通知 worker 优雅退出后返回
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _Server().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""图片质量评分与近似重复指纹：只依赖 numpy 与 Pillow、导入时没有副作用。
+
+评分进程池以 spawn 方式启动子进程，子进程只需导入本模块，不会导入 app
+（也就不会重复初始化数据库、后台线程等进程级资源）。
+"""
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+SCORE_DECODE_SIZE = (1024, 1024)
+FINGERPRINT_DECODE_SIZE = (128, 128)
+_LAPLACIAN_KERNEL = np.array([[0, 1, 0], [1, -4, 1], [0, 1, 0]], dtype=np.float32)
+
+
+def _conv2d(arr: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """二维互相关（与逐像素实现等价），边界采用 reflect 填充。
+
+    按卷积核的每个偏移对整幅图做切片加权累加，计算量为 kh*kw 次向量运算，
+    避免逐像素的 Python 循环。
+    """
+    kh, kw = kernel.shape
+    ph, pw = kh // 2, kw // 2
+    padded = np.pad(arr, ((ph, ph), (pw, pw)), mode='reflect')
+    h, w = arr.shape
+    out = np.zeros_like(arr)
+    for di in range(kh):
+        for dj in range(kw):
+            k = kernel[di, dj]
+            if k == 0:
+                continue
+            out += k * padded[di:di + h, dj:dj + w]
+    return out
+
+
+def _compute_quality_score(img: Image.Image, orig_size: tuple[int, int] | None = None) -> float:
+    """
+    计算图片质量评分：综合锐度(边缘)、对比度、亮度合理性与分辨率。
+    返回值越大表示质量越好。
+    orig_size：img 为降采样解码结果时传入原始尺寸，保证分辨率评分不变。
+    """
+    # 限制计算尺寸，保证速度与稳定
+    w, h = orig_size or img.size
+    scaled = img.copy()
+    scaled.thumbnail((1024, 1024), Image.LANCZOS)
+    arr = np.array(scaled.convert('L'), dtype=np.float32)
+
+    # Sobel 边缘强度
+    kx = np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]], dtype=np.float32)
+    ky = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]], dtype=np.float32)
+    gx = _conv2d(arr, kx)
+    gy = _conv2d(arr, ky)
+    mag = np.sqrt(gx * gx + gy * gy)
+    edge_mean = float(np.mean(mag))
+    sharpness_score = float(np.log1p(edge_mean))  # 0~4 左右
+
+    # 对比度（标准差）
+    contrast_score = float(np.std(arr) / 50.0)
+
+    # 亮度偏差惩罚，接近中性灰更佳
+    brightness_penalty = float(abs(np.mean(arr) - 127.5) / 127.5)
+
+    # 分辨率评分（偏好更高分辨率）
+    resolution_score = float(min(w, h) / 1024.0)
+
+    score = sharpness_score + 0.8 * contrast_score + 0.2 * resolution_score - 0.5 * brightness_penalty
+    return round(score, 6)
+
+
+def _score_image_bytes(data: bytes) -> float | None:
+    """在子进程中执行：解码并评分，无法解析时返回 None。"""
+    try:
+        img = Image.open(io.BytesIO(data)).convert('RGB')
+        return _compute_quality_score(img)
+    except Exception:
+        return None
+
+
+def _score_image_bytes_reduced(data: bytes) -> float | None:
+    """降采样解码后评分：JPEG 使用 draft 模式直接按 1/2~1/8 比例解码，
+    其他格式解码后立即缩小，避免持有全分辨率位图。"""
+    try:
+        img = Image.open(io.BytesIO(data))
+        orig_size = img.size
+        img.draft('RGB', SCORE_DECODE_SIZE)
+        img = img.convert('RGB')
+        if max(img.size) > max(SCORE_DECODE_SIZE):
+            img.thumbnail(SCORE_DECODE_SIZE, Image.LANCZOS)
+        return _compute_quality_score(img, orig_size=orig_size)
+    except Exception:
+        return None
+
+
+def _score_image_bytes_timed(reduced: bool, data: bytes) -> tuple[float | None, float]:
+    """在子进程中执行：返回 (评分, 解码+评分耗时)，耗时由父进程汇总到指标。"""
+    start = time.perf_counter()
+    score = (_score_image_bytes_reduced if reduced else _score_image_bytes)(data)
+    return score, time.perf_counter() - start
+
+
+def _image_fingerprint(data: bytes) -> tuple[int | None, float | None, float]:
+    """在子进程中执行：降采样解码为灰度小图，返回 (dHash, 清晰度粗估, 耗时)；无法解析时前两项为 None。"""
+    start = time.perf_counter()
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft('L', FINGERPRINT_DECODE_SIZE)
+        img = img.convert('L')
+        img.thumbnail(FINGERPRINT_DECODE_SIZE, Image.BILINEAR)
+        # dHash：缩为 9x8 后比较水平相邻像素，得到 64 位
+        tiny = np.asarray(img.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+        bits = (tiny[:, 1:] > tiny[:, :-1]).ravel()
+        dhash = int.from_bytes(np.packbits(bits).tobytes(), 'big')
+        # 拉普拉斯响应方差：只用于组内排序，不参与最终评分
+        sharpness = float(_conv2d(np.asarray(img, dtype=np.float32), _LAPLACIAN_KERNEL).var())
+        return dhash, sharpness, time.perf_counter() - start
+    except Exception:
+        return None, None, time.perf_counter() - start
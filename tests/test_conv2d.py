@@ -0,0 +1,91 @@
+"""_conv2d 向量化实现的回归测试：与原逐像素实现逐点对比，并校验质量评分不变。"""
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _reference_conv2d(arr: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    # 向量化之前的逐像素实现，作为对照
+    kh, kw = kernel.shape
+    ph, pw = kh // 2, kw // 2
+    padded = np.pad(arr, ((ph, ph), (pw, pw)), mode='reflect')
+    out = np.zeros_like(arr)
+    for i in range(arr.shape[0]):
+        region_rows = padded[i:i+kh]
+        for j in range(arr.shape[1]):
+            region = region_rows[:, j:j+kw]
+            out[i, j] = float((region * kernel).sum())
+    return out
+
+
+SOBEL_X = np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]], dtype=np.float32)
+SOBEL_Y = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]], dtype=np.float32)
+
+
+@pytest.fixture(scope='module')
+def scoring_module():
+    # scoring 只依赖 numpy 与 Pillow，导入时不触碰数据目录与数据库
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import scoring
+    return scoring
+
+
+def _kernels(rng):
+    return {
+        'sobel_x': SOBEL_X,
+        'sobel_y': SOBEL_Y,
+        'random_3x3': rng.normal(size=(3, 3)).astype(np.float32),
+        'random_5x5': rng.normal(size=(5, 5)).astype(np.float32),
+    }
+
+
+@pytest.mark.parametrize('shape', [(5, 7), (17, 32), (64, 64), (3, 100)])
+def test_conv2d_matches_reference_on_random_input(scoring_module, shape):
+    rng = np.random.default_rng(sum(shape))
+    arr = rng.uniform(0, 255, size=shape).astype(np.float32)
+    for name, kernel in _kernels(rng).items():
+        expected = _reference_conv2d(arr, kernel)
+        actual = scoring_module._conv2d(arr, kernel)
+        assert actual.shape == expected.shape and actual.dtype == expected.dtype
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-3, err_msg=name)
+
+
+def test_conv2d_matches_reference_on_reflect_edges(scoring_module):
+    # 边界处强对比：reflect 填充若取错行列，边缘像素的结果会明显不同
+    arr = np.zeros((24, 31), dtype=np.float32)
+    arr[0, :] = 255
+    arr[:, -1] = 200
+    arr[1, 1] = 50
+    arr[-2, 0] = 255
+    arr[-1, -1] = 0
+    rng = np.random.default_rng(1)
+    for name, kernel in _kernels(rng).items():
+        expected = _reference_conv2d(arr, kernel)
+        actual = scoring_module._conv2d(arr, kernel)
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-3, err_msg=name)
+        np.testing.assert_allclose(actual[[0, -1], :], expected[[0, -1], :], rtol=1e-5, atol=1e-3)
+        np.testing.assert_allclose(actual[:, [0, -1]], expected[:, [0, -1]], rtol=1e-5, atol=1e-3)
+
+
+def _noise_image(w: int, h: int, seed: int) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, w, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, h, dtype=np.float32)[:, None, None]
+    base = (x * 0.6 + y * 0.4) * np.ones((1, 1, 3), dtype=np.float32)
+    arr = np.clip(base + rng.normal(0, 25, (h, w, 3)), 0, 255).astype(np.uint8)
+    return Image.fromarray(arr, 'RGB')
+
+
+@pytest.mark.parametrize('size, seed', [((96, 64), 0), ((160, 120), 1), ((33, 200), 2)])
+def test_quality_score_unchanged(scoring_module, monkeypatch, size, seed):
+    img = _noise_image(*size, seed=seed)
+    actual = scoring_module._compute_quality_score(img)
+    monkeypatch.setattr(scoring_module, '_conv2d', _reference_conv2d)
+    expected = scoring_module._compute_quality_score(img)
+    assert actual == pytest.approx(expected, abs=1e-4)